@@ -0,0 +1,86 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from timing import timing
+
+"""
+Concurrent acquisition stage
+
+Blocking reads (e.g. HTTP request to the meterhub) are started in worker threads and run at the same time as the
+VE.Bus transactions in the control loop. join() collects the results until a deadline. A job which is not finished
+at the deadline keeps running in the background, its data is used in a later cycle. A job is not started again
+while the previous one is still running.
+
+    acquisition.start('meterhub', meterhub.read)
+    multiplus.update()                                  # VE.Bus transactions in parallel
+    acquisition.join(deadline=t_begin + 0.4)
+"""
+
+
+class Acquisition:
+    def __init__(self, workers=2, log_name='acquisition'):
+        """
+        :param workers: number of worker threads
+        :param log_name: name for logger
+        """
+        self.log = logging.getLogger(log_name)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='acquisition')
+        self.jobs = {}  # running or finished jobs, name: future
+        self.stats = {}  # name: {'done': n, 'late': n, 'busy': n, 'error': n}
+
+    def start(self, name, func, *args, **kwargs):
+        """
+        Start a job in a worker thread. Skipped if the previous job with the same name is still running.
+
+        :param name: name of the job
+        :param func: function to run
+        :return: True if started
+        """
+        stats = self.stats.setdefault(name, {'done': 0, 'late': 0, 'busy': 0, 'error': 0})
+        job = self.jobs.get(name, None)
+        if job is not None and not job.done():
+            stats['busy'] += 1
+            self.log.debug("{} still running, not restarted".format(name))
+            return False
+        self.jobs[name] = self.executor.submit(self.run, name, func, *args, **kwargs)
+        return True
+
+    def run(self, name, func, *args, **kwargs):
+        """
+        Run a job inside the worker thread, the duration is added to the latency statistics as 'acquisition.<name>'
+        """
+        with timing.measure('acquisition.' + name):
+            return func(*args, **kwargs)
+
+    def join(self, deadline):
+        """
+        Wait for all started jobs until the deadline
+
+        :param deadline: absolute time (time.perf_counter())
+        :return: list with names of the jobs finished in time
+        """
+        wait(self.jobs.values(), timeout=max(deadline - time.perf_counter(), 0))
+
+        finished = []
+        for name, job in list(self.jobs.items()):
+            if job.done():
+                del self.jobs[name]
+                if job.exception() is not None:
+                    self.stats[name]['error'] += 1
+                    self.log.error("{} failed: {}".format(name, job.exception()))
+                else:
+                    self.stats[name]['done'] += 1
+                    finished.append(name)
+            else:
+                self.stats[name]['late'] += 1
+                self.log.debug("{} not finished at deadline".format(name))
+        return finished
+
+    def get_state(self):
+        """
+        Get job statistics
+
+        :return: dictionary
+        """
+        return {name: dict(stats) for name, stats in self.stats.items()}
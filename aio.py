@@ -0,0 +1,841 @@
+import asyncio
+import json
+import logging
+import struct
+import sys
+import time
+from io import BytesIO
+from urllib.parse import urlsplit, unquote
+
+from api_request import ApiRequest
+from bms_us2000 import US2000
+from config import config
+from multiplus2 import MultiPlus2
+from pylontech import get_command, decode_frame, parse_analog_value, parse_alarm_info, parse_analog_block, \
+    parse_alarm_block, parse_packs, ALL_PACKS
+from timing import timing
+from vebus import VEBus
+
+"""
+asyncio runtime (config: 'runtime': 'asyncio')
+
+All devices run as coroutines on one event loop, driven by the same App statemachine:
+
+    AsyncVEBus / AsyncMultiPlus2    VE.Bus transactions, the serial port is read with loop.add_reader(), optional
+                                    worker task (mp2_thread, more than one device)
+    AsyncUS2000Poller               Pylontech polling, replaces the US2000 thread
+    AsyncApiRequest                 meterhub HTTP request with asyncio streams
+    AsyncWSGIServer                 web API, HTTP on the event loop, the Bottle application runs in the executor
+
+Frames, parser and the decisions (e.g. MultiPlus2.next_command) are shared with the threaded drivers, only the I/O is
+replaced. Non-blocking serial access needs a POSIX system (Raspberry, NAS, ...).
+"""
+
+
+class AsyncSerial:
+    """
+    Non-blocking access to an open pyserial port. Received bytes are collected in a buffer by a reader callback,
+    coroutines wait for new data instead of polling.
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self.com = None
+        self.buffer = bytearray()
+        self.event = asyncio.Event()
+
+    def attach(self, com):
+        """
+        Attach an open pyserial port to the running event loop
+
+        :param com: pyserial instance
+        """
+        self.detach()
+        self.com = com
+        self.buffer.clear()
+        asyncio.get_running_loop().add_reader(com.fileno(), self.on_readable)
+
+    def detach(self):
+        if self.com is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self.com.fileno())
+            except Exception:
+                pass
+        self.com = None
+        self.event.set()  # wake up waiting coroutines
+
+    def on_readable(self):
+        try:
+            self.buffer += self.com.read(self.com.in_waiting or 1)
+        except Exception as e:
+            self.log.error("serial read failed: {}".format(e))
+            self.detach()
+        self.event.set()
+
+    def write(self, data):
+        self.com.write(data)
+
+    def reset_input_buffer(self):
+        self.buffer.clear()
+
+    async def wait_data(self, tout):
+        """
+        Wait for new received data
+
+        :param tout: absolute timeout (time.perf_counter())
+        """
+        self.event.clear()
+        await asyncio.wait_for(self.event.wait(), max(tout - time.perf_counter(), 0))
+        if self.com is None:
+            raise IOError("serial port closed")
+
+    async def read_until(self, terminator, timeout):
+        """
+        Read until terminator, like pyserial read_until() the received data is returned on timeout
+
+        :param terminator: bytes
+        :param timeout: timeout in seconds
+        :return: bytes
+        """
+        tout = time.perf_counter() + timeout
+        while True:
+            p = self.buffer.find(terminator)
+            if p >= 0:
+                data = bytes(self.buffer[:p + len(terminator)])
+                del self.buffer[:p + len(terminator)]
+                return data
+            try:
+                await self.wait_data(tout)
+            except asyncio.TimeoutError:
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                return data
+
+
+class AsyncVEBus(VEBus):
+    """
+    VEBus with coroutines for all transactions
+    """
+
+    def __init__(self, port, log='vebus'):
+        self.aserial = AsyncSerial(logging.getLogger(log))
+        super().__init__(port, log)
+
+    def check_port(self):
+        if self.serial is None:
+            self.open_port()  # open port
+        if self.serial is None:
+            raise IOError("serial port not available")
+        if self.aserial.com is not self.serial:
+            self.aserial.attach(self.serial)
+            self.parser.clear()
+
+    def port_failed(self):
+        self.serial = None
+        self.aserial.detach()
+        self.log.error("serial port failed")
+
+    async def request(self, cmd, data, head, timeout=0.5):
+        """
+        Send a frame and wait for the response
+
+        :param cmd: command
+        :param data: payload
+        :param head: search pattern (frame start) or list of search pattern
+        :param timeout: timeout in seconds
+        :return: frame
+        """
+        self.check_port()
+        frame = self.build_frame(cmd, data)
+        self.log.debug("TX: cmd={} frame={}".format(cmd, self.format_hex(frame)))
+        self.write(frame)
+        return await self.receive(head, timeout)
+
+    def write(self, data, frames=1):
+        self.aserial.write(data)
+        self.link.add_tx(len(data), frames)
+
+    def read_buffer(self):
+        """
+        Move the bytes received by the event loop into the parser
+        """
+        rx = self.aserial.buffer
+        self.link.add_rx(len(rx))
+        self.parser.feed(rx)
+        rx.clear()
+
+    async def receive(self, head, timeout=0.5):
+        """
+        Receive frame, see VEBus.receive_frame()
+        """
+        tout = time.perf_counter() + timeout
+        while True:
+            self.read_buffer()
+            frame = self.match_frame(head)
+            if frame is not None:
+                return frame
+            try:
+                await self.aserial.wait_data(tout)
+            except asyncio.TimeoutError:
+                break
+
+        if self.parser.buffer:
+            raise Exception("invalid rx frame {}".format(self.format_hex(self.parser.buffer)))
+        else:
+            raise Exception("receive timeout, no data")
+
+    async def get_version(self):
+        try:
+            rx = await self.request('V', [], b'\x07\xFF', timeout=0.5)
+            return self.parse_version(rx)
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            return None
+
+    async def init_address(self, addr=0x00):
+        try:
+            rx = await self.request('A', [0x01, addr], b'\x04\xFF\x41')
+            return self.parse_init_address(rx, addr)
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("init_address {}: {}".format(addr, e))
+        return False
+
+    async def get_led(self):
+        try:
+            rx = await self.request('L', [], b'\x08\xFF\x4C', timeout=0.5)
+            return self.parse_led(rx)
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("get_led: {}".format(e))
+            return None
+
+    async def get_ac_info(self):
+        try:
+            if len(self.phases) > 1:
+                return self.parse_ac_phases(await self.transact([('F', [p], b'\x0F\x20') for p in self.phases]))
+            rx = await self.request('F', [0x01], b'\x0F\x20')
+            return self.parse_ac_info(rx)
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("get_ac_info: {}".format(e))
+            return None
+
+    async def send_snapshot_request(self):
+        try:
+            self.check_port()
+            self.write(self.build_frame('F', [0x06] + self.snapshot_ids))  # no response
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("send_snapshot_request: {}".format(e))
+
+    async def read_snapshot(self):
+        try:
+            rx = await self.request('X', [0x38], self.snapshot_head(self.snapshot_ids))
+            return self.parse_snapshot(rx)
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("read_snapshot: {}".format(e))
+            return None
+
+    async def get_ram_var_info(self, ramid):
+        key = (self.address, self.mk2_version, ramid)
+        if key in self.ram_var_info:
+            return self.ram_var_info[key]
+        try:
+            rx = await self.request('X', struct.pack("<BH", 0x36, ramid), b'\x07\xFF\x58\x8E')
+            return self.parse_ram_var_info(rx, ramid)
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("get_ram_var_info: ramid={} error={}".format(ramid, e))
+            return None
+
+    async def load_ram_var_info(self, ids):
+        return all([await self.get_ram_var_info(ramid) is not None for ramid in ids])
+
+    async def read_ram_vars(self, ids, pause=0.05):
+        if not 0 < len(ids) <= self.SNAPSHOT_MAX:
+            raise ValueError("1..{} RAM ids per snapshot, got {}".format(self.SNAPSHOT_MAX, len(ids)))
+        await self.load_ram_var_info(ids)
+        try:
+            self.check_port()
+            self.write(self.build_frame('F', [0x06] + list(ids)))  # no response
+            await asyncio.sleep(pause)
+            rx = await self.request('X', [0x38], self.snapshot_head(ids))
+            return self.parse_ram_vars(rx, ids)
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("read_ram_vars: ids={} error={}".format(ids, e))
+            return None
+
+    async def set_power(self, power):
+        try:
+            rx = await self.request('X', self.make_set_power(power), [b'\x05\xFF\x58', b'\x03\xFF\x58'])
+            return self.parse_set_power(rx, power)
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("set_ess_power: power={} error={}".format(power, e))
+            return False
+
+    async def set_power_multi(self, setpoints):
+        try:
+            batch = self.batch_set_power(setpoints)
+            return self.parse_set_power_multi(batch, await self.transact(batch, 0.5 + 0.06 * len(batch)))
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("set_power_multi: setpoints={} error={}".format(setpoints, e))
+            return False
+
+    async def transact(self, batch, timeout=0.5):
+        """
+        Send several requests with one write, see VEBus.transact()
+        """
+        self.check_port()
+        tx, responses, pending = self.make_batch(batch)
+        self.log.debug("TX: batch={}".format(self.format_hex(tx)))
+        self.write(tx, len(batch))
+        tout = time.perf_counter() + timeout
+        while True:
+            self.read_buffer()
+            if self.assign_frames(pending, responses):
+                return responses
+            try:
+                await self.aserial.wait_data(tout)
+            except asyncio.TimeoutError:
+                raise Exception("batch timeout, missing {}".format([batch[i][0] for i in pending]))
+
+    async def get_ac_info_batch(self):
+        try:
+            rx = await self.transact(self.batch_ac_info())
+            return self.parse_ac_phases(rx[1:])
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("get_ac_info_batch: {}".format(e))
+            return None
+
+    async def read_snapshot_led(self):
+        try:
+            rx = await self.transact(self.batch_snapshot_led())
+            return self.parse_snapshot(rx[0]), self.parse_led(rx[1])
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("read_snapshot_led: {}".format(e))
+        return None, None
+
+    async def scan_ess_assistant(self):
+        ramid = 128
+        for n in range(8):
+            try:
+                rx = await self.request('X', struct.pack("<BH", 0x30, ramid), b'\x07\xFF\x58')  # read ram id
+                found, ramid = self.parse_scan_ess_assistant(rx, ramid)
+                if found:
+                    return True
+            except IOError:
+                self.port_failed()
+            except Exception as e:
+                self.log.error("scan_ess_assistant error={}".format(e))
+                return False
+
+        self.log.error("ess assistant not found")
+        return False
+
+    async def verify_ess_assistant(self, ramid):
+        try:
+            rx = await self.request('X', struct.pack("<BH", 0x30, ramid - 1), b'\x07\xFF\x58')  # read ram id
+            found, _ = self.parse_scan_ess_assistant(rx, ramid - 1)
+            return found
+        except IOError:
+            self.port_failed()
+        except Exception as e:
+            self.log.error("verify_ess_assistant ramid={} error={}".format(ramid, e))
+        return False
+
+
+class AsyncMultiPlus2(MultiPlus2):
+    """
+    MultiPlus2 driven by the event loop. With worker=True the VE.Bus is served by run() as an own task like the
+    worker thread of MultiPlus2: command() and update() do not wait, a setpoint is sent first.
+    """
+
+    def __init__(self, port, timeout=10, worker=False, **kwargs):
+        super().__init__(port, timeout, vebus=AsyncVEBus(port=port, log='vebus'), **kwargs)
+        self.worker = worker
+        self.wake = asyncio.Event()  # setpoint posted for the worker task
+
+    async def connect(self):
+        version = await self.vebus.get_version()
+        if version:
+            self.data = {'mk2_version': version}  # init dictionary
+            await asyncio.sleep(0.1)
+            for device in reversed(self.devices):  # first device is selected at the end
+                if not await self.connect_device(device):
+                    return
+            await self.vebus.load_ram_var_info(self.vebus.snapshot_ids)  # default scaling on failure
+            self.data = {'mk2_version': version, 'state': 'init'}  # replace, published data is not modified
+            self.data_timeout = time.perf_counter() + self.timeout  # start timeout
+            self.online = True
+
+    async def connect_device(self, device):
+        if not await self.vebus.init_address(device['address']):
+            return False
+        await asyncio.sleep(0.1)
+        ramid = self.get_cached_ram_id()
+        if ramid and await self.vebus.verify_ess_assistant(ramid):
+            self.warm_connects += 1
+        elif not await self.vebus.scan_ess_assistant():
+            return False
+        return self.set_device_ram_id(device)
+
+    async def try_connect(self):
+        try:
+            await self.connect()
+        except Exception as e:
+            self.log.exception("connect: {}".format(e))
+        self.connect_done()
+
+    async def command(self, power, meter=None):
+        self.set_phase_grid(meter)
+        if self.worker:
+            if self.wake.is_set() and self.setpoint_time is not None:
+                self.coalesced += 1
+            self.setpoint = power  # replaces a setpoint not yet sent
+            self.setpoint_time = time.perf_counter()
+            self.wake.set()
+        else:
+            await self.execute(*self.next_command(power))
+
+    async def execute(self, cmd, value):
+        if cmd == 'wakeup':
+            self.vebus.wakeup()
+        elif cmd == 'sleep':
+            self.vebus.sleep()
+        elif cmd == 'power':
+            t = time.perf_counter()
+            with timing.measure('mp2.set_power'):
+                if len(self.devices) > 1:
+                    ok = await self.vebus.set_power_multi(self.split_power(value))
+                else:
+                    ok = await self.vebus.set_power(value)
+            self.set_power_time = time.perf_counter() - t
+            self.set_power_done(value, ok)
+
+    async def update(self, pause_time=0.1):
+        self.pause_time = pause_time
+        if self.worker:
+            return  # read by the worker task
+        if not self.online:
+            if self.connect_due():
+                self.connecting = True
+                asyncio.ensure_future(self.try_connect())  # the cycle continues while connecting
+        else:
+            await self.read_all(asyncio.sleep)
+
+        self.check_timeout()
+
+    async def read_all(self, pause):
+        """
+        Read all information, set data if complete
+
+        :param pause: coroutine function(duration) between the requests
+        """
+        self.vebus.link.cycle()  # link statistics per update interval
+        steps, led = self.update_steps()
+        parts = []
+        for n, (name, func) in enumerate(steps):
+            if n:
+                await pause(self.pause_time)
+            with timing.measure(name):
+                part = await func()
+            if not self.add_part(parts, name, part):
+                return
+        self.set_data(*parts, self.vebus.led_status if led else {})
+
+    async def run(self):
+        """
+        Worker task, owns the VE.Bus (see MultiPlus2.run())
+        """
+        while True:
+            try:
+                if not self.online:
+                    if self.connect_due():
+                        self.connecting = True
+                        await self.try_connect()
+                    if not self.online:
+                        await self.pause(min(max(self.connect_time - time.perf_counter(), 0.1), 1))
+                else:
+                    t = time.perf_counter()
+                    self.bus_credit = 0
+                    await self.read_all(self.pause)
+                    await self.pause(self.update_interval - (time.perf_counter() - t), credit=True)
+                self.check_timeout()
+            except Exception as e:
+                self.log.exception("worker: {}".format(e))
+                await asyncio.sleep(1)
+
+    async def pause(self, duration, credit=False):
+        """
+        Wait for duration, a posted command is sent at once (see MultiPlus2.pause())
+        """
+        tout = time.perf_counter() + duration
+        while True:
+            remaining = tout - time.perf_counter() - (self.bus_credit if credit else 0)
+            try:
+                await asyncio.wait_for(self.wake.wait(), max(remaining, 0))
+            except asyncio.TimeoutError:
+                return
+            self.wake.clear()
+            setpoint_time = self.setpoint_time
+            self.setpoint_time = None
+            skipped = self.power_skipped
+            await self.execute(*self.next_command(self.setpoint))
+            if self.power_skipped > skipped:
+                self.bus_credit += self.set_power_time
+            if setpoint_time is not None:
+                timing.add('mp2.command_latency', time.perf_counter() - setpoint_time)
+            if remaining <= 0:
+                return
+
+
+class AsyncUS2000Poller:
+    """
+    Pylontech polling as coroutine for a US2000 instance created with thread=False
+    """
+
+    def __init__(self, bms):
+        self.bms = bms
+        self.aserial = AsyncSerial(bms.log)
+
+    async def request(self, address, cid2, timeout=0.5):
+        """
+        Send a command to a pack and wait for the response
+
+        :param address: pack address 0, ... or ALL_PACKS
+        :param cid2: command
+        :return: frame in bytes
+        """
+        if self.bms.com is None:
+            raise IOError("serial port not available")
+        if self.aserial.com is not self.bms.com:
+            self.aserial.attach(self.bms.com)
+        self.aserial.reset_input_buffer()
+        self.aserial.write(self.bms.commands.get((address, cid2)) or get_command(address, cid2))
+        rx = await self.aserial.read_until(b'\r', timeout)
+        frame = decode_frame(rx)
+        if frame is None:
+            raise ValueError('receive failed dump={}'.format(rx))
+        return frame
+
+    async def run(self):
+        bms = self.bms
+        while True:
+            kind, delay = bms.poll.next()
+            if delay > 0:
+                await asyncio.sleep(min(delay, bms.pause))  # hint and trigger are checked again
+                continue
+            t = time.perf_counter()
+
+            if bms.com is None:
+                bms.connect()
+            elif kind == 'analog':
+                bms.data['frame_count'] += 1  # count read cycle
+
+            if not (bms.use_bulk() and await self.read_bulk([kind])):
+                await self.read_packs([kind])
+            bms.poll.done(kind, t)
+
+            bms.process_data()
+
+    async def read_packs(self, kinds=('analog', 'alarm')):
+        """
+        Read pack by pack
+
+        :param kinds: 'analog' and/or 'alarm'
+        """
+        bms = self.bms
+        requests = {'analog': (0x42, lambda frame: parse_analog_value(frame, bms.type)),
+                    'alarm': (0x44, parse_alarm_info)}
+        for i in range(bms.pack_number):
+            for kind in kinds:
+                cid2, parse = requests[kind]
+                try:
+                    bms.store(kind, i, parse(await self.request(i, cid2)))
+                except IOError:
+                    bms.com = None
+                    self.aserial.detach()
+                    bms.data[kind][i] = None
+                    bms.log.error("read_{}: io port failed".format(kind))
+                except Exception as e:
+                    bms.store(kind, i, None, e)
+
+                await asyncio.sleep(bms.pause)
+
+    async def read_bulk(self, kinds=('analog', 'alarm')):
+        """
+        Read all packs with one request per command, see US2000.read_bulk()
+
+        :param kinds: 'analog' and/or 'alarm'
+        :return: True if done, False for a fallback to per-pack reads
+        """
+        bms = self.bms
+        requests = {'analog': (0x42, lambda frame, p: parse_analog_block(frame, p, bms.type)),
+                    'alarm': (0x44, parse_alarm_block)}
+        for kind in kinds:
+            cid2, parse = requests[kind]
+            try:
+                frame = await self.request(ALL_PACKS, cid2, bms.bulk_timeout)
+                bms.store_bulk(kind, parse_packs(frame, lambda p: parse(frame, p)))
+            except IOError:
+                bms.com = None
+                self.aserial.detach()
+                bms.data[kind] = [None] * bms.pack_number
+                bms.log.error("read_{}: io port failed".format(kind))
+                return True
+            except Exception as e:
+                bms.set_bulk(False, e)
+                return False
+
+            await asyncio.sleep(bms.pause)
+
+        bms.set_bulk(True)
+        return True
+
+
+class AsyncApiRequest(ApiRequest):
+    """
+    ApiRequest with a coroutine read() based on asyncio streams (HTTP/1.1, JSON)
+    """
+
+    async def read(self, post=None, url_extension=''):
+        t0 = time.perf_counter()
+        valid = False
+        url = self.url + url_extension
+        try:
+            status, content = await asyncio.wait_for(self.http(url, post), self.timeout)
+            if status == 200:
+                data = json.loads(content)
+            else:
+                raise ValueError("status_code={} url={}".format(status, url))
+
+            valid = True
+            self.log.debug("read done in {:.3f}s data: {}".format(time.perf_counter() - t0, data))
+
+        except asyncio.TimeoutError as e:
+            error = "read to {} failed ({:.3f}s)".format(url, time.perf_counter() - t0)
+            self.log.error(error + " error: timeout")
+            data = {'error': error}
+
+        except OSError:
+            error = "connection to {} failed ({:.3f}s)".format(url, time.perf_counter() - t0)
+            self.log.error(error)
+            data = {'error': error}
+
+        except Exception as e:
+            error = "read to {} failed ({:.3f}s)".format(url, time.perf_counter() - t0)
+            self.log.error(error + " error: {}".format(e))
+            data = {'error': error}
+
+        return self.set_data(data, valid, t0)
+
+    async def http(self, url, post=None):
+        """
+        HTTP GET or POST (JSON)
+
+        :return: status, content
+        """
+        u = urlsplit(url)
+        path = (u.path or '/') + ('?' + u.query if u.query else '')
+        body = json.dumps(post).encode() if post is not None else b''
+
+        reader, writer = await asyncio.open_connection(u.hostname, u.port or 80)
+        try:
+            head = "{} {} HTTP/1.1\r\nHost: {}\r\nConnection: close\r\n".format(
+                'GET' if post is None else 'POST', path, u.netloc)
+            if post is not None:
+                head += "Content-Type: application/json\r\nContent-Length: {}\r\n".format(len(body))
+            writer.write(head.encode('latin-1') + b'\r\n' + body)
+            await writer.drain()
+
+            status = int((await reader.readline()).split()[1])
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+
+            if 'content-length' in headers:
+                content = await reader.readexactly(int(headers['content-length']))
+            elif headers.get('transfer-encoding', '').lower() == 'chunked':
+                content = b''
+                while True:
+                    size = int((await reader.readline()).split(b';')[0], 16)
+                    if size == 0:
+                        break
+                    content += await reader.readexactly(size)
+                    await reader.readline()  # \r\n after chunk
+            else:
+                content = await reader.read()
+            return status, content
+        finally:
+            writer.close()
+
+
+class AsyncWSGIServer:
+    """
+    Minimal HTTP server on the event loop for a WSGI application (Bottle). The application (handlers, static files)
+    runs in the default executor (thread pool), a slow request does not stall the device coroutines.
+    """
+
+    def __init__(self, wsgi_app, host='0.0.0.0', port=8080, log='web'):
+        self.wsgi_app = wsgi_app
+        self.host = host
+        self.port = port
+        self.log = logging.getLogger(log)
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+
+    async def handle(self, reader, writer):
+        try:
+            method, target, version = (await reader.readline()).decode('latin-1').split()
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                key, value = line.decode('latin-1').split(':', 1)
+                headers[key.strip().lower()] = value.strip()
+            body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+            path, _, query = target.partition('?')
+            environ = {'REQUEST_METHOD': method,
+                       'SCRIPT_NAME': '',
+                       'PATH_INFO': unquote(path, encoding='latin-1'),
+                       'QUERY_STRING': query,
+                       'SERVER_NAME': self.host,
+                       'SERVER_PORT': str(self.port),
+                       'SERVER_PROTOCOL': version,
+                       'REMOTE_ADDR': writer.get_extra_info('peername', ('', 0))[0],
+                       'CONTENT_TYPE': headers.get('content-type', ''),
+                       'CONTENT_LENGTH': str(len(body)),
+                       'wsgi.version': (1, 0),
+                       'wsgi.url_scheme': 'http',
+                       'wsgi.input': BytesIO(body),
+                       'wsgi.errors': sys.stderr,
+                       'wsgi.multithread': True,
+                       'wsgi.multiprocess': False,
+                       'wsgi.run_once': False}
+            for key, value in headers.items():
+                environ['HTTP_' + key.upper().replace('-', '_')] = value
+
+            status, response_headers, content = await asyncio.get_running_loop().run_in_executor(
+                None, self.call_app, environ)
+            head = "HTTP/1.0 {}\r\n".format(status)
+            head += "".join(["{}: {}\r\n".format(k, v) for k, v in response_headers])
+            writer.write(head.encode('latin-1') + b'Connection: close\r\n\r\n' + content)
+            await writer.drain()
+        except Exception as e:
+            self.log.error("request failed: {}".format(e))
+        finally:
+            writer.close()
+
+    def call_app(self, environ):
+        """
+        Run the WSGI application, called in the executor
+
+        :return: (status, response headers, content)
+        """
+        start = []
+
+        def start_response(status, response_headers, exc_info=None):
+            start[:] = [status, response_headers]
+
+        result = self.wsgi_app(environ, start_response)
+        try:
+            content = b''.join(result)
+        finally:
+            if hasattr(result, 'close'):
+                result.close()
+        return start[0], start[1], content
+
+
+class AsyncRuntime:
+    """
+    Run the application on one asyncio event loop
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.log = logging.getLogger('aio')
+
+    async def run(self):
+        app = self.app
+        server = AsyncWSGIServer(app.web.web, port=config['http_port'])
+        await server.start()
+
+        tasks = [asyncio.create_task(self.cycle())]
+        if getattr(app.multiplus, 'worker', False):
+            tasks.append(asyncio.create_task(app.multiplus.run()))
+        if isinstance(app.bms, US2000) and app.bms.thread is None:
+            tasks.append(asyncio.create_task(AsyncUS2000Poller(app.bms).run()))
+        self.log.info("asyncio runtime started")
+        await asyncio.gather(*tasks)
+
+    async def cycle(self):
+        """
+        Control cycle, same sequence as App.start()
+        """
+        app = self.app
+        meterhub = None
+        while True:
+            app.scheduler.begin()
+
+            # === acquisition: meterhub (HTTP) parallel to multiplus (VE.Bus) =====
+
+            if meterhub is None or meterhub.done():
+                meterhub = asyncio.create_task(
+                    self.measure('acquisition.meterhub', app.meterhub.read(post=app.get_meterhub_post())))
+
+            await app.multiplus.update(pause_time=app.mp2_pause)
+            app.scheduler.mark('multiplus_update')
+
+            await asyncio.wait([meterhub], timeout=max(app.scheduler.t_begin + app.acquisition_deadline -
+                                                       time.perf_counter(), 0))
+            app.scheduler.mark('meterhub')
+
+            # === bms / statemachine =====
+
+            app.bms.update()
+            app.scheduler.mark('bms')
+            app.control()
+            app.scheduler.mark('fsm')
+
+            # === Multiplus =====
+
+            await app.multiplus.command(app.reg_p, app.meterhub.data)
+            app.scheduler.mark('multiplus_command')
+
+            # === Blackbox =====
+
+            app.record()
+            app.scheduler.mark('record')
+
+            await asyncio.sleep(app.scheduler.finish())
+
+    async def measure(self, name, coro):
+        with timing.measure(name):
+            return await coro
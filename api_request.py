@@ -38,8 +38,7 @@ class ApiRequest:
         """
 
         t0 = time.perf_counter()
-        error = None
-        data = None
+        valid = False
         url = ""
         try:
             url = self.url + url_extension
@@ -52,8 +51,7 @@ class ApiRequest:
             else:
                 raise ValueError("status_code={} url={}".format(r.status_code, url))
 
-            self.lifetime_timeout = t0 + self.lifetime if self.lifetime else None  # set new lifetime timeout
-            self.data = data  # update data
+            valid = True
             self.log.debug("read done in {:.3f}s data: {}".format(time.perf_counter() - t0, data))
 
         except requests.ConnectionError:
@@ -66,6 +64,21 @@ class ApiRequest:
             self.log.error(error + " error: {}".format(e))
             data = {'error': error}
 
+        return self.set_data(data, valid, t0)
+
+    def set_data(self, data, valid, t0):
+        """
+        Update self.data with the result of a read. With lifetime an error is set after the lifetime only.
+
+        :param data: dictionary, received data or {'error': ...}
+        :param valid: True for a successful read
+        :param t0: start time of the read (time.perf_counter())
+        :return: data
+        """
+        if valid:
+            self.lifetime_timeout = t0 + self.lifetime if self.lifetime else None  # set new lifetime timeout
+            self.data = data  # update data
+
         if self.lifetime:
             if self.lifetime_timeout and time.perf_counter() > self.lifetime_timeout:
                 self.lifetime_timeout = None  # disable timeout, restart with next valid receive
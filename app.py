@@ -1,15 +1,24 @@
+import asyncio
+import json
 import logging
+import threading
 import time
-from copy import deepcopy
+from collections import namedtuple
 from datetime import datetime
 
 import version
+from acquisition import Acquisition
+from aio import AsyncRuntime, AsyncApiRequest, AsyncMultiPlus2
 from api_request import ApiRequest
+from meter_stream import MeterStream
 from blackbox import Blackbox
 from config import config
 from fsm import FSM
 from multiplus2 import MultiPlus2
+from regulator import Regulator
+from scheduler import CycleScheduler
 from timer import Timer
+from timing import timing
 from trace import Trace
 from bms_us2000 import US2000
 from utils import *
@@ -21,34 +30,101 @@ from bms_dummy import BMS_DUMMY
 ESS Application
 """
 
+# State of one control cycle, built once by App.publish() and shared by trace, blackbox, csv log and web. The instance
+# is replaced every cycle and never modified, readers must not modify state.
+#   seq:    sequence number
+#   time:   time of publishing (time.perf_counter())
+#   state:  dictionary, see App.get_state()
+#   record: state with bms detail as JSON line for the blackbox
+Snapshot = namedtuple('Snapshot', ['seq', 'time', 'state', 'record'])
+
+# Output of the supervisory step for the regulator, used by the fast loop. Replaced, never modified.
+#   mode:       'charge', 'feed' or None (set_p is passed through)
+#   p_min:      lowest setpoint [W]
+#   p_max:      highest setpoint [W]
+#   reserve:    charge or feed reserve power [W]
+#   set_p:      power of the statemachine [W]
+Envelope = namedtuple('Envelope', ['mode', 'p_min', 'p_max', 'reserve', 'set_p'])
+
 
 class App(FSM):
-    def __init__(self):
+    def __init__(self, meterhub=None, bms=None, multiplus=None, blackbox=None, web=True):
+        """
+        Devices are created from config. For replay or simulation they can be passed instead.
+
+        :param meterhub: meterhub instance (ApiRequest)
+        :param bms: BMS instance
+        :param multiplus: MultiPlus2 instance
+        :param blackbox: Blackbox instance
+        :param web: start the web interface
+        """
         super().__init__('init')
         self.www_path = config['www_path']
         self.log = logging.getLogger('app')
-        self.web = AppWeb(self)
+        self.runtime = config.get('runtime', 'thread')  # 'thread' or 'asyncio'
+        threaded = self.runtime != 'asyncio'
+        self.fast_loop = config.get('fast_loop') if threaded else None  # setpoint loop with its own period
+        self.web = AppWeb(self, server=threaded) if web else None
         self.trace = Trace()
         self.config = config
-        self.meterhub = ApiRequest(config['meterhub_address'], timeout=0.5, lifetime=10, log_name='meterhub')
+        if meterhub:
+            self.meterhub = meterhub
+        elif config.get('meterhub_stream') and threaded:
+            self.meterhub = MeterStream(config['meterhub_address'], **config['meterhub_stream'])
+        elif threaded:
+            self.meterhub = ApiRequest(config['meterhub_address'], timeout=0.5, lifetime=10, log_name='meterhub')
+        else:
+            self.meterhub = AsyncApiRequest(config['meterhub_address'], timeout=0.5, lifetime=10, log_name='meterhub')
 
-        if 'bms_us2000' in config:
-            self.bms = US2000(**self.config['bms_us2000'])  # pass config to BMS class
+        if bms:
+            self.bms = bms
+        elif 'bms_us2000' in config:
+            self.bms = US2000(**self.config['bms_us2000'], thread=threaded)  # pass config to BMS class
         elif 'bms_us5000' in config:
-            self.bms = US2000(**self.config['bms_us5000'], type="US5000")  # pass config to BMS class
+            self.bms = US2000(**self.config['bms_us5000'], type="US5000", thread=threaded)  # pass config to BMS class
         # elif 'bms_seplos' in config:
         #     self.bms = SEPLOS(**self.config['bms_seplos'])  # pass config to BMS class
         else:
             self.log.exception("undefined BMS")
             self.bms = None
 
-        self.multiplus = MultiPlus2(config['victron_mk3_port'])
-        self.blackbox = Blackbox(size=config['blackbox_size'],
-                                 path=config['log_path'],
-                                 csv_config=config.get('csv_log', None))
+        # more than one device: the VE.Bus time of a cycle exceeds the period, the worker thread sends the setpoint
+        # first and reads the telemetry in the remaining bus time
+        multi_device = len(config.get('mp2_devices') or ()) > 1
+        if multiplus:
+            self.multiplus = multiplus
+        elif threaded:
+            self.multiplus = MultiPlus2(config['victron_mk3_port'], pipeline=config.get('mp2_pipeline', False),
+                                        thread=config.get('mp2_thread', False) or bool(self.fast_loop) or multi_device,
+                                        update_interval=config.get('mp2_update_interval', 0.5),
+                                        ram_vars=config.get('mp2_ram_vars'), cache_file=config.get('mp2_cache_file'),
+                                        devices=config.get('mp2_devices'), **config.get('mp2_setpoint', {}))
+        else:
+            self.multiplus = AsyncMultiPlus2(config['victron_mk3_port'], pipeline=config.get('mp2_pipeline', False),
+                                             worker=config.get('mp2_thread', False) or multi_device,
+                                             update_interval=config.get('mp2_update_interval', 0.5),
+                                             ram_vars=config.get('mp2_ram_vars'),
+                                             cache_file=config.get('mp2_cache_file'), devices=config.get('mp2_devices'),
+                                             **config.get('mp2_setpoint', {}))
+        self.scheduler = CycleScheduler(**config.get('cycle', {}))
+        self.fast_scheduler = CycleScheduler(name='fast.cycle', log_name='fast', **self.fast_loop) \
+            if self.fast_loop else None
+        self.acquisition = Acquisition()
+        self.acquisition_deadline = config.get('acquisition_deadline', 0.4)  # [s] after cycle start
+        self.mp2_pause = config.get('mp2_pause', 0.075)  # [s] pause between VE.Bus requests
+        self.blackbox = blackbox if blackbox else Blackbox(size=config['blackbox_size'],
+                                                           path=config['log_path'],
+                                                           csv_config=config.get('csv_log', None))
 
         self.mode = 'off'  # Operation mode: 'off', 'auto', 'manual'
         self.set_p = 0  # power set value
+        self.reg_p = 0  # power set value after the regulator, sent to the multiplus
+        self.envelope = Envelope(None, 0, 0, 0, 0)
+        self.bms_data = self.bms.get_snapshot() if self.bms else None  # BMSSnapshot of the supervisory step
+        self.bms_seq = None  # seq of the BMSSnapshot used by the last supervisory step
+        self.bms_fresh = False  # new BMS sweep in this supervisory step, BMS driven transitions only with new data
+        self.feed_max_p = 0  # actual feed limit (soc, throttle)
+        self.regulator = Regulator(**config.get('regulator', {}))
         self.setting = 0  # 0, 1, ... Index to usersettings from config/ui
 
         self.ui_command = None  # commands from UI sent with polling, manual commands
@@ -66,6 +142,8 @@ class App(FSM):
         self.feed_throttle_timer = Timer()
         self.state_timer = Timer()
 
+        self.snapshot = None
+        self.publish()  # initial snapshot (seq=0)
 
     def get_setting(self, name):
         """
@@ -82,66 +160,273 @@ class App(FSM):
         """
         Application mainloop
         """
-        self.log.info('start ess {}'.format(version.__version__))
+        self.log.info('start ess {} ({})'.format(version.__version__, self.runtime))
+
+        if self.runtime == 'asyncio':
+            asyncio.run(AsyncRuntime(self).run())
+            return
+        if self.fast_loop:
+            self.run_split()
+            return
+        if isinstance(self.meterhub, MeterStream):
+            self.run_push()
+            return
 
         while True:
-            t_begin = time.perf_counter()  # cycle start time
+            self.scheduler.begin()  # cycle start time
 
-            # === meterhub ===================================================   ~ 15ms
+            # === acquisition: meterhub (HTTP, worker thread) parallel to multiplus (VE.Bus) =====
 
-            self.meterhub.read(
-                post={'bat_info': self.get_info_text(), 'bat_soc': self.bms.soc})
+            self.acquisition.start('meterhub', self.meterhub.read, post=self.get_meterhub_post())  # ~ 15ms
+
+            self.multiplus.update(pause_time=self.mp2_pause)
+            self.log.debug("multiplus {}".format(self.multiplus.data))
+            self.scheduler.mark('multiplus_update')
+
+            self.acquisition.join(self.scheduler.t_begin + self.acquisition_deadline)  # old data if not in time
             self.log.debug("meterhub {}".format(self.meterhub.data))
+            self.scheduler.mark('meterhub')
 
             # === bms ===================================================   ~ 0ms (Thread)
 
             self.bms.update()
             self.log.debug("bms {}".format(self.bms.get_state()))
+            self.scheduler.mark('bms')
 
             # ================================================================
 
-            if self._fsm_state not in ('error', 'init'):
-                self.fsm_switch()
-            self.update_in()
-            self.run_fsm()
-            self.trace.push(deepcopy(self.get_state()))
+            self.control()
+            self.scheduler.mark('fsm')
 
             # === Multiplus ===================================================
 
-            self.multiplus.command(self.set_p)
-            time.sleep(0.075)
-            self.multiplus.update(pause_time=0.075)
-            self.log.debug("multiplus {}".format(self.multiplus.data))
+            self.multiplus.command(self.reg_p, self.meterhub.data)  # gap to the next update is given by the cycle wait
+            self.scheduler.mark('multiplus_command')
 
-            # === Blackbox ===================================================
+            # === Trace / Blackbox ============================================
 
-            self.blackbox.push(self.get_state(bms_detail=True))
+            self.record()
+            self.scheduler.mark('record')
 
             # ================================================================
 
-            t_end = time.perf_counter()
-            while time.perf_counter() < t_begin + 0.75:
-                time.sleep(0.01)
+            self.scheduler.wait()  # sleep until next cycle
+
+    def run_push(self):
+        """
+        Mainloop with meter data pushed by the meterhub (MeterStream). A new sample starts the cycle, the setpoint is
+        sent first and the multiplus is read afterwards for the next cycle. Without samples the cycle runs with the
+        period.
+        """
+        while True:
+            self.scheduler.begin()
+
+            self.acquisition.start('meterhub', self.meterhub.send, self.get_meterhub_post())  # reduced rate
+            self.meterhub.read()  # lifetime
+            self.bms.update()
+            self.scheduler.mark('bms')
+
+            rx_time = self.meterhub.rx_time
+            self.control()
+            self.scheduler.mark('fsm')
+
+            self.multiplus.command(self.reg_p, self.meterhub.data)
+            self.scheduler.mark('multiplus_command')
+            if rx_time is not None:
+                timing.add('meter_to_setpoint', time.perf_counter() - rx_time)
+
+            self.multiplus.update(pause_time=self.mp2_pause)
+            self.scheduler.mark('multiplus_update')
+
+            self.acquisition.join(time.perf_counter())  # no wait, send() is finished in a later cycle
+            self.record()
+            self.scheduler.mark('record')
+
+            self.scheduler.wait(self.meterhub.event)  # sleep until next sample or period
+
+    def run_split(self):
+        """
+        Mainloop with two loops. The fast loop (thread) reads the meter and sends the setpoint within the envelope
+        given by the supervisory loop. The supervisory loop (cycle period) runs the safety checks, BMS, statemachine,
+        trace and blackbox. The multiplus is served by its worker thread, update() and command() do not block.
+        """
+        threading.Thread(target=self.run_fast, daemon=True).start()
+        while True:
+            self.scheduler.begin()
+
+            if isinstance(self.meterhub, MeterStream):
+                self.acquisition.start('meterhub', self.meterhub.send, self.get_meterhub_post())  # reduced rate
+            else:
+                self.acquisition.start('meterhub', self.meterhub.read, post=self.get_meterhub_post())
+            self.multiplus.update(pause_time=self.mp2_pause)
+            self.scheduler.mark('multiplus_update')
+
+            self.bms.update()
+            self.scheduler.mark('bms')
+
+            self.supervise()
+            self.scheduler.mark('fsm')
+
+            self.acquisition.join(time.perf_counter())  # no wait, the post is finished in a later cycle
+            self.record()
+            self.scheduler.mark('record')
+
+            self.scheduler.wait()
 
-            # typical ~ 680ms (synced to 750ms)
+    def run_fast(self):
+        """
+        Fast setpoint loop: meter, regulator and multiplus command. With MeterStream a new sample starts the cycle.
+        """
+        scheduler = self.fast_scheduler
+        event = self.meterhub.event if isinstance(self.meterhub, MeterStream) else None
+        while True:
+            scheduler.begin()
+            try:
+                meter = dict(self.meterhub.read() or {})  # MeterStream: lifetime check only
+                rx_time = getattr(self.meterhub, 'rx_time', None)
+                scheduler.mark('fast.meterhub')
+
+                self.regulate(meter)  # the attributes of the supervisory step are not written
+                scheduler.mark('fast.regulate')
+
+                self.multiplus.command(self.reg_p, meter)
+                scheduler.mark('fast.command')
+                if rx_time is not None:
+                    timing.add('meter_to_setpoint', time.perf_counter() - rx_time)
+            except Exception as e:
+                self.log.exception("fast loop: {}".format(e))
+            scheduler.wait(event)
+
+    def control(self):
+        """
+        Control step: supervisory step and regulator
+        """
+        self.supervise()
+        self.regulate()
 
-            # print("loop {:.3f}s/{:.3f}s ".format(t_end - t_begin, time.perf_counter() - t_begin))
+    def supervise(self):
+        """
+        Supervisory step: safety checks, incoming data, statemachine and the envelope of the regulator
+        """
+        self.bms_data = self.bms.get_snapshot()  # one BMS sweep for the whole step
+        self.bms_fresh = self.bms_data.seq != self.bms_seq
+        self.bms_seq = self.bms_data.seq
+        if self._fsm_state not in ('error', 'init'):
+            self.fsm_switch()
+        self.update_in()
+        self.run_fsm()
+        self.envelope = self.get_envelope()
+        self.bms.set_poll_hint(self.get_poll_hint())
+
+    def get_envelope(self):
+        """
+        :return: limits of the regulator for the actual state (Envelope)
+        """
+        if self._fsm_state == 'auto_charge':
+            return Envelope('charge', 0, self.get_setting('charge_max_power'), self.get_setting('charge_reserve_power'),
+                            self.set_p)
+        elif self._fsm_state == 'auto_feed':
+            return Envelope('feed', -self.feed_max_p, 0, self.get_setting('feed_reserve_power'), self.set_p)
+        return Envelope(None, 0, 0, 0, self.set_p)
+
+    def get_poll_hint(self):
+        """
+        :return: hint for the BMS poll rate, 'fast' near the end of charge or feed, 'slow' while the system sleeps
+        """
+        bms = self.bms_data
+        soc_margin = self.config.get('bms_fast_soc', 5)
+        u_margin = self.config.get('bms_fast_voltage', 0.5)
+        if self._fsm_state == 'auto_charge':
+            if (bms.soc_high is not None and bms.soc_high >= self.get_setting('charge_end_soc') - soc_margin) or (
+                    bms.voltage is not None and bms.voltage >= self.get_setting('charge_end_voltage') - u_margin):
+                return 'fast'
+        elif self._fsm_state == 'auto_feed':
+            if (bms.soc_low is not None and bms.soc_low <= self.get_setting('feed_end_soc') + soc_margin) or (
+                    bms.voltage is not None and bms.voltage <= self.get_setting('feed_end_voltage') + u_margin):
+                return 'fast'
+        elif self._fsm_state == 'off':
+            return 'slow'
+        elif self._fsm_state == 'auto_idle':
+            mp2 = self.multiplus.data  # None or only the version while the multiplus (re)connects
+            if mp2 is not None and mp2.get('state') == 'sleep':
+                return 'slow'
+        return 'normal'
+
+    def regulate(self, meter=None):
+        """
+        Regulator between statemachine (set_p) and multiplus (reg_p), only active in charge and feed
+
+        :param meter: meter data of the fast loop, the target is calculated from it within the envelope, else set_p
+        """
+        env = self.envelope  # one reference, consistent with set_p
+        target = env.set_p
+        grid_p = self.grid_p
+        if meter is not None:
+            grid_p, car_p, pv_p, home_all_p, home_p = self.get_meter_values(meter)
+            if env.mode and None not in (pv_p, home_all_p, home_p):
+                if env.mode == 'charge':
+                    target = limit(pv_p - home_all_p - env.reserve, env.p_min, env.p_max)
+                else:
+                    target = -limit(home_p - pv_p - env.reserve, -env.p_max, -env.p_min)
+
+        if env.mode == 'charge':
+            self.reg_p = self.regulator.update(target, grid_p, -env.reserve, env.p_min, env.p_max)
+        elif env.mode == 'feed':
+            self.reg_p = self.regulator.update(target, grid_p, env.reserve, env.p_min, env.p_max)
+        else:
+            self.reg_p = self.regulator.update(target, active=False)
+
+    def record(self):
+        """
+        Publish the snapshot of the cycle and record it to trace and blackbox
+        """
+        with timing.measure('snapshot'):
+            self.publish()
+        with timing.measure('trace'):
+            self.trace.push(self.snapshot.state)
+        with timing.measure('blackbox'):
+            self.blackbox.push(self.snapshot.state, line=self.snapshot.record)
+
+    def publish(self):
+        """
+        Build the snapshot of the actual cycle and replace self.snapshot
+        """
+        seq = self.snapshot.seq + 1 if self.snapshot else 0
+        state = self.get_state()
+        state['ess']['seq'] = seq
+        detail = dict(state)
+        detail['bms_detail'] = self.bms.get_detail()
+        self.snapshot = Snapshot(seq, time.perf_counter(), state, json.dumps(detail) + '\n')
+
+    def get_meterhub_post(self):
+        """
+        Battery information sent to the meterhub, taken from the last snapshot
+
+        :return: dictionary
+        """
+        return {'bat_info': self.snapshot.state['ess']['info'], 'bat_soc': self.snapshot.state['bms']['soc']}
 
     def update_in(self):
         """
         Acquire all incoming data
         """
-        self.grid_p = dictget(self.meterhub.data, 'grid_p')
-        self.car_p = dictget(self.meterhub.data, 'car_p')
-        self.pv_p = dictget(self.meterhub.data, 'pv_p')
-        self.home_all_p = dictget(self.meterhub.data, 'home_all_p')
+        self.grid_p, self.car_p, self.pv_p, self.home_all_p, self.home_p = self.get_meter_values(self.meterhub.data)
 
-        # if self.home_all_p and self.car_p:
-        #     self.home_p = self.home_all_p - self.car_p
-        if self.home_all_p:
-            self.home_p = self.home_all_p
-        else:
-            self.home_p = None
+    @staticmethod
+    def get_meter_values(meter):
+        """
+        :param meter: meterhub data
+        :return: (grid_p, car_p, pv_p, home_all_p, home_p)
+        """
+        grid_p = dictget(meter, 'grid_p')
+        car_p = dictget(meter, 'car_p')
+        pv_p = dictget(meter, 'pv_p')
+        home_all_p = dictget(meter, 'home_all_p')
+
+        # if home_all_p and car_p:
+        #     home_p = home_all_p - car_p
+        home_p = home_all_p if home_all_p else None
+        return grid_p, car_p, pv_p, home_all_p, home_p
 
 
 
@@ -149,16 +434,16 @@ class App(FSM):
         """
         Auto state change by events
         """
-        if self.bms.voltage and self.bms.voltage > self.config['udc_max']:
+        if self.bms_data.voltage and self.bms_data.voltage > self.config['udc_max']:
             self.log.error("error max voltage at bms {}".format(self.bms.get_state()))
             self.set_fsm_state('error')
-        elif self.bms.temperature and self.bms.temperature > self.config['t_max']:
+        elif self.bms_data.temperature and self.bms_data.temperature > self.config['t_max']:
             self.log.error("error max bms temperature {}".format(self.bms.get_state()))
             self.set_fsm_state('error')
         elif not self.is_meterhub_ready():
             self.log.error("meterhub error {}".format(self.meterhub.data))
             self.set_fsm_state('error')
-        elif self.bms.error:
+        elif self.bms_data.error:
             self.log.error("bms error {}".format(self.bms.get_state()))
             self.set_fsm_state('error')
         elif not self.is_multiplus_ready():
@@ -183,13 +468,13 @@ class App(FSM):
         except:
             p = 0
 
-        if p < self.get_setting('charge_min_power') or self.bms.soc_high is None or self.bms.soc_high > (
+        if p < self.get_setting('charge_min_power') or self.bms_data.soc_high is None or self.bms_data.soc_high > (
                 self.get_setting('charge_end_soc') - self.get_setting('charge_hysteresis_soc')):
             self.charge_start_timer.stop()
         else:
             if self.charge_start_timer.is_stop():
                 self.charge_start_timer.start(self.get_setting('charge_start_time'))
-            elif self.charge_start_timer.is_expired():
+            elif self.charge_start_timer.is_expired() and self.bms_fresh:  # confirmed by a new BMS sweep
                 # self.charge_start_timer.stop()
                 return True
         return False
@@ -206,13 +491,13 @@ class App(FSM):
         except:
             p = 0
 
-        if p < self.get_setting('feed_min_power') or self.bms.soc_low is None or self.bms.soc_low < (
+        if p < self.get_setting('feed_min_power') or self.bms_data.soc_low is None or self.bms_data.soc_low < (
                 self.get_setting('feed_end_soc') + self.get_setting('feed_hysteresis_soc')):
             self.feed_start_timer.stop()
         else:
             if self.feed_start_timer.is_stop():
                 self.feed_start_timer.start(self.get_setting('feed_start_time'))
-            elif self.feed_start_timer.is_expired():
+            elif self.feed_start_timer.is_expired() and self.bms_fresh:  # confirmed by a new BMS sweep
                 # self.feed_start_timer.stop()
                 return True
         return False
@@ -232,13 +517,13 @@ class App(FSM):
             self.set_p = 0
             self.state_timer.start(10)
 
-        if self.is_meterhub_ready() and not self.bms.error and self.is_multiplus_ready():
+        if self.is_meterhub_ready() and not self.bms_data.error and self.is_multiplus_ready():
             self.fsm_switch()
 
         if self.state_timer.is_expired():
             if not self.is_meterhub_ready():
                 self.log.error("meterhub error {}".format(self.meterhub.data))
-            if self.bms.error():
+            if self.bms_data.error:
                 self.log.error("bms error {}".format(self.bms.get_state()))
             if not self.is_multiplus_ready():
                 self.log.error("multiplus error={}".format(self.multiplus.data))
@@ -303,13 +588,14 @@ class App(FSM):
             p = self.pv_p - self.home_all_p - self.get_setting('charge_reserve_power')
 
             # print("p={} pv={} home_all={} home={} car={}".format(p, self.pv_p, self.home_all_p, self.home_p, self.car_p) )
-            # ToDo Filter     schnell runter, langsam hoch
+            # filter (fast down, slow up) in regulate()
 
             charge_set_p = limit(p, 0, self.get_setting('charge_max_power'))  # limit to 0..max
-            if self.bms.soc_high and self.bms.soc_high >= self.get_setting('charge_end_soc'):  # end by SOC
+            bms = self.bms_data  # end by SOC or UDC only with a new BMS sweep
+            if self.bms_fresh and bms.soc_high and bms.soc_high >= self.get_setting('charge_end_soc'):  # end by SOC
                 self.log.info("charge end by soc (config.charge_end_soc)")
                 self.set_fsm_state('auto_idle')
-            elif self.bms.voltage and self.bms.voltage >= self.get_setting('charge_end_voltage'):  # end by UDC
+            elif self.bms_fresh and bms.voltage and bms.voltage >= self.get_setting('charge_end_voltage'):  # by UDC
                 self.log.info("charge end by voltage (config.charge_end_voltage)")
                 self.set_fsm_state('auto_idle')
             else:
@@ -339,7 +625,7 @@ class App(FSM):
         try:
             p = self.home_p - self.pv_p - self.get_setting('feed_reserve_power')
 
-            if self.bms.soc_low and self.bms.soc_low <= 25:
+            if self.bms_data.soc_low and self.bms_data.soc_low <= 25:
                 max_p = self.get_setting('feed_soc25_max_power')
             else:
                 max_p = self.get_setting('feed_max_power')
@@ -367,12 +653,14 @@ class App(FSM):
                     self.log.info("feed throttle disabled")
 
                 feed_set_p = limit(p, 0, self.get_setting('feed_throttle_power'))
+            self.feed_max_p = self.get_setting('feed_throttle_power') if self.feed_throttle else max_p
             # --------------------------------------------------------------------------------
 
-            if self.bms.soc_low and self.bms.soc_low <= self.get_setting('feed_end_soc'):  # end by SOC
+            bms = self.bms_data  # end by SOC or UDC only with a new BMS sweep
+            if self.bms_fresh and bms.soc_low and bms.soc_low <= self.get_setting('feed_end_soc'):  # end by SOC
                 self.log.info("feed end by soc (config.feed_end_soc)")
                 self.set_fsm_state('auto_idle')
-            elif self.bms.voltage and self.bms.voltage <= self.get_setting('feed_end_voltage'):  # end by UDC
+            elif self.bms_fresh and bms.voltage and bms.voltage <= self.get_setting('feed_end_voltage'):  # end by UDC
                 self.log.info("feed end by voltage (config.feed_end_voltage)")
                 self.set_fsm_state('auto_idle')
             else:
@@ -434,6 +722,7 @@ class App(FSM):
                 'mode': self.mode,
                 'state': self._fsm_state,
                 'set_p': self.set_p,
+                'reg_p': self.reg_p,
                 'time': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                 'setting': self.setting,
                 'info': self.get_info_text()
@@ -441,6 +730,7 @@ class App(FSM):
             'meterhub': self.meterhub.data,
             'bms': self.bms.get_state(),
             'multiplus': self.multiplus.data,
+            'regulator': self.regulator.get_state(),
         }
         if bms_detail:
             d['bms_detail'] = self.bms.get_detail()
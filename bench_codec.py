@@ -0,0 +1,148 @@
+import argparse
+import json
+import logging
+import platform
+import struct
+import sys
+import timeit
+import tracemalloc
+
+from pylontech import encode_cmd, get_command, decode_frame, get_frame_checksum, parse_analog_value, parse_alarm_info
+from vebus import VEBus
+
+"""
+Micro-benchmark for the protocol codecs (VE.Bus and Pylontech)
+
+Recorded frames (see docstrings in vebus.py and pylontech.py) are fed through the byte level functions. For every
+case ops/s and the peak of temporary memory per call are measured.
+
+    python3 bench_codec.py                                      # print results
+    python3 bench_codec.py --save development/bench_codec.json  # save as baseline
+    python3 bench_codec.py --compare development/bench_codec.json
+"""
+
+# === recorded frames ===
+
+VEBUS_SNAPSHOT = bytes.fromhex('0D FF 58 99 89 FE 05 00 72 01 1C 13 64 00 71'.replace(' ', ''))
+VEBUS_AC_INFO = bytes.fromhex('0F 20 01 01 01 09 08 EC 5A 5F FF EC 5A 08 00 C3 08'.replace(' ', ''))
+VEBUS_SET_POWER_DATA = struct.pack("<BBBh", 0x37, 0x00, 131, -370)
+
+US2000_ANALOG = b'~20024600C06E10020F0C9A0C980C990C980C9A0C9A0C990C9B0C9C0C9A0C9B0C9B0C9B0C9B0C99050B740B550B570B530B630000BD06190F02C3500084E545\r'
+US3000_ANALOG = b'~20024600F07A00020F0CC90CC90CC80CC90CC80CC80CC80CC90CC90CC90CC80CC90CC90CC80CC8050BA10B8A0B870B840B910000BFC0FFFF04FFFF0000007968012110E211\r'
+US2000_ALARM = b'~20024600A04210020F000000000000000000000000000000050000000000000000000E00000000F108\r'
+
+
+class RecordedSerial:
+    """
+    pyserial replacement, read() returns the recorded bytes once
+    """
+
+    def __init__(self, data=b''):
+        self.data = data
+
+    @property
+    def in_waiting(self):
+        return len(self.data)
+
+    def read(self, size=1):
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        pass
+
+
+def make_vebus():
+    logging.getLogger('bench.vebus').setLevel(logging.CRITICAL)  # no port
+    vebus = VEBus(port=None, log='bench.vebus')
+    vebus.serial = RecordedSerial()
+    return vebus
+
+
+def make_cases():
+    vebus = make_vebus()
+
+    def receive_frame():
+        vebus.serial.data = b'\x00\x55' + VEBUS_SNAPSHOT  # with leading noise
+        return vebus.receive_frame(b'\x0D\xFF\x58')
+
+    analog = decode_frame(US2000_ANALOG)
+    analog_us3000 = decode_frame(US3000_ANALOG)
+    alarm = decode_frame(US2000_ALARM)
+    inner = US2000_ANALOG[1:-5]
+
+    return {
+        'vebus.build_frame': lambda: vebus.build_frame('X', [0x38]),
+        'vebus.build_frame_set_power': lambda: vebus.build_frame('X', VEBUS_SET_POWER_DATA),
+        'vebus.receive_frame': receive_frame,
+        'vebus.parse_snapshot': lambda: vebus.parse_snapshot(VEBUS_SNAPSHOT),
+        'vebus.parse_ac_info': lambda: vebus.parse_ac_info(VEBUS_AC_INFO),
+        'pylontech.encode_cmd': lambda: encode_cmd(2, 0x42, b'02'),
+        'pylontech.get_command': lambda: get_command(0, 0x42),
+        'pylontech.get_frame_checksum': lambda: get_frame_checksum(inner),
+        'pylontech.decode_frame': lambda: decode_frame(US2000_ANALOG),
+        'pylontech.parse_analog_value': lambda: parse_analog_value(analog, 'US2000'),
+        'pylontech.parse_analog_value_us3000': lambda: parse_analog_value(analog_us3000, 'US3000'),
+        'pylontech.parse_alarm_info': lambda: parse_alarm_info(alarm),
+    }
+
+
+def measure(func, min_time=0.2):
+    """
+    :param func: function without parameter
+    :param min_time: minimum measuring time in seconds
+    :return: dictionary with ops/s and peak of temporary memory per call in bytes
+    """
+    timer = timeit.Timer(func)
+    number, t = timer.autorange()
+    while t < min_time:
+        number *= 2
+        t = timer.timeit(number)
+    ops = number / t
+
+    func()  # warm up (caches)
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    func()
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return {'ops': round(ops), 'us': round(1e6 / ops, 3), 'alloc_peak': peak}
+
+
+def run(filter=None, min_time=0.2):
+    results = {}
+    for name, func in make_cases().items():
+        if filter and filter not in name:
+            continue
+        results[name] = measure(func, min_time)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Protocol codec micro-benchmark")
+    parser.add_argument('--save', help="save results as JSON baseline")
+    parser.add_argument('--compare', help="compare with JSON baseline")
+    parser.add_argument('--filter', help="run only cases containing this text")
+    parser.add_argument('--time', type=float, default=0.2, help="minimum measuring time per case in seconds")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        baseline = json.load(open(args.compare))['results']
+
+    results = run(args.filter, args.time)
+
+    print("{:40} {:>12} {:>10} {:>10} {:>9}".format('case', 'ops/s', 'us/op', 'alloc [B]', 'speedup'))
+    for name, r in results.items():
+        speedup = ''
+        if baseline and name in baseline:
+            speedup = "{:.2f}x".format(r['ops'] / baseline[name]['ops'])
+        print("{:40} {:>12} {:>10} {:>10} {:>9}".format(name, r['ops'], r['us'], r['alloc_peak'], speedup))
+
+    if args.save:
+        json.dump({'python': sys.version.split()[0],
+                   'machine': platform.machine(),
+                   'results': results}, open(args.save, 'w'), indent=2)
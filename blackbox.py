@@ -24,15 +24,18 @@ class Blackbox:
 
         self.csv_config = csv_config
         self.csv_interval_time = None
+        self.csv_day = None  # date of csv_filename
+        self.csv_filename = None
 
 
 
-    def push(self, dataset):
+    def push(self, dataset, line=None):
         """
         Convert dataset to JSON, append \n and append to FIFO list. Limit the size to maximum.
         :param dataset: dictionary
+        :param line: optional, dataset already converted to a JSON line
         """
-        self.record_lines.append(json.dumps(dataset) + '\n')
+        self.record_lines.append(line if line is not None else json.dumps(dataset) + '\n')
         self.record_lines = self.record_lines[-self.size:]  # limit to latest
 
         if self.csv_config:
@@ -52,6 +55,35 @@ class Blackbox:
 
 
 
+    def get_csv_header(self):
+        return ";".join([col[0] for col in self.csv_config['columns']])
+
+    def get_csv_filename(self):
+        """
+        Daily CSV file, YYYY-MM-DD.csv. If the file has another header (changed columns), the rows are written to
+        YYYY-MM-DD-1.csv, YYYY-MM-DD-2.csv, ...
+
+        :return: filename
+        """
+        day = datetime.now().strftime("%Y-%m-%d")
+        if day != self.csv_day:
+            self.csv_day = day
+            header = self.get_csv_header()
+            n = 0
+            while True:
+                filename = day + ('-{}'.format(n) if n else '') + '.csv'
+                try:
+                    with open(os.path.join(self.path, filename)) as f:
+                        if f.readline().rstrip('\n') == header:
+                            break
+                except FileNotFoundError:
+                    break
+                n += 1
+            if n:
+                self.log.info("csv header changed, use {}".format(filename))
+            self.csv_filename = filename
+        return self.csv_filename
+
     def csv_push(self, dataset):
         t = int(datetime.now().timestamp() / self.csv_config['interval'])
 
@@ -60,9 +92,9 @@ class Blackbox:
         elif self.csv_interval_time != t:
             self.csv_interval_time = t
             # print('minute')
-            filename = datetime.now().strftime("%Y-%m-%d.csv")
+            filename = self.get_csv_filename()
             if not os.path.isfile(os.path.join(self.path, filename)):
-                open(os.path.join(self.path, filename), 'a').write(";".join([col[0] for col in self.csv_config['columns']]) + '\n')
+                open(os.path.join(self.path, filename), 'a').write(self.get_csv_header() + '\n')
 
             row = []
             for col in self.csv_config['columns']:
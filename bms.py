@@ -1,48 +1,119 @@
+import asyncio
+import threading
+import time
 from abc import ABC, abstractmethod
+from collections import namedtuple
 
 """
 Interface class description of the BMS interface
+
+The values of a read sweep are published as one immutable BMSSnapshot with sequence number and time
+(time.perf_counter()). The snapshot is replaced as a whole, a reader never gets a mix of two sweeps. Take it once
+per cycle with get_snapshot() and compare seq with the last used snapshot, or wait for new data with
+wait_for_update(). wait_for_update() blocks, it is for the thread runtime only and refused on an event loop.
 """
 
+# voltage [V], current [A], temperature [°C], soc [%], soc_low/soc_high: lowest/highest soc of the packs,
+# error: None or string in case of an error, pack_*: tuples with one value per pack (optional)
+BMSSnapshot = namedtuple('BMSSnapshot', ['seq', 'time', 'error', 'voltage', 'current', 'temperature', 'soc',
+                                         'soc_low', 'soc_high', 'pack_u', 'pack_i', 'pack_t', 'pack_soc',
+                                         'pack_cycle'],
+                         defaults=(None,) * 7 + ((),) * 5)
+
 
 class BMS(ABC):
 
     def __init__(self):
-        self._error = None  # None or string in case of an error
-        self._voltage = None  # voltage [V]
-        self._current = None  # current [A]
-        self._temperature = None  # temperature [°C]
-        self._soc = None  # State of charge [%]
-        self._soc_low = None  # lowest soc with multiple packs (set to soc for single pack)
-        self._soc_high = None  # highest soc with multiple packs (set to soc for single pack)
+        self.snapshot = BMSSnapshot(0, None)
+        self.condition = threading.Condition()
+
+    def publish(self, **values):
+        """
+        Publish the values of a sweep as new snapshot
+
+        :param values: fields of BMSSnapshot without seq and time, missing fields are None
+        :return: BMSSnapshot
+        """
+        with self.condition:
+            self.snapshot = BMSSnapshot(self.snapshot.seq + 1, time.perf_counter(), **values)
+            self.condition.notify_all()
+        return self.snapshot
+
+    def get_snapshot(self):
+        """
+        :return: latest BMSSnapshot
+        """
+        return self.snapshot
+
+    def wait_for_update(self, timeout=None, seq=None):
+        """
+        Wait for a snapshot newer than seq, thread runtime only (blocks)
+
+        :param timeout: timeout in seconds, None: no timeout
+        :param seq: sequence number of the last used snapshot, default: the latest
+        :return: BMSSnapshot or None on timeout
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass  # no event loop in this thread
+        else:
+            raise RuntimeError("wait_for_update() would block the event loop")
+        with self.condition:
+            if seq is None:
+                seq = self.snapshot.seq
+            if self.condition.wait_for(lambda: self.snapshot.seq > seq, timeout):
+                return self.snapshot
+        return None
+
+    def get_snapshot_state(self, snapshot=None):
+        """
+        :param snapshot: BMSSnapshot, default: the latest
+        :return: dictionary with the keys of get_state()
+        """
+        s = snapshot if snapshot else self.snapshot
+        return {'error': s.error,
+                'u': s.voltage,
+                'i': s.current,
+                't': s.temperature,
+                'soc': s.soc,
+                'soc_low': s.soc_low,
+                'soc_high': s.soc_high,
+                'pack_u': list(s.pack_u),
+                'pack_i': list(s.pack_i),
+                'pack_t': list(s.pack_t),
+                'pack_soc': list(s.pack_soc),
+                'pack_cycle': list(s.pack_cycle),
+                'seq': s.seq,
+                'age': round(time.perf_counter() - s.time, 3) if s.time is not None else None}
 
     @property
     def voltage(self):
-        return self._voltage
+        return self.snapshot.voltage
 
     @property
     def current(self):
-        return self._current
+        return self.snapshot.current
 
     @property
     def temperature(self):
-        return self._temperature
+        return self.snapshot.temperature
 
     @property
     def soc(self):
-        return self._soc
+        return self.snapshot.soc
 
     @property
     def soc_low(self):
-        return self._soc_low
+        return self.snapshot.soc_low
 
     @property
     def soc_high(self):
-        return self._soc_high
+        return self.snapshot.soc_high
 
     @property
     def error(self):
-        return self._error
+        return self.snapshot.error
 
     @abstractmethod
     def update(self):
@@ -52,6 +123,14 @@ class BMS(ABC):
         """
         pass
 
+    def set_poll_hint(self, hint):
+        """
+        Hint of the application for the poll rate, optional
+
+        :param hint: 'fast' (charge or feed near the end), 'normal' or 'slow' (system sleeps)
+        """
+        pass
+
     @abstractmethod
     def get_state(self):
         """
@@ -1,15 +1,112 @@
-from bms import BMS
+from bms import BMS, BMSSnapshot
+from cell_history import CellHistory
 import logging
 import time
 from datetime import datetime
-from threading import Thread
-from pylontech import read_analog_value, read_alarm_info
+from threading import Thread, Event
+from pylontech import read_analog_value, read_alarm_info, read_analog_values, read_alarm_infos, make_commands
+from timing import timing
 import serial  # pip install pyserial
 
+# limits of the analog values, an anomaly starts an alarm info read
+ANOMALY = {'cell_spread': 100,  # [mV] highest - lowest cell
+           'u_cell_min': 2900,  # [mV]
+           'u_cell_max': 3550,  # [mV]
+           't_max': 45}  # [°C]
+
+# default poll intervals [s] per command and hint (see PollScheduler)
+POLL_INTERVALS = {'analog': {'fast': 0.5, 'normal': 1.0, 'slow': 5.0},
+                  'alarm': {'fast': 5.0, 'normal': 5.0, 'slow': 10.0}}
+
+
+class PollScheduler:
+    """
+    Due times of the BMS requests, one interval per command and poll hint
+
+        'fast'      charge or feed near the end by soc or voltage
+        'normal'
+        'slow'      system sleeps
+
+    The alarm info is read with a background interval and at once after an anomaly of the analog values (trigger).
+    The requests are separated by the pause of the poller.
+    """
+
+    def __init__(self, intervals=None, max_interval=None):
+        """
+        :param intervals: dictionary {'analog': {'fast': 0.5, ...}, 'alarm': {...}}, merged with POLL_INTERVALS
+        :param max_interval: upper limit of all intervals (data lifetime)
+        """
+        intervals = intervals or {}
+        self.intervals = {kind: dict(POLL_INTERVALS[kind], **intervals.get(kind, {})) for kind in POLL_INTERVALS}
+        self.max_interval = max_interval
+        self.hint = 'normal'
+        self.due = {kind: 0 for kind in self.intervals}  # time.perf_counter()
+        self.last = {kind: None for kind in self.intervals}
+        self.triggers = 0
+        self.event = Event()  # set on a change of the due times
+
+    def get_interval(self, kind):
+        interval = self.intervals[kind][self.hint]
+        return min(interval, self.max_interval) if self.max_interval else interval
+
+    def set_hint(self, hint):
+        """
+        :param hint: 'fast', 'normal' or 'slow'
+        """
+        if hint == self.hint or hint not in self.intervals['analog']:
+            return
+        self.hint = hint
+        for kind, last in self.last.items():
+            if last is not None:
+                self.due[kind] = last + self.get_interval(kind)
+        self.event.set()
+
+    def trigger(self, kind):
+        """
+        Read at once
+        """
+        self.due[kind] = 0
+        self.triggers += 1
+        self.event.set()
+
+    def next(self):
+        """
+        :return: (kind, delay) of the next request, delay <= 0 if due
+        """
+        kind = min(self.due, key=self.due.get)
+        return kind, self.due[kind] - time.perf_counter()
+
+    def wait(self, delay):
+        """
+        Wait for the next request or a change of the due times (thread)
+        """
+        self.event.wait(delay)
+        self.event.clear()
+
+    def done(self, kind, t):
+        """
+        :param kind: 'analog' or 'alarm'
+        :param t: start time of the request, the interval is counted from here
+        """
+        if self.last[kind] is not None:
+            timing.add('bms.' + kind, t - self.last[kind])  # achieved interval
+        self.last[kind] = t
+        self.due[kind] = t + self.get_interval(kind)
+
+    def get_state(self):
+        """
+        :return: dictionary
+        """
+        return {'hint': self.hint,
+                'interval': {kind: self.get_interval(kind) for kind in self.intervals},
+                'triggers': self.triggers}
+
 
 class US2000(BMS):
 
-    def __init__(self, port=None, baudrate=115200, pack_number=1, lifetime=20, log_name='us2000', pause=0.25, type='US2000'):
+    def __init__(self, port=None, baudrate=115200, pack_number=1, lifetime=20, log_name='us2000', pause=0.25, type='US2000',
+                 bulk=True, bulk_retry=600, poll=None, anomaly=None, history=0, history_interval=None,
+                 thread=True):
         """
         Service class with polling thread
 
@@ -19,6 +116,13 @@ class US2000(BMS):
         :param lifetime:    Time in seconds data is still valid
         :param log_name:    Name
         :param pause:       Pause between polling
+        :param bulk:        Read all packs with one request per command, falls back to per-pack reads if not supported
+        :param bulk_retry:  Time in seconds until the bulk read is tried again after a fallback
+        :param poll:        Poll intervals, see PollScheduler, limited to lifetime / 2
+        :param anomaly:     Limits of the analog values for an alarm re-read, see ANOMALY
+        :param history:     Time span of the cell history in seconds, 0: off (~55 bytes per pack and sample)
+        :param history_interval: Time between two samples of the cell history, default: normal analog poll interval
+        :param thread:      Start the polling thread, False if polled by the asyncio runtime (aio.py)
         """
         super().__init__()
         self.port = port
@@ -30,12 +134,23 @@ class US2000(BMS):
         self.log = logging.getLogger(log_name)
         self.log.info('init port={}'.format(port))
         self.com = None
-
-        self._pack_u = [None] * self.pack_number
-        self._pack_i = [None] * self.pack_number
-        self._pack_t = [None] * self.pack_number
-        self._pack_soc = [None] * self.pack_number
-        self._pack_cycle = [None] * self.pack_number
+        packs = (None,) * pack_number
+        self.snapshot = BMSSnapshot(0, None, pack_u=packs, pack_i=packs, pack_t=packs, pack_soc=packs, pack_cycle=packs)
+        self.commands = make_commands(pack_number, bulk=bulk)  # TX frames (address, cid2) built once
+        self.bulk = bulk
+        self.bulk_retry = bulk_retry
+        self.bulk_ok = None  # None: not tried, True: supported, False: fallback to per-pack reads
+        self.bulk_time = 0  # time of the last fallback
+        # receive timeout of a bulk response, ~70 bytes (140 ASCII characters) per pack and block
+        self.bulk_timeout = 0.5 + pack_number * (0.1 + 200 * 10 / baudrate)
+        self.poll = PollScheduler(poll, max_interval=lifetime / 2)
+        self.anomaly = dict(ANOMALY, **(anomaly or {}))
+        self.anomalies = [None] * pack_number  # active anomaly per pack
+        self.rx_time = {'analog': [None] * pack_number, 'alarm': [None] * pack_number}  # last valid data
+        self.history = None
+        if history:
+            interval = history_interval if history_interval else self.poll.intervals['analog']['normal']
+            self.history = CellHistory(pack_number, interval, history)
 
         self.data = {"analog": [None] * pack_number,
                      "alarm": [None] * pack_number,
@@ -43,37 +158,29 @@ class US2000(BMS):
                      "alarm_timeout": [time.perf_counter() + self.lifetime] * pack_number,
                      "frame_count": 0,
                      "error_analog": [0] * self.pack_number,
-                     "error_alarm": [0] * self.pack_number}
+                     "error_alarm": [0] * self.pack_number,
+                     "bulk": None,
+                     "error_bulk": 0}
 
         self.connect()
-        self.thread = Thread(target=self.run, daemon=True)
-        self.thread.start()
+        self.thread = None
+        if thread:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
 
     def get_state(self):
         """
         Get status of BMS as dictionary
         """
-        return {
-            'error': self._error,
-            'u': self._voltage,
-            'i': self._current,
-            't': self._temperature,
-            'soc': self._soc,
-            'soc_low': self._soc_low,
-            'soc_high': self._soc_high,
-
-            'pack_u': self._pack_u,
-            'pack_i': self._pack_i,
-            'pack_t': self._pack_t,
-            'pack_soc': self._pack_soc,
-            'pack_cycle': self._pack_cycle,
-        }
+        return dict(self.get_snapshot_state(), pack_age=self.get_age('analog'))
 
     def get_detail(self):
         """
         Get extra status of BMS as dictionary
         """
-        return self.data
+        return dict(self.data, poll=dict(self.poll.get_state(),
+                                         age={kind: self.get_age(kind) for kind in self.rx_time},
+                                         anomaly=list(self.anomalies)))
 
     def connect(self):
         try:
@@ -83,57 +190,180 @@ class US2000(BMS):
             self.log.error("connect: {}".format(e))
 
     def run(self):
+        poll = self.poll
         while True:
+            kind, delay = poll.next()
+            if delay > 0:
+                poll.wait(delay)
+                continue
+            t = time.perf_counter()
+
             if self.com is None:
                 self.connect()
-            else:
+            elif kind == 'analog':
                 self.data['frame_count'] += 1  # count read cycle
 
-            for i in range(self.pack_number):
-                try:
-                    d = read_analog_value(self.com, i, self.type)
-                    self.log.debug("read_analog_value[{}] {}".format(i, d))
-                    self.data['analog'][i] = d
-                    self.data['analog'][i]['time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.data['analog_timeout'][i] = time.perf_counter() + self.lifetime
-                except IOError:
-                    self.com = None
-                    self.data['analog'][i] = None
-                    self.log.error("read_analog_value: io port failed")
-                except Exception as e:
-                    self.data['analog'][i] = None
-                    self.data['error_analog'][i] += 1  # count error
-                    self.log.debug("EXCEPTION read_analog_value[{}] {}".format(i, e))
+            if not (self.use_bulk() and self.read_bulk([kind])):
+                self.read_packs([kind])
+            poll.done(kind, t)
 
-                time.sleep(self.pause)
+            self.process_data()
 
+    def read_bulk(self, kinds=('analog', 'alarm')):
+        """
+        Read all packs with one request per command
+
+        :param kinds: 'analog' and/or 'alarm'
+        :return: True if done, False for a fallback to per-pack reads
+        """
+        read = {'analog': lambda: read_analog_values(self.com, self.type, self.bulk_timeout),
+                'alarm': lambda: read_alarm_infos(self.com, self.bulk_timeout)}
+        for kind in kinds:
+            try:
+                self.store_bulk(kind, read[kind]())
+            except IOError:
+                self.com = None
+                self.data[kind] = [None] * self.pack_number
+                self.log.error("read_{}: io port failed".format(kind))
+                return True
+            except Exception as e:
+                self.set_bulk(False, e)
+                return False
+
+            time.sleep(self.pause)
+
+        self.set_bulk(True)
+        return True
+
+    def read_packs(self, kinds=('analog', 'alarm')):
+        """
+        Read pack by pack
+
+        :param kinds: 'analog' and/or 'alarm'
+        """
+        read = {'analog': lambda i: read_analog_value(self.com, i, self.type),
+                'alarm': lambda i: read_alarm_info(self.com, i)}
+        for i in range(self.pack_number):
+            for kind in kinds:
                 try:
-                    d = read_alarm_info(self.com, i)
-                    self.log.debug("read_alarm_info[{}] {}".format(i, d))
-                    self.data['alarm'][i] = d
-                    self.data['alarm'][i]['time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    self.data['alarm_timeout'][i] = time.perf_counter() + self.lifetime
+                    self.store(kind, i, read[kind](i))
                 except IOError:
                     self.com = None
-                    self.data['alarm'][i] = None
-                    self.log.error("read_alarm_info: io port failed")
+                    self.data[kind][i] = None
+                    self.log.error("read_{}: io port failed".format(kind))
                 except Exception as e:
-                    self.data['alarm'][i] = None
-                    self.data['error_alarm'][i] += 1  # count error
-                    self.log.debug("EXCEPTION read_alarm_info[{}] {}".format(i, e))
+                    self.store(kind, i, None, e)
 
                 time.sleep(self.pause)
 
-            self.process_data()
+    def use_bulk(self):
+        """
+        :return: True if the next sweep is read with bulk requests
+        """
+        if not self.bulk or self.com is None:
+            return False
+        return self.bulk_ok is not False or time.perf_counter() - self.bulk_time > self.bulk_retry
+
+    def set_bulk(self, ok, error=None):
+        """
+        Result of a bulk sweep. After a failure the per-pack reads are used, once for a bulk read that has worked
+        before, else for bulk_retry seconds.
+
+        :param ok: True if all packs were read
+        :param error: exception of a failed bulk read
+        """
+        if ok:
+            if self.bulk_ok is not True:
+                self.log.info("bulk read of {} packs".format(self.pack_number))
+            self.bulk_ok = True
+        else:
+            self.data['error_bulk'] += 1
+            self.bulk_time = time.perf_counter()
+            self.bulk_ok = None if self.bulk_ok else False
+            self.log.warning("bulk read failed, per-pack reads{}: {}".format(
+                '' if self.bulk_ok is None else " for {}s".format(self.bulk_retry), error))
+        self.data['bulk'] = self.bulk_ok
+
+    def set_poll_hint(self, hint):
+        self.poll.set_hint(hint)
+
+    def check_anomaly(self, i, d):
+        """
+        Check the analog values of a pack, the alarm info is read at once when an anomaly starts
+
+        :param i: pack index
+        :param d: dictionary with parsed analog values, None if the request failed
+        """
+        a = self.anomaly
+        if d is None:
+            anomaly = 'read failed'
+        elif max(d['u_cell']) - min(d['u_cell']) > a['cell_spread']:
+            anomaly = 'cell spread {}mV'.format(max(d['u_cell']) - min(d['u_cell']))
+        elif not a['u_cell_min'] <= min(d['u_cell']) <= max(d['u_cell']) <= a['u_cell_max']:
+            anomaly = 'cell voltage {}..{}mV'.format(min(d['u_cell']), max(d['u_cell']))
+        elif max(d['t']) > a['t_max']:
+            anomaly = 'temperature {}°C'.format(max(d['t']))
+        else:
+            anomaly = None
+
+        if anomaly and not self.anomalies[i]:
+            self.log.info("anomaly pack {}: {}, read alarm info".format(i, anomaly))
+            self.poll.trigger('alarm')
+        self.anomalies[i] = anomaly
+
+    def get_age(self, kind):
+        """
+        :param kind: 'analog' or 'alarm'
+        :return: list with the data age per pack in seconds, None without data
+        """
+        t = time.perf_counter()
+        return [round(t - rx, 3) if rx is not None else None for rx in self.rx_time[kind]]
+
+    def store_bulk(self, kind, packs):
+        """
+        Store the result of a bulk request
+
+        :param kind: 'analog' or 'alarm'
+        :param packs: list with a dictionary per pack
+        """
+        if len(packs) != self.pack_number:
+            raise ValueError("bulk read with {} packs, expected {}".format(len(packs), self.pack_number))
+        for i, d in enumerate(packs):
+            self.store(kind, i, d)
+
+    def store(self, kind, i, d, error=None):
+        """
+        Store the result of a pack request
+
+        :param kind: 'analog' or 'alarm'
+        :param i: pack index
+        :param d: dictionary with parsed values or None if the request failed
+        :param error: exception of a failed request
+        """
+        if d is not None:
+            self.log.debug("read_{}[{}] {}".format(kind, i, d))
+            self.data[kind][i] = d
+            self.data[kind][i]['time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            self.data[kind + '_timeout'][i] = time.perf_counter() + self.lifetime
+            self.rx_time[kind][i] = time.perf_counter()
+        else:
+            self.data[kind][i] = None
+            self.data['error_' + kind][i] += 1  # count error
+            self.log.debug("EXCEPTION read_{}[{}] {}".format(kind, i, error))
+        if kind == 'analog':
+            self.check_anomaly(i, d)
+            if d is not None and self.history:
+                self.history.add(i, d['u_cell'], d['t'])
 
     def process_data(self):
         """
-        Convert raw bms data to BMS main values (voltage, current, soc, ...)
+        Convert raw bms data to BMS main values (voltage, current, soc, ...), published as one snapshot
         """
         t = time.perf_counter()
 
         valid = True
         error = None
+        pack_u, pack_i, pack_t, pack_soc, pack_cycle = ([None] * self.pack_number for n in range(5))
 
         for i in range(self.pack_number):  # loop over all packs
             try:
@@ -143,45 +373,41 @@ class US2000(BMS):
                 pass
 
             try:
-                self._pack_u[i] = self.data['analog'][i]['u']
-                self._pack_i[i] = self.data['analog'][i]['i']
-                self._pack_t[i] = max(self.data['analog'][i]['t'])
-                self._pack_soc[i] = self.data['analog'][i]['soc']
-                self._pack_cycle[i] = self.data['analog'][i]['cycle']
+                pack_u[i] = self.data['analog'][i]['u']
+                pack_i[i] = self.data['analog'][i]['i']
+                pack_t[i] = max(self.data['analog'][i]['t'])
+                pack_soc[i] = self.data['analog'][i]['soc']
+                pack_cycle[i] = self.data['analog'][i]['cycle']
             except:
                 valid = False
-                self._pack_u[i] = None
-                self._pack_i[i] = None
-                self._pack_t[i] = None
-                self._pack_soc[i] = None
-                self._pack_cycle[i] = None
+                pack_u[i] = pack_i[i] = pack_t[i] = pack_soc[i] = pack_cycle[i] = None
                 self.log.exception("process_data with pack {} failed".format(i))
 
             if t > self.data['analog_timeout'][i] or t > self.data['alarm_timeout'][i]:
                 error = "timeout pack {}".format(i)
 
-        # process all packs to main data
+        # process all packs to main data, the last values are kept if a pack is missing (within lifetime)
 
+        s = self.snapshot
+        values = {'error': s.error, 'voltage': s.voltage, 'current': s.current, 'temperature': s.temperature,
+                  'soc': s.soc, 'soc_low': s.soc_low, 'soc_high': s.soc_high}
         if valid:
             try:
-                self._voltage = max(self._pack_u)
-                self._current = sum(self._pack_i)
-                self._temperature = max(self._pack_t)
-                self._soc = round(sum(self._pack_soc) / self.pack_number)
-                self._soc_low = round(min(self._pack_soc))
-                self._soc_high = round(max(self._pack_soc))
-                self._error = None
+                values = {'error': None,
+                          'voltage': max(pack_u),
+                          'current': sum(pack_i),
+                          'temperature': max(pack_t),
+                          'soc': round(sum(pack_soc) / self.pack_number),
+                          'soc_low': round(min(pack_soc)),
+                          'soc_high': round(max(pack_soc))}
             except:
-                self._error = "exception"
+                values['error'] = "exception"
 
         if error:
-            self._error = error
-            self._voltage = None
-            self._current = None
-            self._temperature = None
-            self._soc = None
-            self._soc_low = None
-            self._soc_high = None
+            values = {'error': error}
+
+        self.publish(**values, pack_u=tuple(pack_u), pack_i=tuple(pack_i), pack_t=tuple(pack_t),
+                     pack_soc=tuple(pack_soc), pack_cycle=tuple(pack_cycle))
 
     def update(self):
         """
@@ -0,0 +1,241 @@
+import math
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from operator import mul
+
+"""
+History of the cell voltages and temperatures per pack
+
+One ring buffer per pack with typed arrays instead of a dictionary per sample:
+
+    time    'd'  time.monotonic()               8 bytes
+    u_cell  'H'  [mV] all cells, sample by sample    2 bytes per cell
+    t       'h'  [0.1°C] all sensors            2 bytes per sensor
+    low     'H'  [mV] lowest cell               2 bytes
+    high    'H'  [mV] highest cell              2 bytes
+    spread  'H'  [mV] high - low                2 bytes
+
+US2000 (15 cells, 5 sensors): 54 bytes per sample, 24h with 1s interval = 4.7MB per pack. Samples closer than the
+interval are skipped. Lowest cell, highest cell and spread are calculated once per sample in add(), the queries work
+on the arrays and strided slices (u_cell[c::cells] = one cell), min, max and sum run in C. The statistics per cell
+and the temperature trend use at most SUMMARY_SAMPLES samples (every n-th sample of longer windows).
+
+The samples are ordered by time.monotonic(), a step of the system clock (NTP) does not disturb the windows. The
+results contain wall time (time.time()), converted with the offset of both clocks at the query. A window is located by
+bisect in the two segments of the ring buffer, only the samples of the window are copied.
+
+    history = CellHistory(pack_number=2, interval=1, duration=86400)
+    history.add(0, d['u_cell'], d['t'])
+    history.get_summary(window=3600)
+    history.get_series(0, window=3600, points=300)
+"""
+
+SUMMARY_SAMPLES = 3600  # samples for the statistics per cell and the temperature trend
+
+
+class PackHistory:
+    """
+    Ring buffer of one pack
+    """
+
+    def __init__(self, size, cells, temps):
+        """
+        :param size: number of samples
+        :param cells: number of cells
+        :param temps: number of temperature sensors
+        """
+        self.size = size
+        self.cells = cells
+        self.temps = temps
+        self.time = array('d', bytes(8 * size))
+        self.u_cell = array('H', bytes(2 * size * cells))
+        self.t = array('h', bytes(2 * size * temps))
+        self.low = array('H', bytes(2 * size))
+        self.high = array('H', bytes(2 * size))
+        self.spread = array('H', bytes(2 * size))
+        self.pos = 0  # next write position
+        self.count = 0  # number of valid samples
+
+    def add(self, t, u_cell, temps):
+        p = self.pos
+        self.time[p] = t
+        self.u_cell[p * self.cells:(p + 1) * self.cells] = array('H', u_cell)
+        self.t[p * self.temps:(p + 1) * self.temps] = array('h', [round(x * 10) for x in temps])
+        low, high = min(u_cell), max(u_cell)
+        self.low[p] = low
+        self.high[p] = high
+        self.spread[p] = high - low
+        self.pos = (p + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+    def get_window(self, since=None):
+        """
+        Copy of the samples in time order
+
+        :param since: time.monotonic() of the oldest sample, None: all
+        :return: (time, u_cell, t, low, high, spread) arrays
+        """
+        if self.count < self.size:
+            segments = [(0, self.count)]
+        else:
+            segments = [(self.pos, self.size), (0, self.pos)]  # older, newer
+        if since is not None:
+            segments = [(bisect_left(self.time, since, lo, hi), hi) for lo, hi in segments]
+
+        def ordered(a, n):
+            (lo, hi), *newer = segments
+            w = a[lo * n:hi * n]
+            for lo, hi in newer:
+                w += a[lo * n:hi * n]
+            return w
+
+        return (ordered(self.time, 1), ordered(self.u_cell, self.cells), ordered(self.t, self.temps),
+                ordered(self.low, 1), ordered(self.high, 1), ordered(self.spread, 1))
+
+
+class CellHistory:
+    def __init__(self, pack_number, interval=1.0, duration=86400):
+        """
+        :param pack_number: number of packs
+        :param interval: minimum time between two samples in seconds
+        :param duration: time span of the ring buffers in seconds
+        """
+        self.pack_number = pack_number
+        self.interval = interval
+        self.duration = duration
+        self.size = math.ceil(duration / interval)
+        self.packs = [None] * pack_number  # PackHistory, created with the first sample (number of cells)
+        self.last = [None] * pack_number
+        self.lock = threading.Lock()
+
+    def add(self, pack, u_cell, t, now=None):
+        """
+        Add a sample of the analog values, skipped if closer than the interval to the last one
+
+        :param pack: pack index
+        :param u_cell: cell voltages [mV]
+        :param t: temperatures [°C]
+        :param now: time.monotonic()
+        :return: True if stored
+        """
+        now = time.monotonic() if now is None else now
+        if self.last[pack] is not None and now - self.last[pack] < self.interval * 0.9:  # jitter of the poll time
+            return False
+        with self.lock:
+            h = self.packs[pack]
+            if h is None or h.cells != len(u_cell) or h.temps != len(t):
+                h = self.packs[pack] = PackHistory(self.size, len(u_cell), len(t))
+            h.add(now, u_cell, t)
+            self.last[pack] = now
+        return True
+
+    def get_window(self, pack, window=None):
+        """
+        :param pack: pack index
+        :param window: time span in seconds up to now, None: all
+        :return: (PackHistory, time, u_cell, t, low, high, spread) or None without samples
+        """
+        with self.lock:
+            h = self.packs[pack]
+            if h is None or not h.count:
+                return None
+            return (h,) + h.get_window(time.monotonic() - window if window else None)
+
+    def get_pack_summary(self, pack, window=None):
+        """
+        Cell spread, lowest and highest cell and temperature trend of a pack, the statistics per cell and the trend
+        use at most SUMMARY_SAMPLES samples
+
+        :param pack: pack index
+        :param window: time span in seconds up to now, None: all
+        :return: dictionary (voltages in mV, temperatures in °C, trend in °C/h) or None without samples
+        """
+        w = self.get_window(pack, window)
+        if w is None:
+            return None
+        h, tm, u_cell, t, low, high, spread = w
+        n = len(tm)
+        if not n:
+            return None
+        k = spread.index(max(spread))
+        step = math.ceil(n / SUMMARY_SAMPLES)
+        cells = [u_cell[c::h.cells * step] for c in range(h.cells)]
+        latest = u_cell[-h.cells:]
+        offset = time.time() - time.monotonic()  # monotonic --> wall time
+        cell_mean = [sum(c) / len(c) for c in cells]
+        pack_mean = sum(cell_mean) / h.cells
+        return {'samples': n,
+                'time': [tm[0] + offset, tm[-1] + offset],
+                'spread': spread[-1],
+                'spread_max': spread[k],
+                'spread_max_time': tm[k] + offset,
+                'spread_mean': round(sum(spread) / n, 1),
+                'cell_min': min(latest),
+                'cell_min_index': latest.index(min(latest)),
+                'cell_max': max(latest),
+                'cell_max_index': latest.index(max(latest)),
+                'cell': {'min': [min(c) for c in cells],
+                         'max': [max(c) for c in cells],
+                         'mean': [round(m, 1) for m in cell_mean],
+                         'offset': [round(m - pack_mean, 1) for m in cell_mean]},  # imbalance to the pack mean
+                't': [x / 10 for x in t[-h.temps:]],
+                't_trend': [round(s, 2) for s in self.get_trend(tm, t, h.temps, step)]}
+
+    def get_summary(self, window=None):
+        """
+        :param window: time span in seconds up to now, None: all
+        :return: dictionary with get_pack_summary() per pack
+        """
+        return {'interval': self.interval,
+                'duration': self.duration,
+                'window': window,
+                'packs': [self.get_pack_summary(i, window) for i in range(self.pack_number)]}
+
+    def get_series(self, pack, window=None, points=300):
+        """
+        Time series for a chart, reduced to about points samples (every n-th sample)
+
+        :param pack: pack index
+        :param window: time span in seconds up to now, None: all
+        :param points: number of points
+        :return: dictionary with lists: time, spread, low and high cell [mV], temperatures per sensor [°C]
+        """
+        w = self.get_window(pack, window)
+        if w is None:
+            return {'time': [], 'spread': [], 'low': [], 'high': [], 't': []}
+        h, tm, u_cell, t, low, high, spread = w
+        step = max(math.ceil(len(tm) / points), 1) if points else 1
+        offset = time.time() - time.monotonic()  # monotonic --> wall time
+        return {'time': [x + offset for x in tm[::step]],
+                'spread': list(spread[::step]),
+                'low': list(low[::step]),
+                'high': list(high[::step]),
+                't': [[x / 10 for x in t[s::h.temps * step]] for s in range(h.temps)]}
+
+    @staticmethod
+    def get_trend(tm, t, temps, step=1):
+        """
+        Least squares slope of every temperature sensor
+
+        :param tm: time array
+        :param t: temperature array [0.1°C], temps values per sample
+        :param temps: number of sensors
+        :param step: use every n-th sample
+        :return: list with the slope per sensor [°C/h]
+        """
+        tm = tm[::step]
+        n = len(tm)
+        if n < 2 or tm[-1] <= tm[0]:
+            return [0.0] * temps
+        x = [v - tm[0] for v in tm]
+        sx = sum(x)
+        d = n * sum(map(mul, x, x)) - sx * sx
+        if not d:
+            return [0.0] * temps
+        trend = []
+        for s in range(temps):
+            y = t[s::temps * step]
+            trend.append((n * sum(map(mul, x, y)) - sx * sum(y)) / d * 3600 / 10)
+        return trend
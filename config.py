@@ -1,4 +1,6 @@
 config = {
+    'runtime': 'thread',  # 'thread' (default) or 'asyncio' (all devices and the web api on one event loop)
+
     'meterhub_address': 'http://192.168.0.10:8008',
     'victron_mk3_port': '/dev/serial/by-id/usb-VictronEnergy_MK3-USB_Interface_HQ2132VK4JK-if00-port0',
 
@@ -7,6 +9,8 @@ config = {
         'port': "/dev/serial/by-path/platform-3f980000.usb-usb-0:1.3:1.0",  # Raspberry Home (rechts oben)
         'pack_number': 2,  # number of Pylontech packs
         'baudrate': 115200,  # Baudrate for Pylontech BMS
+        # 'bulk': False,  # read pack by pack, default: all packs with one request, fallback if not supported
+        # 'history': 86400,  # [s] cell history (/api/cells), ~4.7MB per pack with 1s interval, default 0: off
     },
 
     # 'bms_seplos': {
@@ -23,12 +27,51 @@ config = {
     # the blackbox stores the specified number of records in /log/blackbox-*.jsonl in case of error
     'blackbox_size': 80,  # Number of data sets, storage time: n * 750ms
 
+    # control cycle, period and time budget per stage in seconds (overruns are counted, see /api/cycle and /api/timing)
+    # The multiplus update takes ~0.53s at 2400 baud (~0.42s with 'mp2_pipeline'), the meterhub is read parallel to
+    # it and limited by 'acquisition_deadline'. A cycle of 0.25..0.35s needs 'mp2_thread': True (update() and command()
+    # do not block), e.g. 'cycle': {'period': 0.3, 'budget': {'multiplus_update': 0.005, 'meterhub': 0.05, ...}}
+    'cycle': {'period': 0.75,
+              'budget': {'multiplus_update': 0.6,
+                         'bms': 0.01,
+                         'fsm': 0.02,
+                         'multiplus_command': 0.15,
+                         'record': 0.03},  # trace and blackbox
+              'min_period': 0.2},  # shortest cycle, started by new samples with meterhub_stream
+    # fast setpoint loop (meter, regulator, multiplus command) apart from the supervisory cycle above, the multiplus is
+    # served by its worker thread (runtime 'thread' only)
+    # 'fast_loop': {'period': 0.25, 'budget': {'fast.meterhub': 0.05, 'fast.regulate': 0.005, 'fast.command': 0.005},
+    #               'min_period': 0.1},
+    'acquisition_deadline': 0.4,  # [s] after cycle start, meterhub data arriving later is used in the next cycle
+    'mp2_pause': 0.075,  # [s] pause between the VE.Bus requests of the multiplus update
+    # VE.Bus in a worker thread (runtime 'asyncio': worker task), setpoints are sent without waiting, always on with
+    # more than one device in 'mp2_devices'
+    'mp2_thread': False,
+    'mp2_update_interval': 0.3,  # [s] telemetry read interval of the worker, uses the bus time of skipped setpoints
+    # setpoint transmission: send on change > deadband [W] or after keepalive [s], the ESS assistant drops a setpoint
+    # without refresh after watchdog [s]. Default: every cycle (keepalive 0). Opt-in e.g. {'deadband': 20,
+    # 'keepalive': 5}, the worker ('mp2_thread') reads the telemetry earlier by the bus time of skipped setpoints.
+    'mp2_setpoint': {'deadband': 0, 'keepalive': 0, 'watchdog': 60},
+    'mp2_pipeline': False,  # multiplus update with two batched VE.Bus writes (snapshot request + ac info, snapshot + led)
+    # RAM variables read with every multiplus update (up to 6, names see VEBus.RAM_VARS), e.g. 9: AC load current
+    'mp2_ram_vars': [15, 16, 4, 5, 13],
+    'mp2_cache_file': 'mp2_cache.json',  # ESS setpoint RAM id per MK2 version/device, fast reconnect without scan
+    # three-phase or parallel system, one entry per ESS assistant (phase master), the setpoint is split by the
+    # phase grid power (meterhub key grid_p), default: single Multiplus at address 0
+    # 'mp2_devices': [{'address': 0, 'phase': 1, 'grid_p': 'grid_l1_p', 'max_power': 2400},
+    #                 {'address': 1, 'phase': 2, 'grid_p': 'grid_l2_p', 'max_power': 2400},
+    #                 {'address': 2, 'phase': 3, 'grid_p': 'grid_l3_p', 'max_power': 2400}],
+
     'enable_car': True,  # Show car values on dashboard
     'enable_heat': False,  # Show heater values on dashboard
 
     'udc_max': 54,  # maximum voltage (only checked at BMS, MP2 has peaks ?! ToDo !!!)
     't_max': 40,  # maximum temperature
 
+    # fast BMS polling in charge/feed if soc or voltage is within this distance to the end
+    'bms_fast_soc': 5,  # [%]
+    'bms_fast_voltage': 0.5,  # [V]
+
     # The setting [0] is used as default, undefined values from other settings [1, ...] are used from the setting [0]
     'setting': [
         {
@@ -115,11 +158,33 @@ config = {
 
     ],
 
+    # meter data pushed by the meterhub instead of a request per cycle (meter_stream.py, runtime 'thread' only)
+    # 'meterhub_stream': {'mode': 'udp', 'port': 8009},  # UDP datagrams (JSON)
+    # 'meterhub_stream': {'mode': 'sse', 'path': '/stream'},  # Server-Sent Events at meterhub_address + path
+
+    # setpoint regulator between statemachine and multiplus (regulator.py)
+    'regulator': {'slew_up': 800,  # [W/s] rise of charge/feed power
+                  'slew_down': None,  # [W/s] fall of charge/feed power, None: immediately
+                  'kp': 0.0,  # [W/W] proportional correction on grid_p
+                  'ki': 0.0,  # [W/Ws] integral correction on grid_p
+                  'ff_gain': 1.0,  # gain of the statemachine power (pv_p, home_all_p)
+                  'i_limit': 300},  # [W] limit of the integral correction
+
     # enable csv log
     'csv_log': {'interval': 60,   # storage interval in seconds
                 'columns': [      # first entry is the name, second and so on the route inside main dataset /api/state
                     ('time', 'ess', 'time'),
                     ('state', 'ess', 'state'),
+                    ('mode', 'ess', 'mode'),
+                    ('set_p', 'ess', 'set_p'),
+                    ('reg_p', 'ess', 'reg_p'),
+                    ('grid_p', 'meterhub', 'grid_p'),     # meterhub and soc values are needed for replay.py
+                    ('pv_p', 'meterhub', 'pv_p'),
+                    ('home_all_p', 'meterhub', 'home_all_p'),
+                    ('mp2_state', 'multiplus', 'state'),
+                    ('bms_soc', 'bms', 'soc'),
+                    ('bms_soc_low', 'bms', 'soc_low'),
+                    ('bms_soc_high', 'bms', 'soc_high'),
                     ('bat_ac_p', 'meterhub', 'bat_p'),
                     ('mp2_bat_u', 'multiplus', 'bat_u'),
                     ('mp2_bat_i', 'multiplus', 'bat_i'),
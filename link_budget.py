@@ -0,0 +1,163 @@
+import argparse
+import json
+import logging
+
+from vebus import VEBus
+
+"""
+VE.Bus link budget
+
+The MK3 link runs at 2400 baud, a byte takes 10 bits = 4.17ms. plan() predicts the shortest VE.Bus time of a cycle
+from the frame sizes, the reaction time of the device (latency) and the pause between the writes:
+
+    time = (TX bytes + RX bytes) * 10 / baudrate + writes with response * latency + (writes - 1) * pause
+
+The requests of one write (batch) are sent back to back, the responses follow after one latency. The frames are built
+with the functions of VEBus, a change of the snapshot ids or the phases is taken into account. PLANS are the update
+variants of MultiPlus2 with one setpoint, the table shows the headroom won by every step. The measured link
+statistics (LinkStats, /api/cycle 'vebus_link') can be shown for comparison.
+
+    python3 link_budget.py [--latency 0.02] [--pause 0.075] [--phases 3] [--devices 3] [--url http://localhost:8888]
+"""
+
+# requests, see request_batch()
+REQUESTS = ('snapshot_request', 'ac_info', 'snapshot', 'led', 'setpoint')
+
+# name: (list of writes (list of requests), LED status appended to the responses)
+PLANS = {
+    'sequential': ([['snapshot_request'], ['ac_info'], ['snapshot'], ['led'], ['setpoint']], False),
+    'led_appended': ([['snapshot_request'], ['ac_info'], ['snapshot'], ['setpoint']], True),
+    'pipeline': ([['snapshot_request', 'ac_info'], ['snapshot', 'led'], ['setpoint']], False),
+    'pipeline_led_appended': ([['snapshot_request', 'ac_info'], ['snapshot'], ['setpoint']], True),
+    'setpoint_only': ([['setpoint']], False),  # worker thread, telemetry skipped in this cycle
+}
+
+
+def make_vebus(phases=1, snapshot_ids=None):
+    logging.getLogger('link_budget.vebus').setLevel(logging.CRITICAL)  # no port
+    vebus = VEBus(port=None, log='link_budget.vebus')
+    vebus.phases = list(range(1, phases + 1))
+    if snapshot_ids:
+        vebus.set_snapshot_ids(snapshot_ids)
+    vebus.address = 0
+    vebus.ess_setpoint_ram_id = 131
+    return vebus
+
+
+def request_batch(vebus, name, devices=1):
+    """
+    :return: list of (cmd, data, head) like VEBus.transact()
+    """
+    if name == 'snapshot_request':
+        return vebus.batch_ac_info()[:1]
+    elif name == 'ac_info':
+        return vebus.batch_ac_info()[1:]
+    elif name == 'snapshot':
+        return vebus.batch_snapshot_led()[:1]
+    elif name == 'led':
+        return vebus.batch_snapshot_led()[1:]
+    elif name == 'setpoint':
+        if devices > 1:
+            return vebus.batch_set_power([(addr, 131, 0) for addr in range(devices)])
+        return [('X', vebus.make_set_power(0), [b'\x05\xFF\x58', b'\x03\xFF\x58'])]
+    raise ValueError("unknown request {}".format(name))
+
+
+def frame_sizes(vebus, batch, led_appended=False):
+    """
+    :return: (TX bytes, RX bytes) of a batch, the shortest response is used if there are alternatives
+    """
+    tx = sum(len(vebus.build_frame(cmd, data)) for cmd, data, head in batch)
+    rx = 0
+    for cmd, data, head in batch:
+        if head is None:
+            continue
+        heads = head if isinstance(head, (list, tuple)) else [head]
+        rx += min(h[0] for h in heads) + 2  # length + checksum
+        if led_appended and heads[0][1] == 0xFF and cmd not in ('L', 'V'):
+            rx += 2
+    return tx, rx
+
+
+def plan(writes, vebus=None, latency=0.02, pause=0.0, led_appended=False, devices=1, baudrate=2400):
+    """
+    Predict the shortest VE.Bus time of a cycle
+
+    :param writes: list of writes, every write a list of request names (REQUESTS)
+    :param vebus: VEBus instance for the frames, default: make_vebus()
+    :param latency: reaction time of the device per write with response in seconds
+    :param pause: pause between two writes in seconds
+    :param led_appended: LED status appended to the responses
+    :param devices: number of devices for the setpoint
+    :param baudrate: baudrate of the link
+    :return: dictionary (times in seconds)
+    """
+    vebus = vebus if vebus else make_vebus()
+    tx = rx = round_trips = 0
+    for names in writes:
+        batch = [r for name in names for r in request_batch(vebus, name, devices)]
+        t, r = frame_sizes(vebus, batch, led_appended)
+        tx += t
+        rx += r
+        round_trips += 1 if r else 0
+    wire_time = (tx + rx) * 10 / baudrate
+    cycle_time = wire_time + round_trips * latency + max(len(writes) - 1, 0) * pause
+    return {'writes': len(writes),
+            'round_trips': round_trips,
+            'tx_bytes': tx,
+            'rx_bytes': rx,
+            'wire_time': wire_time,
+            'cycle_time': cycle_time,
+            'max_rate': 1 / cycle_time if cycle_time else None,
+            'utilization': wire_time / cycle_time if cycle_time else None}
+
+
+def plan_all(latency=0.02, pause=0.0, phases=1, devices=1, snapshot_ids=None):
+    """
+    :return: dictionary with the result of plan() per PLANS entry
+    """
+    vebus = make_vebus(phases, snapshot_ids)
+    return {name: plan(writes, vebus, latency, pause, led_appended, devices)
+            for name, (writes, led_appended) in PLANS.items()}
+
+
+def read_measured(url):
+    """
+    :return: last update interval of the running ESS (/api/cycle 'vebus_link') or None
+    """
+    import requests
+    try:
+        return requests.get(url + '/api/cycle', timeout=2).json().get('vebus_link')
+    except Exception as e:
+        print("read {} failed: {}".format(url, e))
+        return None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="VE.Bus link budget")
+    parser.add_argument('--latency', type=float, default=0.02, help="reaction time of the device [s]")
+    parser.add_argument('--pause', type=float, default=0.0, help="pause between two writes [s] (config mp2_pause)")
+    parser.add_argument('--phases', type=int, default=1, help="phases of the AC info")
+    parser.add_argument('--devices', type=int, default=1, help="devices for the setpoint")
+    parser.add_argument('--url', help="ESS webserver, show the measured link statistics")
+    parser.add_argument('--json', action='store_true', help="print as JSON")
+    args = parser.parse_args()
+
+    results = plan_all(args.latency, args.pause, args.phases, args.devices)
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        base = results['sequential']['cycle_time']
+        print("{:24} {:>6} {:>6} {:>6} {:>6} {:>9} {:>9} {:>8} {:>7}".format(
+            'plan', 'writes', 'trips', 'tx [B]', 'rx [B]', 'wire [ms]', 'time [ms]', 'max [Hz]', 'gain'))
+        for name, r in results.items():
+            print("{:24} {:>6} {:>6} {:>6} {:>6} {:>9.1f} {:>9.1f} {:>8.2f} {:>6.0f}%".format(
+                name, r['writes'], r['round_trips'], r['tx_bytes'], r['rx_bytes'], r['wire_time'] * 1000,
+                r['cycle_time'] * 1000, r['max_rate'], (1 - r['cycle_time'] / base) * 100))
+
+    if args.url:
+        measured = read_measured(args.url)
+        if measured and measured['cycle']:
+            c = measured['cycle']
+            print("measured: tx={tx_bytes}B rx={rx_bytes}B frames={tx_frames}/{rx_frames} wire={wire_time}s "
+                  "elapsed={elapsed}s utilization={utilization} idle_gaps={idle_gaps} idle={idle_time}s".format(**c))
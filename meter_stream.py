@@ -0,0 +1,168 @@
+import json
+import socket
+import threading
+import time
+
+import requests
+
+from api_request import ApiRequest
+from timing import timing
+
+"""
+Meter data pushed by the meterhub instead of one HTTP request per cycle
+
+The samples (same JSON dictionary as the meterhub API) are received in a thread:
+
+    'udp'   one JSON dictionary per datagram
+    'sse'   Server-Sent Events, one JSON dictionary per event (data: {...})
+
+The latest sample is kept in .data with its receive time. .event is set with every new sample and used by the
+scheduler to start the control cycle at once. read() has the interface of ApiRequest.read(), it only checks the
+lifetime. The battery info is sent to the meterhub API with send() (blocking HTTP, reduced rate).
+
+    stream = MeterStream('http://192.168.0.10:8008', mode='udp', port=8009)
+"""
+
+
+class MeterStream(ApiRequest):
+    def __init__(self, url, mode='udp', host='', port=8009, path='/stream', post_interval=5, timeout=1, lifetime=10,
+                 log_name='meterhub'):
+        """
+        :param url: meterhub API, used for posts and as base for the SSE path
+        :param mode: 'udp' or 'sse'
+        :param host: UDP bind address
+        :param port: UDP port
+        :param path: SSE path
+        :param post_interval: minimum time between two posts in seconds
+        :param timeout: timeout for HTTP in seconds
+        :param lifetime: timeout for data in seconds
+        :param log_name: name for logger
+        """
+        super().__init__(url, timeout=timeout, lifetime=lifetime, log_name=log_name)
+        self.mode = mode
+        self.host = host
+        self.port = port
+        self.path = path
+        self.post_interval = post_interval
+        self.post_time = None
+        self.event = threading.Event()  # set with every new sample
+        self.lock = threading.Lock()
+
+        self.rx_time = None  # receive time of the last sample (time.perf_counter())
+        self.source_time = None  # timestamp of the last sample given by the meterhub
+        self.samples = 0
+        self.errors = 0
+
+        target = self.run_udp if mode == 'udp' else self.run_sse
+        self.thread = threading.Thread(target=target, daemon=True)
+        self.thread.start()
+
+    def receive(self, raw):
+        """
+        Handle a received sample
+
+        :param raw: JSON (bytes or string)
+        """
+        t = time.perf_counter()
+        try:
+            data = json.loads(raw)
+            if not isinstance(data, dict):
+                raise ValueError("no dictionary")
+        except ValueError as e:
+            self.errors += 1
+            self.log.error("invalid sample {} error: {}".format(raw[:80], e))
+            return
+        with self.lock:
+            if self.rx_time is not None:
+                timing.add('meter.interval', t - self.rx_time)
+            self.rx_time = t
+            self.source_time = data.get('timestamp', data.get('time'))
+            self.samples += 1
+            self.set_data(data, True, t)
+        self.event.set()
+
+    def run_udp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        self.log.info("receive udp at port {}".format(self.port))
+        while True:
+            try:
+                raw, addr = sock.recvfrom(4096)
+                self.receive(raw)
+            except Exception as e:
+                self.errors += 1
+                self.log.error("udp receive failed: {}".format(e))
+                time.sleep(1)
+
+    def run_sse(self):
+        url = self.url + self.path
+        while True:
+            try:
+                self.log.info("connect to {}".format(url))
+                with requests.get(url, stream=True, timeout=(self.timeout, self.lifetime),
+                                  headers={'Accept': 'text/event-stream'}) as r:
+                    if r.status_code != 200:
+                        raise ValueError("status_code={} url={}".format(r.status_code, url))
+                    lines = []
+                    # chunk_size=1: a line is given when complete, larger chunks wait for the next event
+                    for line in r.iter_lines(chunk_size=1, decode_unicode=True):
+                        if line.startswith('data:'):
+                            lines.append(line[5:].strip())
+                        elif not line and lines:  # empty line: end of event
+                            self.receive('\n'.join(lines))
+                            lines = []
+            except Exception as e:
+                self.errors += 1
+                self.log.error("stream {} failed: {}".format(url, e))
+            time.sleep(1)  # reconnect
+
+    def send(self, post, url_extension=''):
+        """
+        Send data to the meterhub API, skipped until post_interval has passed since the last send
+
+        :param post: dictionary
+        :return: True if sent
+        """
+        t = time.perf_counter()
+        if self.post_time is not None and t - self.post_time < self.post_interval:
+            return False
+        self.post_time = t
+        try:
+            requests.post(self.url + url_extension, timeout=self.timeout, json=post)
+            return True
+        except Exception as e:
+            self.log.error("post to {} failed: {}".format(self.url, e))
+            return False
+
+    def read(self, post=None, url_extension=''):
+        """
+        Check the lifetime, the data is received by the thread
+
+        :param post: optional, sent with send()
+        :return: data (dictionary)
+        """
+        if post is not None:
+            self.send(post, url_extension)
+        t = time.perf_counter()
+        with self.lock:
+            if self.rx_time is None or t - self.rx_time > self.lifetime:
+                self.set_data({'error': "no sample from {} stream".format(self.mode)}, False, t)
+            return self.data
+
+    def get_age(self):
+        """
+        :return: age of the latest sample in seconds, None without sample
+        """
+        return time.perf_counter() - self.rx_time if self.rx_time is not None else None
+
+    def get_state(self):
+        """
+        :return: dictionary
+        """
+        age = self.get_age()
+        return {'mode': self.mode,
+                'samples': self.samples,
+                'errors': self.errors,
+                'age': round(age, 3) if age is not None else None,
+                'source_time': self.source_time}
@@ -1,20 +1,73 @@
+import json
 import logging
+import math
+import os
+import threading
 import time
 
+from timing import timing
 from vebus import VEBus
 
 """
 Multiplus-II, ESS Mode 3 
 
+A setpoint is sent when it differs more than deadband from the last sent value or when keepalive is due. The ESS
+assistant drops a setpoint which is not refreshed within its watchdog time, a lapse is counted and the setpoint is
+sent again at once. deadband=0 and keepalive=0 sends every cycle.
+
+With thread=True the VE.Bus is served by a worker thread. command(), sleep() and wakeup() only post the request, a
+newer setpoint replaces one not yet sent. The worker sends it at once (between the update requests) and reads the
+telemetry with update_interval. update() does not block, .data is the latest complete read with 'timestamp'.
+
+connect() runs in the background (connect thread, worker thread or asyncio task) and is retried with exponential
+backoff, an offline Multiplus does not stall the control cycle. The RAM id of the ESS setpoint is stored in cache_file
+per MK2 version and device address. A reconnect checks it with one read instead of the assistant scan.
+
+With more than one device (three-phase or parallel system, one entry per ESS assistant) the setpoint is split across
+the devices by the grid power of their phase: feed goes to the phases with import, charge to the phases with export.
+All setpoints are written with one VE.Bus write, the AC info of all phases is read with the update. The snapshot
+(RAM vars) is read from the first device.
+
+    devices = [{'address': 0, 'phase': 1, 'grid_p': 'grid_l1_p', 'max_power': 2400}, ...]
+
 22.01.2023 Martin Steppuhn
 """
 
 
 class MultiPlus2:
-    def __init__(self, port, timeout=10):
-        self.vebus = VEBus(port=port, log='vebus')
+    def __init__(self, port, timeout=10, vebus=None, pipeline=False, thread=False, update_interval=0.5, led_max_age=5,
+                 deadband=0, keepalive=0, watchdog=60, ram_vars=None, cache_file=None, connect_backoff=(1, 60),
+                 devices=None):
+        """
+        :param port: serial port of the MK3 interface
+        :param timeout: time in seconds until the multiplus is offline without valid data
+        :param vebus: optional VEBus instance, default: VEBus(port)
+        :param pipeline: update with two batched transactions instead of four single requests, always with more than
+                         one device
+        :param thread: VE.Bus I/O in a worker thread
+        :param update_interval: time between two updates of the worker thread in seconds
+        :param led_max_age: LED status appended to other responses is used up to this age, get_led() is skipped
+        :param deadband: setpoint change in watt which is sent before keepalive
+        :param keepalive: time in seconds after which an unchanged setpoint is sent again, 0: every cycle,
+                          limited to watchdog / 2
+        :param watchdog: time in seconds after which the ESS assistant drops the setpoint
+        :param ram_vars: RAM ids read with every update (up to 6), default: VEBus.SNAPSHOT_IDS
+        :param cache_file: JSON file for the ESS setpoint RAM id, None: scan at every connect
+        :param connect_backoff: (first, maximum) delay between connect attempts in seconds
+        :param devices: list of dictionaries, address, phase, grid_p (meterhub key of the phase grid power) and
+                        max_power [W], default: single device at address 0
+        """
+        self.vebus = vebus if vebus else VEBus(port=port, log='vebus')
+        if ram_vars:
+            self.vebus.set_snapshot_ids(ram_vars)
+        self.devices = [dict(d) for d in devices] if devices else [{'address': 0, 'phase': 1}]
+        self.vebus.phases = sorted(set(d.get('phase', 1) for d in self.devices))
+        self.phase_grid_p = None  # grid power per device, set by command()
+        self.device_power = [0] * len(self.devices)  # last split setpoints [W]
         self.log = logging.getLogger('mp2')
         self.timeout = timeout
+        self.pipeline = pipeline or len(self.devices) > 1  # phases of the AC info and LED status in one write
+        self.led_max_age = led_max_age
 
         self.data_timeout = time.perf_counter() + self.timeout
         self.data = None  # Dictionary with all information from Multiplus
@@ -27,56 +80,287 @@ class MultiPlus2:
         self._wakeup = False
         self._sleep = False
 
+        self.cache_file = cache_file
+        self.cache = self.load_cache()  # {'<mk2_version>/<address>': {'ess_setpoint_ram_id': ...}}
+        self.connect_backoff = connect_backoff
+        self.connect_delay = connect_backoff[0]
+        self.connect_time = 0  # next connect attempt (time.perf_counter())
+        self.connecting = False
+        self.connect_attempts = 0
+        self.warm_connects = 0  # connects with verified cached RAM id
+
+        self.deadband = deadband
+        self.watchdog = watchdog
+        if keepalive and watchdog and keepalive > watchdog / 2:
+            self.log.warning("keepalive {}s limited to watchdog / 2 = {}s".format(keepalive, watchdog / 2))
+            keepalive = watchdog / 2  # refresh always within the watchdog
+        self.keepalive = keepalive
+        self.sent_power = None  # last setpoint written successfully, None: send next setpoint
+        self.sent_time = None  # time of the last successful write
+        self.power_sent = 0  # number of writes
+        self.power_skipped = 0  # number of setpoints not sent (deadband)
+        self.set_power_time = 0.11  # [s] bus time of the last setpoint write
+        self.bus_credit = 0  # [s] bus time of the setpoints skipped since the last read, the next read is earlier
+        self.watchdog_lapses = 0
+
+        self.pause_time = 0.1  # pause between the update requests of the worker thread, set by update()
+        self.update_interval = update_interval
+        self.setpoint = 0  # latest setpoint for the worker thread
+        self.setpoint_time = None  # time of the latest command() not yet sent
+        self.command_event = threading.Event()
+        self.coalesced = 0  # setpoints replaced before sent
+        self.thread = None
+        if thread:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
     def sleep(self):
         self._sleep = True
+        self.command_event.set()
 
     def wakeup(self):
         self._wakeup = True
+        self.command_event.set()
 
     def connect(self):
         version = self.vebus.get_version()  # hide errors while scanning
         if version:
             self.data = {'mk2_version': version}  # init dictionary
             time.sleep(0.1)
-            if self.vebus.init_address():
-                time.sleep(0.1)
-                if self.vebus.scan_ess_assistant():
-                    self.log.info("ess assistant setpoint ramid={}".format(self.vebus.ess_setpoint_ram_id))
-                    self.data['state'] = 'init'
-                    self.online = True
-                    self.data_timeout = time.perf_counter() + self.timeout  # start timeout
+            if all(self.connect_device(d) for d in reversed(self.devices)):  # first device is selected at the end
+                self.vebus.load_ram_var_info(self.vebus.snapshot_ids)  # default scaling on failure
+                self.data = {'mk2_version': version, 'state': 'init'}  # replace, published data is not modified
+                self.data_timeout = time.perf_counter() + self.timeout  # start timeout
+                self.online = True
 
+    def connect_device(self, device):
+        """
+        Select the device and find its ESS setpoint RAM id
 
+        :return: True/False
+        """
+        if not self.vebus.init_address(device['address']):
+            return False
+        time.sleep(0.1)
+        ramid = self.get_cached_ram_id()
+        if ramid and self.vebus.verify_ess_assistant(ramid):
+            self.warm_connects += 1
+        elif not self.vebus.scan_ess_assistant():
+            return False
+        return self.set_device_ram_id(device)
 
-    def command(self, power):
+    def set_device_ram_id(self, device):
+        self.log.info("address={} ess assistant setpoint ramid={}".format(device['address'],
+                                                                         self.vebus.ess_setpoint_ram_id))
+        device['ram_id'] = self.vebus.ess_setpoint_ram_id
+        self.set_cached_ram_id()
+        return True
+
+    def try_connect(self):
+        try:
+            self.connect()
+        except Exception as e:
+            self.log.exception("connect: {}".format(e))
+        self.connect_done()
+
+    def connect_due(self):
+        """
+        :return: True if a connect attempt is to be started
+        """
+        return not self.connecting and time.perf_counter() >= self.connect_time
+
+    def connect_done(self):
+        """
+        End of a connect attempt, the delay to the next attempt is doubled after every failure
+        """
+        self.connecting = False
+        self.connect_attempts += 1
+        if self.online:
+            self.connect_delay = self.connect_backoff[0]
+        else:
+            self.log.info("connect failed, retry in {}s".format(self.connect_delay))
+            self.connect_time = time.perf_counter() + self.connect_delay
+            self.connect_delay = min(self.connect_delay * 2, self.connect_backoff[1])
+
+    # ====== RAM id cache ======
+
+    def load_cache(self):
+        if self.cache_file and os.path.exists(self.cache_file):
+            try:
+                with open(self.cache_file) as f:
+                    return json.load(f)
+            except Exception as e:
+                self.log.error("load cache {} failed: {}".format(self.cache_file, e))
+        return {}
+
+    def get_cache_key(self):
+        return "{}/{}".format(self.vebus.mk2_version, self.vebus.address)
+
+    def get_cached_ram_id(self):
+        return self.cache.get(self.get_cache_key(), {}).get('ess_setpoint_ram_id')
+
+    def set_cached_ram_id(self):
+        """
+        Store the ESS setpoint RAM id, the file is written only on change
+        """
+        entry = {'ess_setpoint_ram_id': self.vebus.ess_setpoint_ram_id}
+        if not self.cache_file or self.cache.get(self.get_cache_key()) == entry:
+            return
+        self.cache[self.get_cache_key()] = entry
+        try:
+            with open(self.cache_file + '.tmp', 'w') as f:
+                json.dump(self.cache, f, indent=2)
+            os.replace(self.cache_file + '.tmp', self.cache_file)
+        except Exception as e:
+            self.log.error("save cache {} failed: {}".format(self.cache_file, e))
+
+    def command(self, power, meter=None):
+        """
+        :param power: setpoint [W], +: charge  -: feed
+        :param meter: meterhub data with the phase grid power (devices 'grid_p')
+        """
+        self.set_phase_grid(meter)
+        if self.thread:
+            if self.command_event.is_set() and self.setpoint_time is not None:
+                self.coalesced += 1
+            self.setpoint = power  # replaces a setpoint not yet sent
+            self.setpoint_time = time.perf_counter()
+            self.command_event.set()
+        else:
+            self.execute(*self.next_command(power))
+
+    def execute(self, cmd, value):
+        """
+        Send a command of next_command() to the multiplus
+        """
+        if cmd == 'wakeup':
+            self.vebus.wakeup()
+        elif cmd == 'sleep':
+            self.vebus.sleep()
+        elif cmd == 'power':
+            t = time.perf_counter()
+            with timing.measure('mp2.set_power'):
+                if len(self.devices) > 1:
+                    ok = self.vebus.set_power_multi(self.split_power(value))
+                else:
+                    ok = self.vebus.set_power(value)  # send command to multiplus
+            self.set_power_time = time.perf_counter() - t
+            self.set_power_done(value, ok)
+
+    def set_phase_grid(self, meter):
+        if len(self.devices) > 1 and meter:
+            self.phase_grid_p = [meter.get(d['grid_p']) if d.get('grid_p') else None for d in self.devices]
+
+    def split_power(self, power):
+        """
+        Split the setpoint across the devices by the grid power of their phase. The phase consumption without the
+        multiplus (grid_p - device power) weights feed, the phase export weights charge. Equal shares without phase
+        grid power. A share above max_power is given to the other devices.
+
+        :param power: setpoint [W], +: charge  -: feed
+        :return: list of (address, ram id, power)
+        """
+        n = len(self.devices)
+        weights = [1] * n
+        grid = self.phase_grid_p
+        if grid and None not in grid:
+            demand = [g - p for g, p in zip(grid, self.device_power)]  # +: import
+            w = [max(d if power < 0 else -d, 0) for d in demand]
+            if sum(w):
+                weights = w
+        total = sum(weights)
+        shares = [power * w / total for w in weights]
+
+        for _ in range(n):  # limit to max_power, the excess goes to devices below their limit
+            excess = 0
+            free = []
+            for i, device in enumerate(self.devices):
+                max_power = device.get('max_power')
+                if max_power is not None and abs(shares[i]) > max_power:
+                    excess += shares[i] - math.copysign(max_power, shares[i])
+                    shares[i] = math.copysign(max_power, shares[i])
+                elif max_power is None or abs(shares[i]) < max_power:
+                    free.append(i)
+            if not excess or not free:
+                break
+            for i in free:
+                shares[i] += excess / len(free)
+
+        self.device_power = [round(p) for p in shares]
+        return [(d['address'], d['ram_id'], p) for d, p in zip(self.devices, self.device_power)]
+
+    def set_power_done(self, power, ok):
+        """
+        Track the written setpoint, a failed write is repeated in the next cycle
+        """
+        self.power_sent += 1
+        if ok:
+            self.sent_power = power
+            self.sent_time = time.perf_counter()
+        else:
+            self.sent_power = None
+
+    def is_power_due(self, power, t):
+        """
+        Transmission policy
+
+        :param power: setpoint
+        :param t: actual time
+        :return: True if the setpoint has to be sent
+        """
+        if self.sent_power is not None and self.sent_power != 0 and t - self.sent_time > self.watchdog:
+            self.watchdog_lapses += 1
+            self.log.warning("setpoint {}W not refreshed for {:.1f}s".format(self.sent_power, t - self.sent_time))
+            self.sent_power = None
+        if self.sent_power is None or not self.keepalive or t - self.sent_time >= self.keepalive:
+            return True
+        if power == 0 or self.sent_power == 0:
+            return power != self.sent_power  # start and stop are sent at once
+        if abs(power - self.sent_power) > self.deadband:
+            return True
+        self.power_skipped += 1
+        return False
+
+    def next_command(self, power):
+        """
+        Decide which command is sent to the multiplus in this cycle
+
+        :param power: power setpoint
+        :return: ('wakeup', None), ('sleep', None), ('power', value) or (None, None)
+        """
+        cmd = (None, None)
         if self.online:
             t = time.perf_counter()
             if self._wakeup and not self.cmd_lock_time:
                 self.cmd_lock_time = t + 3  # lock command for 3 seconds
                 self._wakeup = False
-                self.vebus.wakeup()
                 self.log.info("wakeup")
+                cmd = ('wakeup', None)
             elif self._sleep and not self.cmd_lock_time:
                 self.cmd_lock_time = t + 3  # lock command for 3 seconds
                 self._sleep = False
-                self.vebus.sleep()
                 self.log.info("sleep")
+                cmd = ('sleep', None)
             else:
                 if abs(power) >= 1:
                     if self.power_delay_time is None:
                         self.log.info("set_power start {}".format(power))
-                    self.log.debug("set_power {}".format(power))
-                    self.vebus.set_power(power)  # send command to multiplus
+                    if self.is_power_due(power, t):
+                        self.log.debug("set_power {}".format(power))
+                        cmd = ('power', power)
                     self.power_delay_time = t + 5  # send zero for 5seconds after last value >= 1
                 elif self.power_delay_time:
-                    self.vebus.set_power(0)
+                    if self.is_power_due(0, t):
+                        cmd = ('power', 0)
                     if t > self.power_delay_time:
                         self.power_delay_time = None
+                        self.sent_power = None  # no setpoint, next start is sent at once
                         self.log.debug("set_power zero trailing timer end")
 
             # reset command lock timer
             if self.cmd_lock_time and t > self.cmd_lock_time:
                 self.cmd_lock_time = None
+        return cmd
 
     def update(self, pause_time=0.1):
         """
@@ -85,44 +369,165 @@ class MultiPlus2:
         :param pause_time: pause time between commands
         :return: dictionary
         """
+        self.pause_time = pause_time
+        if self.thread:
+            return  # read by worker thread
+
         if not self.online:
-            self.connect()
+            if self.connect_due():
+                self.connecting = True
+                threading.Thread(target=self.try_connect, daemon=True).start()  # the cycle continues while connecting
+        else:
+            self.read_all(time.sleep)
+
+        self.check_timeout()
+
+    def update_steps(self):
+        """
+        Requests of a complete read. get_led() is skipped while an appended LED status is fresh.
+
+        :return: (list of (timing name, function), LED status or None)
+        """
+        led = self.vebus.get_led_status(self.led_max_age)
+        if self.pipeline:
+            steps = [('mp2.ac_info', self.vebus.get_ac_info_batch)]  # snapshot request + ac info
+            if led:
+                steps.append(('mp2.snapshot', self.vebus.read_snapshot))
+            else:
+                steps.append(('mp2.snapshot_led', self.vebus.read_snapshot_led))
+        else:
+            steps = [('mp2.snapshot_request', self.vebus.send_snapshot_request),  # no response
+                     ('mp2.ac_info', self.vebus.get_ac_info),
+                     ('mp2.snapshot', self.vebus.read_snapshot)]
+            if not led:
+                steps.append(('mp2.led', self.vebus.get_led))
+        return steps, led
+
+    def add_part(self, parts, name, part):
+        """
+        Collect the result of a step
+
+        :return: False if the step failed
+        """
+        if name == 'mp2.snapshot_request':
+            return True  # no response
+        parts.extend(part if isinstance(part, tuple) else (part,))
+        return all(parts)
 
+    def read_all(self, pause):
+        """
+        Read all information, set data if complete
+
+        :param pause: function(duration) between the requests
+        """
+        self.vebus.link.cycle()  # link statistics per update interval
+        steps, led = self.update_steps()
+        parts = []
+        for n, (name, func) in enumerate(steps):
+            if n:
+                pause(self.pause_time)
+            with timing.measure(name):
+                part = func()
+            if not self.add_part(parts, name, part):
+                return
+        self.set_data(*parts, self.vebus.led_status if led else {})  # latest appended LED status
+
+    def set_data(self, *parts):
+        """
+        Merge the parts of a complete read, evaluate the state and publish as self.data
+
+        :param parts: dictionaries (ac info, snapshot, led)
+        """
+        data = {}
+        for part in parts:
+            data.update(part)
+        led = data.get('led_light', 0) + data.get('led_blink', 0)
+        state = data.get('device_state_id', None)
+        if state == 2:
+            data['state'] = 'sleep'
+        elif led & 0x40:
+            data['state'] = 'low_bat'
+        elif led & 0x80:
+            data['state'] = 'temperature'
+        elif led & 0x20:
+            data['state'] = 'overload'
+        elif state == 8 or state == 9:
+            data['state'] = 'on'
+        elif state == 4:
+            data['state'] = 'wait'
         else:
-            self.vebus.send_snapshot_request()  # trigger snapshot
-            time.sleep(pause_time)
-            part1 = self.vebus.get_ac_info()  # read ac infos and append to data dictionary
-            time.sleep(pause_time)
-            if part1:
-                part2 = self.vebus.read_snapshot()  # read snapshot infos and append to data dictionary
-                time.sleep(pause_time)
-                if part2:
-                    part3 = self.vebus.get_led()  # read led infos and append to data dictionary
-                    if part3:
-                        data = {}
-                        data.update(part1)
-                        data.update(part2)
-                        data.update(part3)
-                        led = data.get('led_light', 0) + data.get('led_blink', 0)
-                        state = data.get('device_state_id', None)
-                        if state == 2:
-                            data['state'] = 'sleep'
-                        elif led & 0x40:
-                            data['state'] = 'low_bat'
-                        elif led & 0x80:
-                            data['state'] = 'temperature'
-                        elif led & 0x20:
-                            data['state'] = 'overload'
-                        elif state == 8 or state == 9:
-                            data['state'] = 'on'
-                        elif state == 4:
-                            data['state'] = 'wait'
-                        else:
-                            data['state'] = '?{}?0x{:02X}?'.format(state, led)
-
-                        self.data = data
-                        self.data_timeout = time.perf_counter() + self.timeout  # reset data timeout with valid rx
+            data['state'] = '?{}?0x{:02X}?'.format(state, led)
+
+        data['timestamp'] = round(time.time(), 3)
+        self.data = data
+        self.data_timeout = time.perf_counter() + self.timeout  # reset data timeout with valid rx
 
+    def check_timeout(self):
         if time.perf_counter() > self.data_timeout:
             self.online = False
             self.data = {'error': 'offline', 'state': 'offline'}
+
+    # ====== Worker thread ======
+
+    def run(self):
+        """
+        Worker thread, owns the VE.Bus
+        """
+        while True:
+            try:
+                if not self.online:
+                    if self.connect_due():
+                        self.connecting = True
+                        self.try_connect()
+                    if not self.online:
+                        self.pause(min(max(self.connect_time - time.perf_counter(), 0.1), 1))
+                else:
+                    t = time.perf_counter()
+                    self.bus_credit = 0
+                    self.read_all(self.pause)
+                    self.pause(self.update_interval - (time.perf_counter() - t), credit=True)
+                self.check_timeout()
+            except Exception as e:
+                self.log.exception("worker: {}".format(e))
+                time.sleep(1)
+
+    def pause(self, duration, credit=False):
+        """
+        Wait for duration, a posted command is sent at once
+
+        :param credit: shorten the wait by the bus time of skipped setpoints (bus_credit), telemetry is read earlier
+        """
+        tout = time.perf_counter() + duration
+        while True:
+            remaining = tout - time.perf_counter() - (self.bus_credit if credit else 0)
+            if not self.command_event.wait(max(remaining, 0)):
+                return
+            self.command_event.clear()
+            setpoint_time = self.setpoint_time
+            self.setpoint_time = None
+            skipped = self.power_skipped
+            self.execute(*self.next_command(self.setpoint))
+            if self.power_skipped > skipped:
+                self.bus_credit += self.set_power_time  # skipped by the transmission policy
+            if setpoint_time is not None:
+                timing.add('mp2.command_latency', time.perf_counter() - setpoint_time)
+            if remaining <= 0:
+                return
+
+    def get_state(self):
+        """
+        :return: dictionary with worker statistics
+        """
+        return {'thread': self.thread is not None,
+                'online': self.online,
+                'coalesced': self.coalesced,
+                'setpoint': self.setpoint,
+                'sent_power': self.sent_power,
+                'sent_age': round(time.perf_counter() - self.sent_time, 3) if self.sent_time else None,
+                'power_sent': self.power_sent,
+                'power_skipped': self.power_skipped,
+                'watchdog_lapses': self.watchdog_lapses,
+                'connect_attempts': self.connect_attempts,
+                'warm_connects': self.warm_connects,
+                'connect_delay': self.connect_delay if not self.online else None,
+                'device_power': self.device_power if len(self.devices) > 1 else None}
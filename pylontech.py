@@ -1,4 +1,5 @@
 import struct
+from binascii import unhexlify
 from config import config
 
 """
@@ -8,6 +9,13 @@ Packet and Framehandling. See demo_pylontech.py for a simple example.
 
 30.11.2022  Martin Steppuhn     Split in pylontech.py (basic packets) and us2000.py (threaded service class)   
 31.12.2022  Martin Steppuhn     US3000 Quickhack
+
+The TX frames of the polled commands are built once per (address, cid2), see make_commands() and get_command().
+decode_frame() checks and decodes a received frame without intermediate strings.
+
+Bulk read: with the address ALL_PACKS (info 'FF' to the master at RS485 address 2) the firmware answers 0x42 and
+0x44 for all packs in one frame. After the DATAFLAG follows the number of packs instead of the address, then one
+block per pack with the layout of the single response. See read_analog_values() and read_alarm_infos().
 """
 
 
@@ -29,7 +37,7 @@ def read_analog_value(com, address, type='US2000'):
     :param address: Address 0, ...
     :return: Dictionary with values
     """
-    tx = encode_cmd(address + 2, 0x42, "{:02X}".format(address + 2).encode('utf-8'))
+    tx = get_command(address, 0x42)
     # print("TX:", tx)
     com.reset_input_buffer()
     com.write(tx)
@@ -72,16 +80,29 @@ def parse_analog_value(frame, type):
     :return: dictionary
     """
 
+    return parse_analog_block(frame, 8, type)[0]
+
+
+def parse_analog_block(frame, p, type):
+    """
+    Parser for the analog values of one pack, starting at the cell number
+
+    :param frame: bytes
+    :param p: position of the block
+    :param type: 'US2000', 'US3000' or 'US5000'
+    :return: (dictionary, position of the next block)
+    """
     if type == 'US5000':
         offs = 44
     else:
         offs = 42   # US2000 / US3000
 
     d = {}
-    p = 8
     cell_number = frame[p]  # US2000 = 15 Zellen
-    d['u_cell'] = struct.unpack_from(">HHHHHHHHHHHHHHH", frame, p + 1)
     temp_number = frame[p + 31]
+    if cell_number != CELLS or temp_number != TEMPS:
+        raise ValueError('analog block at {}: {} cells, {} temperatures'.format(p, cell_number, temp_number))
+    d['u_cell'] = struct.unpack_from(">HHHHHHHHHHHHHHH", frame, p + 1)
     temp = struct.unpack_from(">HHHHH", frame, p + 32)
     d['t'] = [(t - 2731) / 10 for t in temp]
     # Ampere, positive (charge), negative (discharge), with 100mA steps
@@ -89,17 +110,65 @@ def parse_analog_value(frame, type):
     d['i'] = current / 10
     d['u'] = voltage / 1000
 
+    p = p + offs + 11
     if id == 4:   # US3000 and US5000
-        p = p + offs + 11
         d['q'] = struct.unpack(">I", b'\x00' + frame[p:p+3])[0]
         p += 3
         d['q_total'] = struct.unpack(">I", b'\x00' + frame[p:p + 3])[0]
+        p += 3
     else:
         d['q'] = q1
         d['q_total'] = q1_total
 
     d['soc'] = round(100 * d['q'] / d['q_total'])
-    return d
+    return d, p
+
+
+def read_analog_values(com, type='US2000', timeout=None):
+    """
+    Read analog values of all packs with one request (bulk)
+
+    :param com: PySerial
+    :param timeout: receive timeout in seconds, None: timeout of the port
+    :return: list with a dictionary per pack
+    """
+    frame = read_frame(com, get_command(ALL_PACKS, 0x42), timeout)
+    return parse_packs(frame, lambda p: parse_analog_block(frame, p, type))
+
+
+def read_alarm_infos(com, timeout=None):
+    """
+    Read alarm status of all packs with one request (bulk)
+
+    :param com: PySerial
+    :param timeout: receive timeout in seconds, None: timeout of the port
+    :return: list with a dictionary per pack
+    """
+    frame = read_frame(com, get_command(ALL_PACKS, 0x44), timeout)
+    return parse_packs(frame, lambda p: parse_alarm_block(frame, p))
+
+
+def parse_packs(frame, parse_block):
+    """
+    Parser for a bulk response: DATAFLAG, number of packs, one block per pack
+
+    The blocks must fill the frame up to the checksum exactly, a short, long or misaligned frame raises ValueError.
+
+    :param frame: bytes
+    :param parse_block: function(position) --> (dictionary, position of the next block)
+    :return: list with a dictionary per pack
+    """
+    packs = []
+    p = 8
+    try:
+        for i in range(frame[7]):
+            d, p = parse_block(p)
+            packs.append(d)
+    except (IndexError, struct.error):
+        raise ValueError('bulk frame too short, {} packs, length={}'.format(frame[7], len(frame)))
+    if p != len(frame) - 2:  # checksum
+        raise ValueError('bulk frame misaligned, {} packs, end={}, length={}'.format(frame[7], p, len(frame)))
+    return packs
 
 
 def read_serial_number(com, address):
@@ -116,7 +185,7 @@ def read_serial_number(com, address):
     :param address: Address 0, ...
     :return: Dictionary with serial
     """
-    tx = encode_cmd(address + 2, 0x93, "{:02X}".format(address + 2).encode('utf-8'))
+    tx = get_command(address, 0x93)
     # print(tx)
     com.write(tx)  # send command to battery
     com.reset_input_buffer()  # clear receive buffer
@@ -147,7 +216,7 @@ def read_alarm_info(com, address):
     :param address: Address 0, ...
     :return: Dictionary with values
     """
-    tx = encode_cmd(address + 2, 0x44, "{:02X}".format(address + 2).encode('utf-8'))
+    tx = get_command(address, 0x44)
     # print("TX:", tx)
     com.reset_input_buffer()
     com.write(tx)
@@ -168,12 +237,24 @@ def parse_alarm_info(frame):
     :param frame: bytes
     :return: dictionary, 'ready'=True --> READY,  if 'error' is set --> FAILURE
     """
+    return parse_alarm_block(frame, 8)[0]
+
+
+def parse_alarm_block(frame, p):
+    """
+    Parser for the alarm info of one pack, starting at the cell number
+
+    :param frame: bytes
+    :param p: position of the block
+    :return: (dictionary, position of the next block)
+    """
     d = {}
-    p = 8
     cell_number = frame[p]  # US2000 = 15 Zellen
+    temp_number = frame[p + 1 + cell_number]
+    if cell_number != CELLS or temp_number != TEMPS:
+        raise ValueError('alarm block at {}: {} cells, {} temperatures'.format(p, cell_number, temp_number))
     d['u_cell'] = list(frame[p + 1:p + 1 + cell_number])  # bytes to list
     p = p + 1 + cell_number
-    temp_number = frame[p]
     d['t'] = list(frame[p + 1:p + 1 + temp_number])
     p = p + 1 + temp_number
     d['i_chg'], d['u_pack'], d['i_dis'] = struct.unpack_from(">BBB", frame, p)
@@ -182,7 +263,7 @@ def parse_alarm_info(frame):
     d['ready'] = True if (d['status'][1] & 0x04) else False
     if d['status'][0]:
         d['error'] = True
-    return d
+    return d, p + 5 + 1  # status and one byte extended status
 
 
 def read_manufacturer_info(com, address):
@@ -230,6 +311,31 @@ def read_manufacturer_info(com, address):
 
 # ====== Helpers ======
 
+def read_frame(com, tx, timeout=None):
+    """
+    Send a command frame and receive the response
+
+    :param com: PySerial
+    :param tx: command frame
+    :param timeout: receive timeout in seconds, None: timeout of the port
+    :return: frame in bytes
+    """
+    com.reset_input_buffer()
+    com.write(tx)
+    if timeout is None:
+        rx = com.read_until(b'\r')
+    else:
+        port_timeout, com.timeout = com.timeout, timeout
+        try:
+            rx = com.read_until(b'\r')
+        finally:
+            com.timeout = port_timeout
+    frame = decode_frame(rx)
+    if frame is None:
+        raise ValueError('receive failed dump={}'.format(rx))
+    return frame
+
+
 def get_frame_checksum(frame):
     """
     Calculate checksum for a given frame
@@ -237,13 +343,7 @@ def get_frame_checksum(frame):
     :param frame: ascii hex frame
     :return: checksum as interger
     """
-    checksum = 0
-    for b in frame:
-        checksum += b
-    checksum = ~checksum
-    checksum %= 0x10000
-    checksum += 1
-    return checksum
+    return (~sum(frame) % 0x10000) + 1
 
 
 def get_info_length(info):
@@ -290,18 +390,63 @@ def encode_cmd(addr, cid2, info=b''):
     return frame
 
 
+# TX frames of the polling commands {(address, cid2): frame}, filled by make_commands() or get_command()
+COMMANDS = {}
+
+ALL_PACKS = 0xFF  # address for a bulk read of all packs
+
+CELLS = 15  # cells per pack, checked in every block
+TEMPS = 5  # temperature sensors per pack
+
+
+def get_command(address, cid2):
+    """
+    Command frame for a pack, the info field is the RS485 address. Built once and taken from COMMANDS.
+
+    :param address: pack address 0, ... or ALL_PACKS (sent to the master with info 'FF')
+    :param cid2: cid2 code
+    :return: frame
+    """
+    frame = COMMANDS.get((address, cid2))
+    if frame is None:
+        if address == ALL_PACKS:
+            frame = encode_cmd(2, cid2, b'FF')
+        else:
+            frame = encode_cmd(address + 2, cid2, "{:02X}".format(address + 2).encode())
+        COMMANDS[(address, cid2)] = frame
+    return frame
+
+
+def make_commands(pack_number, cid2_list=(0x42, 0x44), bulk=False):
+    """
+    Build the command frames of all packs, called once when the poller starts
+
+    :param pack_number: number of packs
+    :param cid2_list: polled commands
+    :param bulk: add the frames for ALL_PACKS
+    :return: dictionary {(address, cid2): frame}
+    """
+    addresses = list(range(pack_number)) + ([ALL_PACKS] if bulk else [])
+    return {(address, cid2): get_command(address, cid2) for address in addresses for cid2 in cid2_list}
+
+
 def decode_frame(raw_frame):
     """
     Decode received frame, checksum is validated
 
+    The hex part is converted in one step (unhexlify), the checksum is added over the ASCII bytes (memoryview, no copy)
+    and compared with the last two decoded bytes.
+
     :param raw_frame: Raw ASCII Hex frame
-    :return: frame in bytes
+    :return: frame in bytes (checksum included) or None
     """
-    if len(raw_frame) >= 18 and raw_frame[0] == ord('~') and raw_frame[-1] == ord('\r') and len(raw_frame) % 2 == 0:
-        frame_chk = int(raw_frame[-5:-1], 16)  # hex encoded checksum from received frame
-        calc_chk = get_frame_checksum(raw_frame[1:-5])  # calculated checksum from data
-        # print(frame_chk, calc_chk)
-        if frame_chk == calc_chk:
-            frame = bytes.fromhex(raw_frame[1:-1].decode("utf-8"))  # hex --> bytes
+    n = len(raw_frame)
+    if n >= 18 and not n & 1 and raw_frame[0] == 0x7E and raw_frame[-1] == 0x0D:  # '~' ... '\r'
+        raw = memoryview(raw_frame)
+        try:
+            frame = unhexlify(raw[1:-1])  # hex --> bytes
+        except ValueError:  # binascii.Error, no hex digit
+            return None
+        if (frame[-2] << 8 | frame[-1]) == (~sum(raw[1:-5]) % 0x10000) + 1:
             return frame
     return None
@@ -0,0 +1,128 @@
+import logging
+import threading
+
+import timer
+from utils import limit
+
+"""
+Setpoint regulator between the statemachine and MultiPlus2.command()
+
+The statemachine calculates the target power from one meter sample (pv_p, home_all_p). The regulator takes this
+target as feed-forward and adds a PI correction on the measured grid power. The output follows with an asymmetric
+slew rate: a smaller magnitude (less charge or less feed) is set fast, a higher magnitude slowly. A load step then
+does not lead to a charge from the grid or to an overshooting feed.
+
+    output = slew(ff_gain * target + kp * e + ki * integral(e))      e = grid_target - grid_p
+
+    charge: grid_target = -charge_reserve_power     (export the reserve)
+    feed:   grid_target = +feed_reserve_power       (import the reserve)
+
+The tracking error |e| is integrated while regulating and given as grid W·s per hour.
+Outside of charge and feed the target is passed through and the integrator is reset.
+
+update() runs in the fast loop (thread), get_state() is read by the supervisory loop and the web server. The state
+is changed and read under a lock, a reader never gets a mix of two steps.
+"""
+
+
+class Regulator:
+    def __init__(self, slew_up=800, slew_down=None, kp=0.0, ki=0.0, ff_gain=1.0, i_limit=300, log_name='regulator'):
+        """
+        :param slew_up: maximum rise of the magnitude [W/s], None: unlimited
+        :param slew_down: maximum fall of the magnitude [W/s], None: unlimited
+        :param kp: proportional gain on grid error [W/W]
+        :param ki: integral gain on grid error [W/(W·s)]
+        :param ff_gain: gain of the statemachine target (feed-forward)
+        :param i_limit: limit of the integral part [W]
+        :param log_name: name for logger
+        """
+        self.log = logging.getLogger(log_name)
+        self.slew_up = slew_up
+        self.slew_down = slew_down
+        self.kp = kp
+        self.ki = ki
+        self.ff_gain = ff_gain
+        self.i_limit = i_limit
+
+        self.p = 0  # output [W], +: charge  -: feed
+        self.target = 0  # target of the statemachine [W]
+        self.i = 0  # integral part [W]
+        self.error = None  # last grid error [W]
+        self.t = None  # time of the last update
+
+        self.error_ws = 0  # integrated |grid error| while regulating [W·s]
+        self.regulated_time = 0  # [s]
+        self.lock = threading.RLock()
+
+    def reset(self, p=0):
+        with self.lock:
+            self.p = p
+            self.i = 0
+            self.error = None
+
+    def update(self, target, grid_p=None, grid_target=0, p_min=None, p_max=None, active=True):
+        """
+        Regulator step, called once per cycle
+
+        :param target: power from the statemachine [W], +: charge  -: feed
+        :param grid_p: measured grid power [W], None: no correction
+        :param grid_target: grid power to regulate to [W]
+        :param p_min: lowest output [W]
+        :param p_max: highest output [W]
+        :param active: False: pass through the target and reset
+        :return: output power [W]
+        """
+        with self.lock:
+            t = timer.clock()
+            dt = t - self.t if self.t is not None else 0
+            self.t = t
+            self.target = target
+
+            if not active:
+                self.reset(target)
+                return self.p
+
+            p = self.ff_gain * target
+            if grid_p is not None:
+                self.error = grid_target - grid_p
+                self.error_ws += abs(self.error) * dt
+                self.regulated_time += dt
+                p += self.kp * self.error
+                i = limit(self.i + self.ki * self.error * dt, -self.i_limit, self.i_limit)
+                if p_min is None or p_max is None or p_min <= p + i <= p_max or abs(i) < abs(self.i):
+                    self.i = i  # anti windup, no integration into the limit
+                p += self.i
+
+            if p_min is not None and p_max is not None:
+                p = limit(p, p_min, p_max)
+
+            # slew rate on the magnitude
+            if dt:
+                if p * self.p < 0:
+                    p = 0  # change of sign, fall to 0 first
+                rate = self.slew_up if abs(p) > abs(self.p) else self.slew_down
+                if rate is not None:
+                    p = limit(p, self.p - rate * dt, self.p + rate * dt)
+
+            self.p = p
+            return round(self.p)
+
+    def get_tracking_error(self):
+        """
+        :return: grid error [W·s] per hour of regulation
+        """
+        with self.lock:
+            return self.error_ws * 3600 / self.regulated_time if self.regulated_time else None
+
+    def get_state(self):
+        """
+        :return: dictionary
+        """
+        with self.lock:
+            tracking = self.get_tracking_error()
+            return {'p': round(self.p),
+                    'target': round(self.target),
+                    'i': round(self.i),
+                    'error': round(self.error) if self.error is not None else None,
+                    'tracking_ws_h': round(tracking) if tracking is not None else None,
+                    'regulated_time': round(self.regulated_time)}
@@ -0,0 +1,381 @@
+import argparse
+import csv
+import json
+import logging
+import sys
+import time
+from datetime import datetime
+
+import timer
+from bms import BMS
+from config import config
+from utils import dictget
+
+"""
+Replay of recorded data through the ESS statemachine
+
+Blackbox dumps (blackbox-*.jsonl, one /api/state dataset per cycle) and the daily CSV files of the csv_log are read
+back. The recorded meterhub, BMS and Multiplus values are fed cycle by cycle to App.control(), the timers run on the
+time of the recording. The setpoints and state transitions the controller would have produced are written as CSV.
+
+    python3 replay.py log/blackbox-2022-11-21\ 144132.jsonl
+    python3 replay.py log/2022-11-*.csv --set charge_reserve_power=100 --out replay.csv
+
+The replay is open loop: the devices do not react to the replayed setpoints, Multiplus sleep/wakeup are only listed
+as events. CSV files contain only the configured columns, the meterhub values (grid_p, pv_p, home_all_p) are
+needed for a meaningful replay.
+"""
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+class ReplayMeterhub:
+    """
+    Replacement for ApiRequest, data is set by the replay
+    """
+
+    def __init__(self):
+        self.data = None
+
+    def read(self, post=None):
+        return self.data
+
+
+class ReplayBMS(BMS):
+    """
+    BMS with recorded state
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.state = {}
+        self.detail = {}
+
+    def load(self, state, detail=None):
+        """
+        :param state: recorded dictionary of BMS.get_state()
+        :param detail: recorded dictionary of BMS.get_detail()
+        """
+        state = dict(state) if state else {}
+        pack_soc = [s for s in state.get('pack_soc', []) if s is not None]
+        if state.get('soc') is None and pack_soc:  # CSV: only pack values
+            state['soc'] = sum(pack_soc) / len(pack_soc)
+        if state.get('soc_low') is None and pack_soc:
+            state['soc_low'] = min(pack_soc)
+        if state.get('soc_high') is None and pack_soc:
+            state['soc_high'] = max(pack_soc)
+        pack_u = [u for u in state.get('pack_u', []) if u is not None]
+        if state.get('u') is None and pack_u:
+            state['u'] = max(pack_u)
+
+        self.state = state
+        self.detail = detail if detail else {}
+        self.publish(error=state.get('error'), voltage=state.get('u'), current=state.get('i'),
+                     temperature=state.get('t'), soc=state.get('soc'), soc_low=state.get('soc_low'),
+                     soc_high=state.get('soc_high'))
+
+    def update(self):
+        pass
+
+    def get_state(self):
+        return self.state
+
+    def get_detail(self):
+        return self.detail
+
+
+class ReplayMultiPlus:
+    """
+    Replacement for MultiPlus2, data is set by the replay. Commands are collected as events.
+    """
+
+    def __init__(self):
+        self.data = None
+        self.events = []
+
+    def sleep(self):
+        self.events.append('sleep')
+
+    def wakeup(self):
+        self.events.append('wakeup')
+
+    def command(self, power, meter=None):
+        pass
+
+    def update(self, pause_time=0):
+        pass
+
+
+class ReplayBlackbox:
+    """
+    Replacement for Blackbox, nothing is written
+    """
+
+    def __init__(self):
+        self.dump_count = 0
+
+    def push(self, dataset, line=None):
+        pass
+
+    def dump(self, prefix='blackbox'):
+        self.dump_count += 1
+
+
+def read_blackbox(filename):
+    """
+    Read a blackbox dump
+
+    :param filename: blackbox-*.jsonl
+    :return: generator of datasets (/api/state)
+    """
+    with open(filename) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_csv(filename, columns=None):
+    """
+    Read a daily CSV file of the csv_log. The columns are mapped back to the dataset by the routes in config.
+
+    :param filename: YYYY-MM-DD.csv
+    :param columns: csv_log columns, default config['csv_log']['columns']
+    :return: generator of datasets (/api/state), only the recorded columns are set
+    """
+    if columns is None:
+        columns = config['csv_log']['columns']
+    routes = {col[0]: col[1:] for col in columns}
+    with open(filename, newline='') as f:
+        for row in csv.DictReader(f, delimiter=';'):
+            dataset = {'ess': {}, 'meterhub': {}, 'bms': {}, 'multiplus': {}}
+            for name, value in row.items():
+                route = routes.get(name)
+                if route is None or value is None:
+                    continue
+                set_route(dataset, route, parse_value(value))
+            yield dataset
+
+
+def parse_value(s):
+    if s == '':
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        return float(s)
+    except ValueError:
+        return s
+
+
+def set_route(dataset, route, value):
+    """
+    Set value in nested dictionaries/lists, counterpart of dictget(). Lists are extended as needed.
+    """
+    d = dataset
+    for key, next_key in zip(route[:-1], route[1:]):
+        if isinstance(d, list):
+            d.extend([None] * (key + 1 - len(d)))
+        if isinstance(d, dict) and key not in d or isinstance(d, list) and d[key] is None:
+            d[key] = [] if isinstance(next_key, int) else {}
+        d = d[key]
+    key = route[-1]
+    if isinstance(d, list):
+        d.extend([None] * (key + 1 - len(d)))
+    d[key] = value
+
+
+def read_records(filenames):
+    """
+    :param filenames: list of .jsonl and .csv files, played in the given order
+    :return: generator of datasets
+    """
+    for filename in filenames:
+        if filename.endswith('.csv'):
+            yield from read_csv(filename)
+        else:
+            yield from read_blackbox(filename)
+
+
+class Replay:
+    def __init__(self, mode=None, setting=None, period=0.75):
+        """
+        :param mode: operation mode ('off', 'auto', 'manual'), None: recorded mode or 'auto'
+        :param setting: index of the user setting, None: recorded setting or 0
+        :param period: cycle time of the recording, used for records within the same second
+        """
+        self.log = logging.getLogger('replay')
+        self.mode = mode
+        self.setting = setting
+        self.period = period
+        self.t = 0  # virtual time [s]
+        self.meterhub = ReplayMeterhub()
+        self.bms = ReplayBMS()
+        self.multiplus = ReplayMultiPlus()
+        self.blackbox = ReplayBlackbox()
+
+        timer.set_clock(self.clock)
+        from app import App  # App imports the runtime modules, keep replay.py importable without them
+        self.app = App(meterhub=self.meterhub, bms=self.bms, multiplus=self.multiplus, blackbox=self.blackbox,
+                       web=False)
+
+    def clock(self):
+        return self.t
+
+    def step(self, record):
+        """
+        Run one control cycle with recorded data
+
+        :param record: dataset (/api/state)
+        :return: dictionary with time, replayed and recorded state/setpoint, regulator output and the multiplus events
+        """
+        recorded_time = dictget(record, ('ess', 'time'))
+        try:
+            t = datetime.strptime(recorded_time, TIME_FORMAT).timestamp()
+            # the time has a resolution of 1s, cycles within the same second are spread by the period
+            self.t = max(t, self.t + self.period) if self.t and t - self.t < 1 else t
+        except (TypeError, ValueError):
+            self.t += self.period
+
+        self.meterhub.data = record.get('meterhub')
+        self.bms.load(record.get('bms'), record.get('bms_detail'))
+        multiplus = record.get('multiplus')
+        if multiplus is not None and 'error' not in multiplus:
+            multiplus = dict(multiplus)
+            multiplus.setdefault('state', 'on')  # not in CSV by default
+        self.multiplus.data = multiplus
+        self.multiplus.events = []
+
+        mode = self.mode if self.mode else dictget(record, ('ess', 'mode'), 'auto')
+        setting = self.setting if self.setting is not None else dictget(record, ('ess', 'setting'), 0)
+        self.app.mode = mode
+        self.app.setting = setting if setting < len(self.app.config['setting']) else 0
+
+        self.app.control()
+
+        return {'time': recorded_time,
+                'state': self.app._fsm_state,
+                'set_p': round(self.app.set_p),
+                'reg_p': round(self.app.reg_p),
+                'recorded_state': dictget(record, ('ess', 'state')),
+                'recorded_set_p': dictget(record, ('ess', 'set_p')),
+                'events': list(self.multiplus.events)}
+
+    def run(self, records, out=None):
+        """
+        Replay the records
+
+        :param records: iterable of datasets
+        :param out: file for the CSV output (one line per cycle), None: no output
+        :return: summary dictionary
+        """
+        columns = ('time', 'state', 'set_p', 'reg_p', 'recorded_state', 'recorded_set_p', 'events')
+        if out:
+            out.write(";".join(columns) + '\n')
+
+        summary = {'records': 0, 'transitions': [], 'state_time': {}, 'charge_wh': 0.0, 'feed_wh': 0.0,
+                   'recorded_charge_wh': 0.0, 'recorded_feed_wh': 0.0, 'set_p_differ': 0, 'events': 0}
+        t0 = time.perf_counter()
+        t_start = None
+        last = None  # (virtual time, row)
+        for record in records:
+            row = self.step(record)
+            if t_start is None:
+                t_start = self.t
+            if last:
+                self.integrate(summary, self.t - last[0], last[1])
+            if last is None or row['state'] != last[1]['state']:
+                summary['transitions'].append((row['time'], last[1]['state'] if last else None, row['state']))
+            if row['recorded_set_p'] is not None and row['set_p'] != round(row['recorded_set_p']):
+                summary['set_p_differ'] += 1
+            summary['events'] += len(row['events'])
+            summary['records'] += 1
+            if out:
+                out.write(";".join(['' if row[c] is None else str(row[c]) if c != 'events' else " ".join(row[c])
+                                    for c in columns]) + '\n')
+            last = (self.t, row)
+
+        if last:
+            self.integrate(summary, self.period, last[1])
+        summary['duration'] = self.t - t_start + self.period if t_start is not None else 0
+        summary['runtime'] = time.perf_counter() - t0
+        summary['blackbox_dumps'] = self.blackbox.dump_count
+        summary['tracking_ws_h'] = self.app.regulator.get_tracking_error()
+        return summary
+
+    def integrate(self, summary, dt, row):
+        """
+        Add the time in state and the energy of the setpoint (regulator output) held for dt
+        """
+        summary['state_time'][row['state']] = summary['state_time'].get(row['state'], 0) + dt
+        for p, charge, feed in ((row['reg_p'], 'charge_wh', 'feed_wh'),
+                                (row['recorded_set_p'], 'recorded_charge_wh', 'recorded_feed_wh')):
+            if p:
+                summary[charge if p > 0 else feed] += abs(p) * dt / 3600
+
+
+def apply_settings(items, setting=0):
+    """
+    Override config values, keys of the user settings are changed in the active setting
+
+    :param items: list of 'key=value', value as JSON (numbers, true/false) or string
+    :param setting: index of the active user setting
+    """
+    for item in items:
+        key, value = item.split('=', 1)
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+        if key in config['setting'][0]:
+            config['setting'][setting][key] = value
+        else:
+            config[key] = value
+
+
+def print_summary(summary, file=sys.stderr):
+    for t, old, new in summary['transitions']:
+        print("{}  {} -> {}".format(t, old, new), file=file)
+    print("records: {}  duration: {:.0f}s  runtime: {:.2f}s  ({:.0f}x)".format(
+        summary['records'], summary['duration'], summary['runtime'],
+        summary['duration'] / summary['runtime'] if summary['runtime'] else 0), file=file)
+    print("state time: {}".format(", ".join("{} {:.0f}s".format(k, v) for k, v in summary['state_time'].items())),
+          file=file)
+    print("charge: {:.0f} Wh (recorded {:.0f} Wh)  feed: {:.0f} Wh (recorded {:.0f} Wh)".format(
+        summary['charge_wh'], summary['recorded_charge_wh'], summary['feed_wh'], summary['recorded_feed_wh']),
+        file=file)
+    print("set_p differs in {} cycles, {} multiplus events, {} blackbox dumps".format(
+        summary['set_p_differ'], summary['events'], summary['blackbox_dumps']), file=file)
+    if summary['tracking_ws_h'] is not None:
+        print("regulator tracking error: {:.0f} Ws/h (recorded grid_p, open loop)".format(summary['tracking_ws_h']),
+              file=file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay blackbox/CSV recordings through the ESS statemachine")
+    parser.add_argument('files', nargs='+', help="blackbox-*.jsonl or YYYY-MM-DD.csv, played in the given order")
+    parser.add_argument('--out', help="CSV output of setpoints and states ('-': stdout)")
+    parser.add_argument('--mode', choices=('off', 'auto', 'manual'), help="operation mode instead of recorded mode")
+    parser.add_argument('--setting', type=int, help="user setting instead of recorded setting")
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help="override config value")
+    parser.add_argument('--period', type=float, default=config.get('cycle', {}).get('period', 0.75),
+                        help="cycle time of the recording [s]")
+    parser.add_argument('--debug', action='store_true', help="log of the statemachine")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.WARNING,
+                        format="%(name)-10s %(levelname)-8s %(message)s")
+
+    apply_settings(args.set, args.setting if args.setting is not None else 0)
+    replay = Replay(mode=args.mode, setting=args.setting, period=args.period)
+
+    out = None
+    if args.out == '-':
+        out = sys.stdout
+    elif args.out:
+        out = open(args.out, 'w')
+    summary = replay.run(read_records(args.files), out)
+    if out and out is not sys.stdout:
+        out.close()
+    print_summary(summary)
@@ -0,0 +1,164 @@
+import logging
+import time
+
+from timing import timing
+
+"""
+Cycle scheduler for the control loop
+
+The cycle runs on a fixed grid of deadlines (t0, t0 + period, t0 + 2 * period, ...). wait() sleeps exactly until the
+next deadline instead of polling. Each stage of a cycle is closed with mark(), its duration is checked against the
+configured budget. Overruns, skipped cycles and start jitter are counted and available with get_state(). Stage and
+cycle durations are also added to the latency statistics (timing.py).
+
+With wait(event) a cycle is started as soon as the event is set (e.g. new meter sample), not earlier than min_period
+after the start of the last cycle. The period is then the longest cycle time, the grid restarts with every trigger.
+
+    scheduler = CycleScheduler(period=0.75, budget={'meterhub': 0.1, 'multiplus': 0.4})
+    while True:
+        scheduler.begin()
+        ...
+        scheduler.mark('meterhub')
+        ...
+        scheduler.mark('multiplus')
+        scheduler.wait()
+"""
+
+
+class CycleScheduler:
+    def __init__(self, period=0.75, budget=None, min_period=0.2, name='cycle', log_name='cycle'):
+        """
+        :param period: cycle time in seconds
+        :param budget: dictionary with time budget in seconds per stage name, {'meterhub': 0.1, ...}
+        :param min_period: shortest cycle time with wait(event) in seconds
+        :param name: name of the cycle time in the latency statistics
+        :param log_name: name for logger
+        """
+        self.name = name
+        self.period = period
+        self.min_period = min_period
+        self.budget = budget if budget else {}
+        self.log = logging.getLogger(log_name)
+
+        self.deadline = None  # start time of the actual cycle on the deadline grid  (time.perf_counter())
+        self.t_begin = None  # real start time of the actual cycle
+        self.t_mark = None  # end time of the last stage
+
+        self.cycles = 0  # number of cycles
+        self.skipped = 0  # number of deadlines missed completely
+        self.triggered = 0  # number of cycles started by event
+        self.overrun = 0  # number of cycles longer than period
+        self.stage_overrun = {}  # number of budget overruns per stage
+        self.stage_time = {}  # last duration per stage
+        self.cycle_time = None  # duration of the last cycle (begin until wait)
+        self.cycle_time_max = 0
+        self.jitter = None  # start delay of the last cycle against the deadline
+        self.jitter_max = 0
+        self.jitter_sum = 0
+
+    def begin(self):
+        """
+        Start a cycle, must be called at the beginning of every cycle
+        """
+        t = time.perf_counter()
+        if self.deadline is None:
+            self.deadline = t  # first cycle defines the grid
+        self.t_begin = t
+        self.t_mark = t
+        self.cycles += 1
+
+        self.jitter = t - self.deadline
+        self.jitter_sum += self.jitter
+        self.jitter_max = max(self.jitter_max, self.jitter)
+
+    def mark(self, stage):
+        """
+        Close a stage. The time since the last mark (or begin) is checked against the budget of the stage.
+
+        :param stage: name of the stage
+        :return: duration of the stage in seconds
+        """
+        t = time.perf_counter()
+        dt = t - self.t_mark
+        self.t_mark = t
+        self.stage_time[stage] = dt
+        timing.add(stage, dt)
+
+        budget = self.budget.get(stage, None)
+        if budget is not None and dt > budget:
+            self.stage_overrun[stage] = self.stage_overrun.get(stage, 0) + 1
+            self.log.debug("stage {} overrun {:.3f}s (budget {:.3f}s)".format(stage, dt, budget))
+        return dt
+
+    def wait(self, event=None):
+        """
+        Finish the cycle and sleep until the next deadline
+
+        :param event: threading.Event, start the next cycle when set (but not before min_period)
+        """
+        timeout = self.finish()
+        if event is None:
+            time.sleep(timeout)
+            return
+
+        gap = self.t_begin + self.min_period - time.perf_counter()
+        if gap > 0:
+            time.sleep(gap)
+        if event.wait(max(self.deadline - time.perf_counter(), 0)):
+            event.clear()
+            self.triggered += 1
+            self.deadline = min(time.perf_counter(), self.deadline)  # restart grid, no jitter for triggered cycles
+
+    def finish(self):
+        """
+        Finish the cycle and calculate the next deadline. After an overrun the next cycle starts immediately (late,
+        seen as jitter). Deadlines which have passed completely are counted as skipped.
+
+        :return: time to sleep until the next deadline in seconds
+        """
+        t = time.perf_counter()
+        self.cycle_time = t - self.t_begin
+        self.cycle_time_max = max(self.cycle_time_max, self.cycle_time)
+        timing.add(self.name, self.cycle_time)
+
+        self.deadline += self.period
+        if t > self.deadline:
+            self.overrun += 1
+            missed = int((t - self.deadline) / self.period)  # complete periods already in the past
+            self.skipped += missed
+            self.deadline += missed * self.period
+            self.log.debug("cycle overrun {:.3f}s, {} deadline(s) skipped".format(self.cycle_time, missed))
+
+        return max(self.deadline - time.perf_counter(), 0)
+
+    def get_state(self):
+        """
+        Get scheduler statistics
+
+        :return: dictionary
+        """
+        return {
+            'period': self.period,
+            'cycles': self.cycles,
+            'overrun': self.overrun,
+            'skipped': self.skipped,
+            'triggered': self.triggered,
+            'cycle_time': self.cycle_time,
+            'cycle_time_max': self.cycle_time_max,
+            'jitter': self.jitter,
+            'jitter_max': self.jitter_max,
+            'jitter_avg': self.jitter_sum / self.cycles if self.cycles else None,
+            'stage_time': dict(self.stage_time),
+            'stage_budget': dict(self.budget),
+            'stage_overrun': dict(self.stage_overrun),
+        }
+
+
+if __name__ == "__main__":
+    scheduler = CycleScheduler(period=0.2, budget={'work': 0.05})
+    for n in range(20):
+        scheduler.begin()
+        time.sleep(0.03 if n % 5 else 0.3)  # overrun every 5th cycle
+        scheduler.mark('work')
+        scheduler.wait()
+    print(scheduler.get_state())
@@ -0,0 +1,19 @@
+"""
+Hardware-free device simulation
+
+    PtyDevice       base class, pseudo terminal with a receive thread, the slave path is used as serial port
+    MultiplusSim    Multiplus-II with MK3 interface (VE.Bus, MK2 frames)
+    PylontechSim    Pylontech US2000/US3000 stack (RS485 ASCII hex frames)
+    MeterhubSim     meterhub HTTP API with PV and load model
+    Battery         battery model shared by the Multiplus and the Pylontech simulation
+
+The real drivers are used unchanged, only the ports and the meterhub address are redirected. See sim/__main__.py:
+
+    python -m sim
+"""
+
+from sim.model import Battery
+from sim.pty_device import PtyDevice
+from sim.multiplus import MultiplusSim
+from sim.pylontech import PylontechSim
+from sim.meterhub import MeterhubSim
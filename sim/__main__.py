@@ -0,0 +1,74 @@
+"""
+Run the ESS application with simulated devices
+
+    python -m sim [--pv 4000] [--day 600] [--packs 2] [--soc 50] [--fast] [--runtime asyncio]
+
+The Multiplus and the Pylontech stack are connected by pseudo terminals, the meterhub is served on localhost.
+config.py is used, only the ports and the meterhub address are replaced.
+"""
+
+import argparse
+import logging
+import os
+
+from config import config
+from sim import Battery, MeterhubSim, MultiplusSim, PylontechSim
+
+parser = argparse.ArgumentParser(description="ESS with simulated devices")
+parser.add_argument('--pv', type=float, default=4000, help="PV peak power [W]")
+parser.add_argument('--day', type=float, default=600, help="length of a simulated day [s]")
+parser.add_argument('--load', type=float, default=300, help="base load [W]")
+parser.add_argument('--packs', type=int, default=2, help="number of Pylontech packs")
+parser.add_argument('--no-bulk', action='store_true', help="Pylontech without bulk read of all packs")
+parser.add_argument('--soc', type=float, default=50, help="initial soc [%%]")
+parser.add_argument('--meterhub-port', type=int, default=0, help="HTTP port of the meterhub (0: free port)")
+parser.add_argument('--http-port', type=int, default=config['http_port'], help="HTTP port of the ESS webserver")
+parser.add_argument('--stream', choices=('udp', 'sse'), help="meter data pushed by the meterhub (meter_stream.py)")
+parser.add_argument('--udp-port', type=int, default=8009, help="UDP port for --stream udp")
+parser.add_argument('--pipeline', action='store_true', help="batched VE.Bus transactions (config mp2_pipeline)")
+parser.add_argument('--mp2-thread', action='store_true', help="VE.Bus worker thread (config mp2_thread)")
+parser.add_argument('--led-appended', action='store_true', help="multiplus appends the LED status to responses")
+parser.add_argument('--fast-loop', type=float, help="period of the fast setpoint loop [s] (config fast_loop)")
+parser.add_argument('--phases', type=int, default=1, choices=(1, 3), help="three-phase system (config mp2_devices)")
+parser.add_argument('--fast', action='store_true', help="no emulation of 2400 baud and device latency")
+parser.add_argument('--runtime', default=config.get('runtime', 'thread'), help="'thread' or 'asyncio'")
+parser.add_argument('--debug', action='store_true')
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO,
+                    format="%(asctime)s %(name)-14s %(levelname)-8s %(message)s",
+                    datefmt='%Y-%m-%d %H:%M:%S')
+logging.getLogger('vebus').setLevel(logging.ERROR)
+logging.getLogger('meterhub').setLevel(logging.ERROR)
+
+battery = Battery(capacity=2400 * args.packs, soc=args.soc)
+multiplus = MultiplusSim(battery, baudrate=None if args.fast else 2400, latency=0 if args.fast else 0.02,
+                         append_led=args.led_appended, devices=args.phases)
+pylontech = PylontechSim(battery, pack_number=args.packs, latency=0 if args.fast else 0.01, bulk=not args.no_bulk)
+meterhub = MeterhubSim(battery, port=args.meterhub_port, pv_peak=args.pv, day=args.day, load_base=args.load,
+                       udp_port=args.udp_port if args.stream == 'udp' else None,
+                       phase_power=multiplus.get_phase_power if args.phases > 1 else None)
+
+config['victron_mk3_port'] = multiplus.port
+config.pop('bms_us5000', None)
+config['bms_us2000'] = dict(config.get('bms_us2000', {}), port=pylontech.port, pack_number=args.packs)
+config['meterhub_address'] = meterhub.address
+config['http_port'] = args.http_port
+if args.stream:
+    config['meterhub_stream'] = {'mode': args.stream, 'port': args.udp_port}
+config['runtime'] = args.runtime
+if args.pipeline:
+    config['mp2_pipeline'] = True
+if args.mp2_thread:
+    config['mp2_thread'] = True
+if args.fast_loop:
+    config['fast_loop'] = dict(config.get('fast_loop', {}), period=args.fast_loop)
+if args.phases > 1:
+    config['mp2_devices'] = [{'address': n, 'phase': n + 1, 'grid_p': 'grid_l{}_p'.format(n + 1), 'max_power': 2400}
+                             for n in range(args.phases)]
+config['log_path'] = os.path.join(config['log_path'], 'sim')
+
+from app import App  # import after the config is patched
+
+app = App()
+app.start()
@@ -0,0 +1,147 @@
+import json
+import logging
+import math
+import random
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sim.model import Battery
+
+"""
+meterhub HTTP API (JSON) with a simple PV and load model
+
+PV follows a sine over a configurable day length, the load is a base load with random steps (e.g. cooking, washing
+machine). The grid power results from PV, load and the actual battery power of the shared battery model:
+
+    grid_p = home_all_p + bat_p - pv_p
+
+With phase_power (function, battery power per phase) the phase values grid_l1_p ... are added. The load is unbalanced
+(LOAD_SHARE), PV is symmetric.
+
+The data is also pushed every push_interval: Server-Sent Events at /stream and optionally UDP datagrams to udp_port
+(see meter_stream.py).
+"""
+
+
+LOAD_SHARE = (0.5, 0.3, 0.2)  # load per phase
+
+
+class MeterhubSim:
+    def __init__(self, battery=None, host='127.0.0.1', port=8008, pv_peak=4000, day=600, load_base=300,
+                 load_step=2000, load_change=20, noise=20, push_interval=0.25, udp_port=None, phase_power=None):
+        """
+        :param battery: Battery model (shared with the Multiplus simulation)
+        :param host: bind address
+        :param port: HTTP port
+        :param pv_peak: PV peak power [W]
+        :param day: length of a simulated day in seconds (PV sine)
+        :param load_base: base load [W]
+        :param load_step: maximum additional load of a random step [W]
+        :param load_change: mean time between load changes [s]
+        :param noise: measurement noise [W]
+        :param push_interval: interval of pushed data (SSE, UDP) in seconds
+        :param udp_port: send UDP datagrams to this port on localhost, None: no UDP
+        :param phase_power: function, battery power per phase [W], None: no phase values
+        """
+        self.log = logging.getLogger('sim.meterhub')
+        self.battery = battery if battery else Battery()
+        self.pv_peak = pv_peak
+        self.day = day
+        self.load_base = load_base
+        self.load_step = load_step
+        self.load_change = load_change
+        self.noise = noise
+        self.t0 = time.perf_counter()
+        self.load = load_base
+        self.load_time = self.t0
+        self.post = None  # last posted data (bat_info, bat_soc)
+        self.request_count = 0
+        self.push_interval = push_interval
+        self.udp_port = udp_port
+        self.phase_power = phase_power
+
+        sim = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == '/stream':
+                    self.stream()
+                else:
+                    self.answer()
+
+            def stream(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                try:
+                    while True:
+                        self.wfile.write("data: {}\n\n".format(json.dumps(sim.get_data())).encode())
+                        self.wfile.flush()
+                        time.sleep(sim.push_interval)
+                except OSError:
+                    pass  # client disconnected
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                try:
+                    sim.post = json.loads(body)
+                except Exception:
+                    pass
+                self.answer()
+
+            def answer(self):
+                content = json.dumps(sim.get_data()).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.address = 'http://{}:{}'.format(host, self.server.server_address[1])
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        if udp_port:
+            threading.Thread(target=self.run_udp, daemon=True).start()
+        self.log.info("started at {}".format(self.address))
+
+    def run_udp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        while True:
+            sock.sendto(json.dumps(self.get_data()).encode(), ('127.0.0.1', self.udp_port))
+            time.sleep(self.push_interval)
+
+    def get_data(self):
+        """
+        Actual meter values
+
+        :return: dictionary like the meterhub API
+        """
+        self.request_count += 1
+        t = time.perf_counter()
+        phase = ((t - self.t0) % self.day) / self.day  # 0 ... 1 (sunrise ... next sunrise)
+        pv = max(math.sin(2 * math.pi * phase), 0) * self.pv_peak
+
+        if t > self.load_time:
+            self.load = self.load_base + random.choice((0, 0, random.random() * self.load_step))
+            self.load_time = t + random.expovariate(1 / self.load_change)
+
+        home = self.load + random.gauss(0, self.noise)
+        bat = self.battery.power
+        data = {'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+                'grid_p': round(home + bat - pv),
+                'pv_p': round(pv),
+                'bat_p': round(bat),
+                'home_all_p': round(home),
+                'home_p': round(home),
+                'car_p': 0}
+        if self.phase_power:
+            powers = self.phase_power()
+            for n, (share, p) in enumerate(zip(LOAD_SHARE, powers)):
+                data['grid_l{}_p'.format(n + 1)] = round(home * share + p - pv / len(powers))
+        return data
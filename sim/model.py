@@ -0,0 +1,60 @@
+import threading
+import time
+
+
+class Battery:
+    """
+    Simple battery model: energy counter, voltage depending on soc and current, thread safe
+    """
+
+    def __init__(self, capacity=4800, soc=50, cells=15):
+        """
+        :param capacity: capacity in Wh
+        :param soc: initial soc in %
+        :param cells: number of cells in series
+        """
+        self.capacity = capacity
+        self.energy = capacity * soc / 100
+        self.cells = cells
+        self.power = 0  # actual power [W], +: charge  -: discharge
+        self.lock = threading.Lock()
+        self.t = time.perf_counter()
+
+    def set_power(self, power):
+        """
+        Integrate the energy with the previous power and set the new power
+
+        :param power: power in W, +: charge  -: discharge
+        """
+        with self.lock:
+            t = time.perf_counter()
+            self.energy += self.power * (t - self.t) / 3600
+            self.energy = min(max(self.energy, 0), self.capacity)
+            self.t = t
+            self.power = power
+
+    @property
+    def soc(self):
+        return 100 * self.energy / self.capacity
+
+    @property
+    def cell_voltage(self):
+        """
+        Open circuit voltage of LiFePO4 (flat in the middle) plus internal resistance
+        """
+        soc = self.soc
+        if soc < 10:
+            u = 3.00 + 0.020 * soc
+        elif soc > 90:
+            u = 3.33 + 0.010 * (soc - 90)
+        else:
+            u = 3.20 + 0.13 * (soc - 10) / 80
+        return u + self.current * 0.0005
+
+    @property
+    def voltage(self):
+        return self.cell_voltage * self.cells
+
+    @property
+    def current(self):
+        return self.power / (self.cells * 3.25)  # nominal voltage, avoids recursion with the voltage
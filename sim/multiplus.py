@@ -0,0 +1,195 @@
+import struct
+import time
+
+from sim.model import Battery
+from sim.pty_device import PtyDevice
+
+"""
+Multiplus-II with MK3-USB interface
+
+Answers the MK2 frames used by vebus.py:
+
+    'V'                     version
+    'A' 01 <addr>           set device address
+    'F' 06 <ids>            RAM snapshot request (no response)
+    'F' 01..03              AC L1..L3 info
+    'L'                     LED status
+    'X' 30 <ramid>          read RAM var (assistant scan)
+    'X' 36 <ramid>          RAM var info (scale, offset)
+    'X' 37 <flags> <id> <v> write via id (ESS setpoint)
+    'X' 38                  read snapshot
+    05 3F 04/07 ...         sleep / wakeup (raw frame, no response)
+
+With append_led the LED status is appended to the responses (MSB of <Length> set, see vebus.py).
+With devices > 1 a three-phase system is simulated, one device per phase at address 0, 1, 2 with its own ESS setpoint.
+RAM vars are given for the selected device, the battery is shared.
+"""
+
+RAM_ASSISTANTS = {128: 0x0090, 129: 0x8800, 130: 0x0054, 131: 0, 132: 0, 133: 0, 134: 0, 135: 0x00A1}
+ESS_SETPOINT_RAM_ID = 131
+# RAM var info (scale, offset), scale < 0: signed, |scale| >= 0x4000: 1 / (0x8000 - |scale|)
+RAM_INFO = {0: (0x8000 - 100, 0), 2: (0x8000 - 100, 0), 4: (0x8000 - 100, 0), 5: (-(0x8000 - 10), 0),
+            9: (-(0x8000 - 10), 0), 13: (0x8000 - 2, 0), 14: (-1, 0), 15: (-1, 0), 16: (-1, 0)}
+
+
+class MultiplusSim(PtyDevice):
+    def __init__(self, battery=None, max_power=2400, ramp=2000, version=1170212, baudrate=2400, latency=0.02,
+                 append_led=False, devices=1):
+        """
+        :param battery: Battery model (shared with the Pylontech simulation)
+        :param max_power: maximum inverter/charger power [W]
+        :param ramp: power change rate [W/s]
+        :param version: MK2 version number
+        :param baudrate: emulated baudrate, None for maximum speed
+        :param latency: reaction time of the MK3 in seconds
+        :param append_led: append the LED status to the responses
+        :param devices: number of devices (phases)
+        """
+        self.battery = battery if battery else Battery()
+        self.max_power = max_power
+        self.ramp = ramp
+        self.version = version
+        self.append_led = append_led
+        self.address = None
+        self.devices = devices
+        self.setpoints = [0] * devices  # ESS setpoint per device [W], +: charge  -: feed
+        self.powers = [0] * devices  # actual power per device [W]
+        self.power = 0  # actual power of all devices [W], +: charge  -: feed
+        self.sleep = False
+        self.snapshot_ids = []
+        self.snapshot = []
+        self.t = time.perf_counter()
+        self.rx = bytes()
+        self.frame_count = {}
+        super().__init__(baudrate=baudrate, latency=latency, log_name='sim.multiplus')
+
+    def handle(self, data):
+        self.rx += data
+        while len(self.rx) >= 2:
+            flen = (self.rx[0] & 0x7F) + 2
+            if self.rx[1] not in (0xFF, 0x3F):
+                self.rx = self.rx[1:]  # resync
+                continue
+            if len(self.rx) < flen:
+                break
+            frame, self.rx = self.rx[:flen], self.rx[flen:]
+            if frame[1] == 0x3F:
+                self.raw_command(frame)
+            elif sum(frame) & 0xFF:
+                self.log.error("checksum error {}".format(frame.hex()))
+            else:
+                self.command(chr(frame[2]), frame[3:-1])
+
+    def raw_command(self, frame):
+        if frame[2] == 0x04:
+            self.log.info("sleep")
+            self.sleep = True
+            self.setpoints = [0] * self.devices
+        elif frame[2] == 0x07:
+            self.log.info("wakeup")
+            self.sleep = False
+
+    def command(self, cmd, data):
+        self.frame_count[cmd] = self.frame_count.get(cmd, 0) + 1
+        self.update()
+        if cmd == 'V':
+            self.reply(0xFF, b'V' + struct.pack("<IB", self.version, ord('B')))
+        elif cmd == 'A' and data[0] == 0x01:
+            if data[1] < self.devices:  # no response from a missing device
+                self.address = data[1]
+                self.reply(0xFF, b'A' + bytes(data[:2]))
+        elif cmd == 'F' and data[0] == 0x06:
+            self.snapshot_ids = list(data[1:7])
+            self.snapshot = [self.ram_value(i) for i in self.snapshot_ids]
+        elif cmd == 'F' and 1 <= data[0] <= self.devices:
+            self.reply(0x20, self.ac_info(data[0]))
+        elif cmd == 'L':
+            led_light, led_blink = self.led()
+            self.reply(0xFF, b'L' + bytes((led_light, led_blink, 0, 0, 0x80, 0)))
+        elif cmd == 'X' and data[0] == 0x30:
+            ramid = data[1] + data[2] * 256
+            self.reply(0xFF, b'X' + struct.pack("<BHH", 0x85, RAM_ASSISTANTS.get(ramid, 0), 0))
+        elif cmd == 'X' and data[0] == 0x36:
+            ramid = data[1] + data[2] * 256
+            self.reply(0xFF, b'X' + struct.pack("<Bhh", 0x8E, *RAM_INFO.get(ramid, (1, 0))))
+        elif cmd == 'X' and data[0] == 0x37:
+            flags, ramid, value = struct.unpack("<BBh", data[1:5])
+            if ramid == ESS_SETPOINT_RAM_ID and not self.sleep:
+                self.setpoints[self.address or 0] = max(min(-value, self.max_power), -self.max_power)
+            self.reply(0xFF, b'X' + bytes((0x87,)))
+        elif cmd == 'X' and data[0] == 0x38:
+            self.reply(0xFF, b'X' + bytes((0x99,)) + b''.join(struct.pack("<H", v & 0xFFFF) for v in self.snapshot))
+        else:
+            self.log.error("unknown command {} {}".format(cmd, bytes(data).hex()))
+
+    def reply(self, marker, payload):
+        if self.append_led and marker == 0xFF and payload[:1] not in (b'L', b'V'):
+            frame = bytes((len(payload) + 3 | 0x80, marker)) + payload + bytes(self.led())
+        else:
+            frame = bytes((len(payload) + 1, marker)) + payload
+        self.send(frame + bytes(((256 - sum(frame)) & 0xFF,)))
+
+    def update(self):
+        """
+        Move the actual power with the ramp to the setpoint and update the battery
+        """
+        t = time.perf_counter()
+        step = self.ramp * (t - self.t)
+        self.t = t
+        for n, setpoint in enumerate(self.setpoints):
+            target = 0 if self.sleep else setpoint
+            if self.battery.soc <= 0 and target < 0 or self.battery.soc >= 100 and target > 0:
+                target = 0
+            self.powers[n] += max(min(target - self.powers[n], step), -step)
+        self.power = sum(self.powers)
+        self.battery.set_power(self.power)
+
+    def device_state(self):
+        if self.sleep:
+            return 2  # off
+        return 9 if self.power > 0 else 8  # charge, bypass
+
+    def ram_value(self, ramid):
+        """
+        Raw RAM variable, scaling see RAM_INFO
+        """
+        if ramid == 0 or ramid == 2:
+            return 23000
+        elif ramid == 4:
+            return round(self.battery.voltage * 100)
+        elif ramid == 5:
+            return round(self.battery.current * 10)
+        elif ramid == 13:
+            return round(self.battery.soc * 2)
+        power = self.powers[self.address or 0]
+        if ramid == 14:
+            return round(power)
+        elif ramid == 15:
+            return round(-power)
+        elif ramid == 16:
+            return round(-power)
+        elif ramid == 9:
+            return round(-power / 23)
+        return 0
+
+    def ac_info(self, phase=1):
+        mains_u = 23000
+        inv_i = round(self.powers[phase - 1] / 230 * 100)
+        phase_info = {1: 0x08 if self.devices == 1 else 0x0A, 2: 0x07, 3: 0x06}[phase]
+        return struct.pack("<BBBBBhhhhB", 1, 1, 1, self.device_state(), phase_info, mains_u, 0, mains_u, inv_i, 195)
+
+    def get_phase_power(self):
+        return list(self.powers)
+
+    def led(self):
+        if self.sleep:
+            return 0x00, 0x00
+        led_light = 0x01  # mains
+        led_blink = 0x00
+        if self.power > 0:
+            led_light |= 0x04  # bulk
+        elif self.power < 0:
+            led_light |= 0x10  # inverter
+        if self.battery.soc <= 0:
+            led_blink |= 0x40  # low battery
+        return led_light, led_blink
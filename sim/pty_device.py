@@ -0,0 +1,66 @@
+import logging
+import os
+import threading
+import time
+import tty
+
+
+class PtyDevice:
+    """
+    Device simulation behind a pseudo terminal. The driver opens self.port like a real serial port. Received bytes are
+    passed to handle(), the answer is written with send(). With baudrate set, the transmission time on the wire is
+    emulated.
+    """
+
+    def __init__(self, baudrate=None, latency=0.0, log_name='sim'):
+        """
+        :param baudrate: emulated baudrate for transmission delay, None: no delay
+        :param latency: reaction time of the device in seconds
+        :param log_name: name for logger
+        """
+        self.log = logging.getLogger(log_name)
+        self.baudrate = baudrate
+        self.latency = latency
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)  # no line processing (\r --> \n)
+        self.port = os.ttyname(self.slave)
+        self.rx_bytes = 0
+        self.tx_bytes = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.log.info("started at {}".format(self.port))
+
+    def run(self):
+        while True:
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                time.sleep(0.1)  # no open slave
+                continue
+            self.rx_bytes += len(data)
+            if self.baudrate:
+                time.sleep(len(data) * 10 / self.baudrate)
+            try:
+                self.handle(data)
+            except Exception:
+                self.log.exception("handle failed")
+
+    def send(self, data):
+        """
+        Send data to the driver
+
+        :param data: bytes
+        """
+        delay = self.latency + (len(data) * 10 / self.baudrate if self.baudrate else 0)
+        if delay:
+            time.sleep(delay)
+        self.tx_bytes += len(data)
+        os.write(self.master, data)
+
+    def handle(self, data):
+        """
+        Process received bytes, must be implemented by the simulation
+
+        :param data: bytes
+        """
+        raise NotImplementedError
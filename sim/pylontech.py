@@ -0,0 +1,93 @@
+import random
+import struct
+
+from pylontech import decode_frame, get_frame_checksum, get_info_length
+from sim.model import Battery
+from sim.pty_device import PtyDevice
+
+"""
+Pylontech US2000 stack
+
+Answers the command frames built by pylontech.encode_cmd():
+
+    0x42    analog value
+    0x44    alarm info
+    0x93    serial number
+
+0x42 and 0x44 with info 0xFF to the master (address 2) are answered for all packs in one frame (bulk=True).
+The packs share the current of the battery model, every pack gets a small individual offset for soc and cells.
+"""
+
+
+class PylontechSim(PtyDevice):
+    def __init__(self, battery=None, pack_number=2, baudrate=None, latency=0.01, bulk=True):
+        """
+        :param battery: Battery model (shared with the Multiplus simulation)
+        :param pack_number: number of packs
+        :param bulk: answer the bulk requests, False: no response like older firmware
+        :param baudrate: emulated baudrate, None for maximum speed
+        :param latency: reaction time of the BMS in seconds
+        """
+        self.battery = battery if battery else Battery()
+        self.pack_number = pack_number
+        self.bulk = bulk
+        self.cycle = [100 + 37 * i for i in range(pack_number)]
+        self.cell_offset = [[random.randint(-4, 4) for c in range(15)] for i in range(pack_number)]
+        self.alarm = [0] * pack_number  # status[0] != 0 is an active error
+        self.rx = bytes()
+        self.frame_count = {}
+        super().__init__(baudrate=baudrate, latency=latency, log_name='sim.pylontech')
+
+    def handle(self, data):
+        self.rx += data
+        while b'\r' in self.rx:
+            p = self.rx.index(b'\r') + 1
+            raw, self.rx = self.rx[:p], self.rx[p:]
+            s = raw.find(b'~')
+            frame = decode_frame(raw[s:]) if s >= 0 else None
+            if frame is None:
+                self.log.error("invalid frame {}".format(raw))
+                continue
+            addr, cid2 = frame[1], frame[3]
+            self.frame_count[cid2] = self.frame_count.get(cid2, 0) + 1
+            pack = addr - 2
+            if len(frame) > 8 and frame[6] == 0xFF:  # bulk
+                if self.bulk and addr == 2 and cid2 in (0x42, 0x44):
+                    info = b''.join(self.info(i, cid2)[2:] for i in range(self.pack_number))
+                    self.reply(addr, bytes((0x10, self.pack_number)) + info)
+            elif 0 <= pack < self.pack_number:
+                info = self.info(pack, cid2)
+                if info is not None:
+                    self.reply(addr, info)
+
+    def info(self, pack, cid2):
+        if cid2 == 0x42:
+            return self.analog_value(pack)
+        elif cid2 == 0x44:
+            return self.alarm_info(pack)
+        elif cid2 == 0x93:
+            return bytes((pack + 2,)) + "HPTSIM{:010d}".format(pack).encode()
+        return None
+
+    def reply(self, addr, info):
+        info = info.hex().upper().encode()
+        inner = "{:02X}{:02X}{:02X}{:02X}{:04X}".format(0x20, addr, 0x46, 0x00, get_info_length(info)).encode()
+        inner += info
+        self.send(b'~' + inner + "{:04X}".format(get_frame_checksum(inner)).encode() + b'\r')
+
+    def analog_value(self, pack):
+        q_total = 50000  # mAh
+        soc = min(max(self.battery.soc + 2 * pack - (self.pack_number - 1), 0), 100)
+        u_cell = self.battery.cell_voltage * 1000
+        current = self.battery.current / self.pack_number
+        cells = [round(u_cell + o) for o in self.cell_offset[pack]]
+        temps = [round((t + 273.1) * 10) for t in (20.0 + pack, 18.5, 18.7, 18.4, 19.0)]
+        info = bytes((0x10, pack + 2, 15)) + struct.pack(">15H", *cells)
+        info += bytes((5,)) + struct.pack(">5H", *temps)
+        info += struct.pack(">hHHbHH", round(current * 10), round(u_cell * 15), round(q_total * soc / 100), 2, q_total,
+                            self.cycle[pack])
+        return info
+
+    def alarm_info(self, pack):
+        status = [self.alarm[pack], 0x0E, 0x00, 0x00, 0x00]
+        return bytes((0x10, pack + 2, 15)) + bytes(15) + bytes((5,)) + bytes(5) + bytes(3) + bytes(status) + bytes(1)
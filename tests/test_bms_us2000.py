@@ -0,0 +1,54 @@
+import pytest
+
+import bms_us2000
+from bms_us2000 import PollScheduler
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(bms_us2000.time, 'perf_counter', lambda: now[0])
+    return now
+
+
+def test_intervals():
+    poll = PollScheduler({'analog': {'fast': 0.25}}, max_interval=8)
+    assert poll.intervals['analog'] == {'fast': 0.25, 'normal': 1.0, 'slow': 5.0}
+    poll.set_hint('slow')
+    assert poll.get_interval('alarm') == 8  # limited to max_interval
+    poll.set_hint('unknown')
+    assert poll.hint == 'slow'
+
+
+def test_due(clock):
+    poll = PollScheduler()
+    kind, delay = poll.next()
+    assert delay <= 0  # all due at start
+    poll.done('analog', 100.0)
+    poll.done('alarm', 100.0)
+    assert poll.next() == ('analog', 1.0)
+    clock[0] = 101.0
+    poll.done('analog', 101.0)
+    assert poll.next() == ('analog', 1.0)
+    clock[0] = 101.5
+    assert poll.next() == ('analog', pytest.approx(0.5))
+
+
+def test_hint(clock):
+    poll = PollScheduler()
+    poll.done('analog', 100.0)
+    poll.done('alarm', 100.0)
+    poll.event.clear()
+    poll.set_hint('fast')
+    assert poll.event.is_set()
+    assert poll.next() == ('analog', 0.5)  # rescheduled from the last request
+    poll.set_hint('slow')
+    assert poll.due == {'analog': 105.0, 'alarm': 110.0}
+
+
+def test_trigger(clock):
+    poll = PollScheduler()
+    poll.done('analog', 100.0)
+    poll.done('alarm', 100.0)
+    poll.trigger('alarm')
+    assert poll.next() == ('alarm', -100.0) and poll.triggers == 1
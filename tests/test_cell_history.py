@@ -0,0 +1,68 @@
+import pytest
+
+import cell_history
+from cell_history import CellHistory
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Monotonic clock set by the test, the wall clock is 1000s ahead
+    """
+    now = [0.0]
+    monkeypatch.setattr(cell_history.time, 'monotonic', lambda: now[0])
+    monkeypatch.setattr(cell_history.time, 'time', lambda: now[0] + 1000)
+    return now
+
+
+def fill(history, n, pack=0, start=0):
+    for i in range(start, start + n):
+        u_cell = [3300 + c for c in range(15)]
+        u_cell[i % 14] = 3250  # lowest cell moves, highest is cell 14, spread 64mV
+        history.add(pack, u_cell, [20 + i / 360] * 5, now=float(i))  # +10°C/h
+
+
+def test_interval(clock):
+    history = CellHistory(1, interval=1, duration=10)
+    assert history.add(0, [3300] * 15, [20] * 5, now=0.0)
+    assert not history.add(0, [3300] * 15, [20] * 5, now=0.5)
+    assert history.add(0, [3300] * 15, [20] * 5, now=0.95)  # jitter of the poll time
+
+
+def test_window_wrap(clock):
+    history = CellHistory(1, interval=1, duration=10)
+    fill(history, 25)
+    clock[0] = 24.0
+    h, tm, u_cell, t, low, high, spread = history.get_window(0)
+    assert list(tm) == [float(i) for i in range(15, 25)]
+    assert len(u_cell) == 10 * 15 and len(t) == 10 * 5
+    assert set(low) == {3250} and set(high) == {3314} and set(spread) == {64}
+    assert list(history.get_window(0, 4.5)[1]) == [20.0, 21.0, 22.0, 23.0, 24.0]  # across the ring segments
+    assert list(history.get_window(0, 7.5)[1]) == [float(i) for i in range(17, 25)]
+    clock[0] = 100.0
+    assert len(history.get_window(0, 10)[1]) == 0
+
+
+def test_summary(clock):
+    history = CellHistory(2, interval=1, duration=3600)
+    fill(history, 3600)
+    clock[0] = 3599.0
+    s = history.get_summary(600)
+    assert s['packs'][1] is None
+    p = s['packs'][0]
+    assert p['samples'] == 601
+    assert p['time'] == [3999.0, 4599.0]  # wall time
+    assert p['spread'] == p['spread_max'] == 64
+    assert p['cell_min'] == 3250 and p['cell_min_index'] == 3599 % 14
+    assert p['cell_max'] == 3314 and p['cell_max_index'] == 14
+    assert p['t_trend'] == pytest.approx([10.0] * 5, abs=0.05)  # resolution 0.1°C
+
+
+def test_series(clock):
+    history = CellHistory(1, interval=1, duration=3600)
+    fill(history, 1000)
+    clock[0] = 999.0
+    s = history.get_series(0, None, points=100)
+    assert len(s['time']) == 100 and s['time'][0] == 1000.0
+    assert set(s['spread']) == {64} and len(s['t']) == 5
+    assert CellHistory(1).get_series(0)['time'] == []
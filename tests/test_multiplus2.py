@@ -0,0 +1,87 @@
+import pytest
+
+from multiplus2 import MultiPlus2
+
+DEVICES = [{'address': 0, 'phase': 1, 'grid_p': 'grid_l1_p', 'max_power': 2400},
+           {'address': 1, 'phase': 2, 'grid_p': 'grid_l2_p', 'max_power': 2400},
+           {'address': 2, 'phase': 3, 'grid_p': 'grid_l3_p', 'max_power': 2400}]
+
+
+@pytest.fixture
+def mp2():
+    mp2 = MultiPlus2(None, devices=DEVICES)
+    for d in mp2.devices:
+        d['ram_id'] = 131
+    mp2.vebus.address = 0
+    return mp2
+
+
+def responses(batch, missing=None):
+    """
+    Confirmations of a setpoint batch, the request with index missing is not answered
+    """
+    rx = []
+    for cmd, data, head in batch:
+        frame = bytes([4, 0xFF, 0x41, 0x01, data[1]]) if cmd == 'A' else bytes([5, 0xFF, 0x58, 0x87, 0, 0])
+        rx.append(None if len(rx) == missing else frame)
+    return rx
+
+
+def test_split_equal(mp2):
+    assert mp2.split_power(-3000) == [(0, 131, -1000), (1, 131, -1000), (2, 131, -1000)]
+    mp2.set_phase_grid({'grid_l1_p': 100})  # phase grid power incomplete
+    assert [p for a, r, p in mp2.split_power(900)] == [300, 300, 300]
+
+
+def test_split_by_phase(mp2):
+    mp2.set_phase_grid({'grid_l1_p': 1000, 'grid_l2_p': 500, 'grid_l3_p': 0})
+    assert [p for a, r, p in mp2.split_power(-1500)] == [-1000, -500, 0]  # feed weighted by consumption
+    mp2.device_power = [0, 0, 0]
+    mp2.set_phase_grid({'grid_l1_p': -600, 'grid_l2_p': -200, 'grid_l3_p': 300})
+    assert [p for a, r, p in mp2.split_power(800)] == [600, 200, 0]  # charge weighted by export
+
+
+def test_split_max_power(mp2):
+    mp2.set_phase_grid({'grid_l1_p': 4000, 'grid_l2_p': 500, 'grid_l3_p': 500})
+    shares = [p for a, r, p in mp2.split_power(-4500)]
+    assert shares[0] == -2400 and sum(shares) == -4500  # excess to the other devices
+    assert [p for a, r, p in mp2.split_power(-9000)] == [-2400, -2400, -2400]
+
+
+def test_set_power_batch(mp2):
+    batch = mp2.vebus.batch_set_power(mp2.split_power(-300))
+    assert [data[1] for cmd, data, head in batch if cmd == 'A'][-1] == 0  # actual address selected at the end
+    assert mp2.vebus.parse_set_power_multi(batch, responses(batch))
+    assert not mp2.vebus.parse_set_power_multi(batch, responses(batch)[:-1])
+    assert not mp2.vebus.parse_set_power_multi(batch, responses(batch, missing=3))
+
+
+def test_power_due_every_cycle():
+    mp2 = MultiPlus2(None)  # default: keepalive 0
+    mp2.set_power_done(500, True)
+    assert mp2.is_power_due(500, mp2.sent_time + 0.1)
+
+
+def test_power_due_deadband_keepalive():
+    mp2 = MultiPlus2(None, deadband=20, keepalive=5, watchdog=60)
+    assert mp2.is_power_due(500, 0)  # nothing sent
+    mp2.set_power_done(500, True)
+    t = mp2.sent_time
+    assert not mp2.is_power_due(519, t + 1)
+    assert mp2.power_skipped == 1
+    assert mp2.is_power_due(521, t + 1)  # change > deadband
+    assert mp2.is_power_due(500, t + 5)  # keepalive
+    assert mp2.is_power_due(0, t + 1)  # stop at once
+    mp2.set_power_done(0, True)
+    assert mp2.is_power_due(10, mp2.sent_time + 1)  # start at once
+    mp2.set_power_done(500, False)
+    assert mp2.is_power_due(500, mp2.sent_time + 1)  # failed write is repeated
+
+
+def test_power_due_watchdog():
+    mp2 = MultiPlus2(None, deadband=20, keepalive=100, watchdog=10)
+    assert mp2.keepalive == 5  # limited to watchdog / 2
+    mp2.set_power_done(500, True)
+    mp2.keepalive = 100  # without the limit, the setpoint lapses
+    assert mp2.is_power_due(500, mp2.sent_time + 11)
+    assert mp2.watchdog_lapses == 1
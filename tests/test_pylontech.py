@@ -0,0 +1,44 @@
+import pytest
+
+from pylontech import decode_frame, parse_alarm_block, parse_analog_block, parse_packs
+
+ANALOG = decode_frame(b'~20024600C06E10020F0C9A0C980C990C980C9A0C9A0C990C9B0C9C0C9A0C9B0C9B0C9B0C9B0C99050B740B550B570B53'
+                      b'0B630000BD06190F02C3500084E545\r')
+ALARM = decode_frame(b'~20024600A04210020F000000000000000000000000000000050000000000000000000E00000000F108\r')
+
+
+def bulk(frame, n, extra=b''):
+    """
+    Bulk frame with n copies of the block of a single response, the checksum is not checked by parse_packs()
+    """
+    return frame[:7] + bytes([n]) + frame[8:-2] * n + extra + frame[-2:]
+
+
+def test_analog_packs():
+    frame = bulk(ANALOG, 3)
+    packs = parse_packs(frame, lambda p: parse_analog_block(frame, p, 'US2000'))
+    assert len(packs) == 3
+    assert all(d['u'] == 48.39 and d['soc'] == 13 and d['u_cell'][0] == 3226 for d in packs)
+
+
+def test_alarm_packs():
+    frame = bulk(ALARM, 2)
+    packs = parse_packs(frame, lambda p: parse_alarm_block(frame, p))
+    assert [d['ready'] for d in packs] == [True, True]
+
+
+@pytest.mark.parametrize('frame', [bulk(ANALOG, 2, b'\x00'),  # too long
+                                   bulk(ANALOG, 2)[:-20] + ANALOG[-2:],  # too short
+                                   ANALOG[:7] + bytes([2]) + ANALOG[9:-2] * 2 + ANALOG[-2:]])  # misaligned
+def test_analog_rejected(frame):
+    with pytest.raises(ValueError):
+        parse_packs(frame, lambda p: parse_analog_block(frame, p, 'US2000'))
+
+
+def test_alarm_rejected():
+    frame = bulk(ALARM, 2, b'\x00\x00')
+    with pytest.raises(ValueError):
+        parse_packs(frame, lambda p: parse_alarm_block(frame, p))
+    frame = ALARM[:7] + bytes([2]) + ALARM[8:-3] * 2 + ALARM[-2:]  # block without the extended status
+    with pytest.raises(ValueError):
+        parse_packs(frame, lambda p: parse_alarm_block(frame, p))
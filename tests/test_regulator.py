@@ -0,0 +1,65 @@
+import pytest
+
+import timer
+from regulator import Regulator
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr(timer, 'clock', lambda: now[0])
+    return now
+
+
+def step(regulator, clock, dt, *args, **kwargs):
+    clock[0] += dt
+    return regulator.update(*args, **kwargs)
+
+
+def test_pass_through(clock):
+    r = Regulator(slew_up=100)
+    r.i = 50
+    assert step(r, clock, 1, 1500, active=False) == 1500
+    assert r.i == 0 and r.error is None
+
+
+def test_slew_asymmetric(clock):
+    r = Regulator(slew_up=800, slew_down=None)
+    step(r, clock, 0, 0)
+    assert step(r, clock, 1, 2000) == 800  # higher magnitude slowly
+    assert step(r, clock, 0.5, 2000) == 1200
+    assert step(r, clock, 1, 300) == 300  # lower magnitude at once
+    assert step(r, clock, 1, -2000) == 0  # change of sign, fall to 0 first
+    assert step(r, clock, 1, -2000) == -800
+
+
+def test_slew_down_limited(clock):
+    r = Regulator(slew_up=None, slew_down=500)
+    step(r, clock, 0, -2000)
+    assert step(r, clock, 1, 0) == -1500
+
+
+def test_pi_correction(clock):
+    r = Regulator(slew_up=None, slew_down=None, kp=0.5, ki=0.1, i_limit=1000)
+    step(r, clock, 0, 1000, -100, -200, 0, 3000)
+    p = step(r, clock, 1, 1000, 100, -200, 0, 3000)  # 300W import instead of 200W export
+    assert r.error == -300
+    assert p == round(1000 - 150 - 30)
+    assert r.get_tracking_error() == pytest.approx(300 * 3600 / 1)
+
+
+def test_anti_windup(clock):
+    r = Regulator(slew_up=None, slew_down=None, kp=0, ki=1, i_limit=1000)
+    step(r, clock, 0, 2000, 0, 0, 0, 2000)
+    for _ in range(5):
+        assert step(r, clock, 1, 2000, -500, 0, 0, 2000) == 2000  # export, output at p_max
+    assert r.i == 0  # no integration into the limit
+    assert step(r, clock, 1, 2000, 300, 0, 0, 2000) == 1700  # leaves the limit at once
+    assert r.i == -300
+
+
+def test_i_limit(clock):
+    r = Regulator(slew_up=None, slew_down=None, kp=0, ki=1, i_limit=200)
+    step(r, clock, 0, 1000)
+    step(r, clock, 1, 1000, 500)
+    assert step(r, clock, 1, 1000, 500) == 800
@@ -0,0 +1,65 @@
+import threading
+
+import pytest
+
+import scheduler
+from scheduler import CycleScheduler
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    Virtual clock, sleep() advances the time
+    """
+    now = [100.0]
+
+    def sleep(duration):
+        now[0] += duration
+
+    monkeypatch.setattr(scheduler.time, 'perf_counter', lambda: now[0])
+    monkeypatch.setattr(scheduler.time, 'sleep', sleep)
+    return now
+
+
+def test_grid(clock):
+    s = CycleScheduler(period=0.75, budget={'work': 0.1})
+    for n in range(3):
+        s.begin()
+        clock[0] += 0.2
+        s.mark('work')
+        s.wait()
+    assert clock[0] == pytest.approx(100 + 3 * 0.75)  # fixed grid, no drift
+    assert s.cycles == 3 and s.overrun == 0 and s.skipped == 0
+    assert s.jitter_max == pytest.approx(0)
+    assert s.stage_overrun == {'work': 3}
+    assert s.stage_time['work'] == pytest.approx(0.2)
+
+
+def test_overrun(clock):
+    s = CycleScheduler(period=0.75)
+    s.begin()
+    clock[0] += 1.0
+    assert s.finish() == 0  # next cycle at once
+    assert s.overrun == 1 and s.skipped == 0
+    s.begin()
+    assert s.jitter == pytest.approx(0.25)
+    clock[0] += 2.0
+    assert s.finish() == 0
+    assert s.overrun == 2 and s.skipped == 2  # deadlines passed completely
+    s.begin()
+    assert s.jitter == pytest.approx(0)  # back on the grid
+    clock[0] += 0.1
+    assert s.finish() == pytest.approx(0.65)
+
+
+def test_event(clock):
+    s = CycleScheduler(period=0.75, min_period=0.2)
+    event = threading.Event()
+    s.begin()
+    clock[0] += 0.05
+    event.set()
+    s.wait(event)
+    assert clock[0] == pytest.approx(100.2)  # not before min_period
+    assert s.triggered == 1 and not event.is_set()
+    s.begin()
+    assert s.jitter == pytest.approx(0)  # grid restarted
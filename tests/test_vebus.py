@@ -0,0 +1,41 @@
+from vebus import FrameParser
+
+
+def frame(*content):
+    """
+    MK2 frame: length, content (marker, command, data), checksum (sum of all bytes = 0)
+    """
+    f = bytes([len(content)]) + bytes(content)
+    return f + bytes([-sum(f) & 0xFF])
+
+
+A = frame(0xFF, 0x41, 0x01, 0x00)
+B = frame(0x20, 0x01, 0x01, 0x09, 0x08, 0xEC, 0x5A)
+
+
+def test_frames_split():
+    p = FrameParser()
+    p.feed(A + B[:3])
+    assert p.next_frame() == A
+    assert p.next_frame() is None  # incomplete
+    p.feed(B[3:])
+    assert p.next_frame() == B
+    assert p.next_frame() is None
+    assert p.frames == 2 and p.resync == 0
+
+
+def test_resync_garbage():
+    p = FrameParser()
+    p.feed(b'\x55\x00\x12' + A)
+    assert p.next_frame() == A
+    assert p.resync == 3 and p.checksum_errors == 0
+
+
+def test_checksum_error():
+    p = FrameParser()
+    bad = bytearray(A)
+    bad[3] ^= 0x01
+    p.feed(bytes(bad) + B)
+    assert p.next_frame() == B
+    assert p.checksum_errors >= 1 and p.resync == len(A)
+    assert p.get_state()['frames'] == 1
@@ -1,22 +1,34 @@
 import time
 
+clock = time.perf_counter  # time base of all timers, replaced by a virtual clock for replay (replay.py)
+
+
+def set_clock(func):
+    """
+    Set the time base of all timers
+
+    :param func: function returning the time in seconds, default time.perf_counter
+    """
+    global clock
+    clock = func
+
 
 class Timer:
     def __init__(self):
         self.event_time = None
 
     def start(self, duration):
-        self.event_time = time.perf_counter() + duration
+        self.event_time = clock() + duration
 
     def stop(self):
         self.event_time = None
 
     def is_expired(self):
-        return True if self.event_time is not None and time.perf_counter() >= self.event_time else False
+        return True if self.event_time is not None and clock() >= self.event_time else False
 
     def remaining(self):
         try:
-            return max(self.event_time - time.perf_counter(), 0)
+            return max(self.event_time - clock(), 0)
         except:
             return 0
 
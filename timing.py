@@ -0,0 +1,107 @@
+import time
+from collections import deque
+from contextlib import contextmanager
+
+"""
+Latency measurement for the stages of the control loop
+
+Every stage keeps the latest durations in a rolling window (fixed size, O(1) per sample). Percentiles are only
+calculated on request (/api/timing). The global instance is shared by all modules:
+
+    from timing import timing
+
+    with timing.measure('mp2.ac_info'):
+        ...
+
+    timing.add('meterhub', dt)
+"""
+
+
+class LatencyHistogram:
+    def __init__(self, size=1000):
+        """
+        :param size: number of samples in the rolling window
+        """
+        self.samples = deque(maxlen=size)
+        self.count = 0  # total number of samples
+        self.max = 0  # maximum of all samples
+
+    def add(self, dt):
+        self.samples.append(dt)
+        self.count += 1
+        if dt > self.max:
+            self.max = dt
+
+    def get_state(self):
+        """
+        Statistics of the rolling window in milliseconds
+
+        :return: dictionary
+        """
+        s = sorted(self.samples)
+        n = len(s)
+        if not n:
+            return {'count': self.count}
+
+        def percentile(p):
+            return round(s[min(int(p * n), n - 1)] * 1000, 2)
+
+        return {'count': self.count,
+                'last': round(self.samples[-1] * 1000, 2),
+                'p50': percentile(0.50),
+                'p95': percentile(0.95),
+                'p99': percentile(0.99),
+                'max': round(s[-1] * 1000, 2),
+                'max_total': round(self.max * 1000, 2)}
+
+
+class Timing:
+    def __init__(self, size=1000):
+        """
+        :param size: number of samples in the rolling window of each stage
+        """
+        self.size = size
+        self.stages = {}  # name: LatencyHistogram
+
+    def add(self, name, dt):
+        """
+        Add a duration
+
+        :param name: name of the stage
+        :param dt: duration in seconds
+        """
+        stage = self.stages.get(name, None)
+        if stage is None:
+            stage = self.stages.setdefault(name, LatencyHistogram(self.size))
+        stage.add(dt)
+
+    @contextmanager
+    def measure(self, name):
+        """
+        Measure the duration of a with block
+
+        :param name: name of the stage
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t0)
+
+    def get_state(self):
+        """
+        Statistics of all stages in milliseconds
+
+        :return: dictionary, {'stage': {'count': .., 'last': .., 'p50': .., 'p95': .., 'p99': .., 'max': ..}, ...}
+        """
+        return {name: stage.get_state() for name, stage in list(self.stages.items())}
+
+
+timing = Timing()  # global instance
+
+
+if __name__ == "__main__":
+    for n in range(200):
+        with timing.measure('sleep'):
+            time.sleep(0.001 if n % 50 else 0.02)
+    print(timing.get_state())
@@ -1,4 +1,5 @@
 import logging
+import math
 import struct
 import time
 
@@ -19,6 +20,18 @@ Frame:
 number of bytes, excluding the length and checksum, MSB of <Length> is a 1, then this frame has LED status appended
 checksum is one byte
 
+Every received frame passes dispatch(): an appended LED status (assumed as the last two bytes <LED on> <LED blink>
+before the checksum, counted in <Length>) is stored and removed, the frame is then given to the waiting request.
+Frames without a waiting request are unsolicited and handled by the handler for their command (add_handler()).
+
+Several devices (three-phase or parallel system) are addressed with init_address(). The ESS setpoints of all devices
+are written with one write (set_power_multi()), the AC info of all phases (self.phases) is requested together.
+
+RAM variables are read with a snapshot (up to 6 ids, read_ram_vars()). Scale and offset of every variable are requested
+once with the RAM var info command and cached per device address and MK2 version:
+
+    value = scale * (raw + offset)      scale < 0: signed variable,  |scale| >= 0x4000: scale = 1 / (0x8000 - |scale|)
+
 
 23.10.2022 Martin Steppuhn
 27.11.2022 Martin Steppuhn  receive_frame() with quick and dirty start search
@@ -26,17 +39,166 @@ checksum is one byte
 """
 
 
+class FrameParser:
+    """
+    Incremental parser for received MK2 frames
+
+    Received bytes are collected in a buffer for the life of the port. Frames are split by the length byte and are only
+    delivered with a valid checksum (sum of all bytes = 0). On an invalid start (marker is not 0xFF or 0x20) or a
+    checksum error one byte is dropped and the search restarts (resync).
+
+        parser.feed(serial.read(n))
+        frame = parser.next_frame()     # None if no complete frame
+    """
+
+    MARKERS = (0xFF, 0x20)  # 0xFF: response, 0x20: AC info
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.frames = 0  # valid frames
+        self.resync = 0  # dropped bytes
+        self.checksum_errors = 0
+        self.unexpected = 0  # valid frames not requested
+
+    def clear(self):
+        self.buffer.clear()
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_frame(self):
+        """
+        :return: next valid frame (bytes) or None
+        """
+        buf = self.buffer
+        while len(buf) >= 2:
+            flen = (buf[0] & 0x7F) + 2  # length + 0xFF/0x20 ... checksum
+            if buf[1] not in self.MARKERS or flen < 4:
+                del buf[0]
+                self.resync += 1
+                continue
+            if len(buf) < flen:
+                return None  # wait for more data
+            frame = bytes(buf[:flen])
+            if sum(frame) & 0xFF:
+                del buf[0]
+                self.resync += 1
+                self.checksum_errors += 1
+                continue
+            del buf[:flen]
+            self.frames += 1
+            return frame
+        return None
+
+    def get_state(self):
+        return {'frames': self.frames,
+                'resync': self.resync,
+                'checksum_errors': self.checksum_errors,
+                'unexpected': self.unexpected}
+
+
+class LinkStats:
+    """
+    Bytes on the wire of the MK3 link
+
+    Every write and every received chunk is counted with its time. A byte takes 10 bits (start, 8 data, stop) on the
+    wire. A TX chunk occupies the line from the write (or from the end of the previous transfer), a RX chunk before
+    its receive time. Gaps between these busy intervals longer than gap_min are idle gaps (pauses between requests,
+    reaction time of the device, time between updates). cycle() closes a measuring interval (one multiplus update).
+
+        utilization = wire time / elapsed time
+
+    See link_budget.py for the planned time of a cycle.
+    """
+
+    COUNTERS = ('tx_bytes', 'rx_bytes', 'tx_frames', 'rx_frames', 'wire_time', 'idle_gaps', 'idle_time')
+
+    def __init__(self, baudrate=2400, gap_min=0.005):
+        """
+        :param baudrate: baudrate of the link
+        :param gap_min: shorter gaps are not counted as idle in seconds
+        """
+        self.baudrate = baudrate
+        self.byte_time = 10 / baudrate
+        self.gap_min = gap_min
+        self.busy_end = None  # end of the last busy interval (time.perf_counter())
+        self.counters = dict.fromkeys(self.COUNTERS, 0)
+        self.mark = dict(self.counters)  # counters at the start of the interval
+        self.t_mark = time.perf_counter()
+        self.last_cycle = None
+
+    def add_tx(self, n, frames=1):
+        t = time.perf_counter()
+        self.add(max(t, self.busy_end) if self.busy_end is not None else t, n, 'tx', frames)
+
+    def add_rx(self, n):
+        if n:
+            self.add(time.perf_counter() - n * self.byte_time, n, 'rx', 0)
+
+    def add_rx_frame(self):
+        self.counters['rx_frames'] += 1
+
+    def add(self, start, n, direction, frames):
+        c = self.counters
+        duration = n * self.byte_time
+        if self.busy_end is not None and start - self.busy_end > self.gap_min:
+            c['idle_gaps'] += 1
+            c['idle_time'] += start - self.busy_end
+        self.busy_end = max(self.busy_end or start, start + duration)
+        c[direction + '_bytes'] += n
+        c[direction + '_frames'] += frames
+        c['wire_time'] += duration
+
+    def cycle(self):
+        """
+        Close the measuring interval
+
+        :return: dictionary with the counters of the interval, elapsed time and utilization
+        """
+        t = time.perf_counter()
+        r = {k: self.counters[k] - self.mark[k] for k in self.COUNTERS}
+        r['elapsed'] = t - self.t_mark
+        r['utilization'] = r['wire_time'] / r['elapsed'] if r['elapsed'] else None
+        self.mark = dict(self.counters)
+        self.t_mark = t
+        self.last_cycle = r
+        return r
+
+    def get_state(self):
+        """
+        :return: dictionary with the totals and the last interval (times in seconds)
+        """
+        return {'baudrate': self.baudrate,
+                'total': {k: round(v, 3) for k, v in self.counters.items()},
+                'cycle': {k: round(v, 3) for k, v in self.last_cycle.items() if v is not None}
+                if self.last_cycle else None}
+
+
 class VEBus:
     def __init__(self, port, log='vebus'):
         self.port = port
         self.ess_setpoint_ram_id = None  # RAM-ID for ESS Assistant  MP2 3000 = 131
+        self.mk2_version = None
+        self.address = None  # device address set by init_address()
+        self.phases = [1]  # phases of the AC info
+        self.snapshot_ids = list(self.SNAPSHOT_IDS)  # RAM ids read with every snapshot
+        self.ram_var_info = {}  # (address, mk2_version, ram id): (scale, offset, signed, digits)
         self.log = logging.getLogger(log)
         self.serial = None
+        self.parser = FrameParser()
+        self.link = LinkStats(baudrate=2400)
+        self.led_status = None  # LED status appended to a received frame  {'led_light': ..., 'led_blink': ...}
+        self.led_time = None  # receive time of led_status (time.perf_counter())
+        self.handlers = {}  # handler for unsolicited frames, command byte: function(frame)
+        self.unsolicited = {}  # number of unsolicited frames per command byte
+        self.broadcast_version = None  # version number sent unsolicited by the MK2/MK3
+        self.add_handler('V', self.on_version)
         self.open_port()
 
     def open_port(self):
+        self.parser.clear()
         try:
-            self.serial = serial.Serial(self.port, 2400, timeout=0)
+            self.serial = serial.Serial(self.port, 2400, timeout=0.05)  # read() returns with the first byte
         except Exception as e:
             self.serial = None
             self.log.error("open_port: {}".format(e))
@@ -59,41 +221,35 @@ class VEBus:
         try:
             self.send_frame('V', [])
             rx = self.receive_frame(b'\x07\xFF', timeout=0.5)
-            cmd, mk2_version = struct.unpack("<BI", rx[2:7])
-            self.log.info("mk2_version={}".format(mk2_version))
-            return mk2_version
+            return self.parse_version(rx)
         except IOError:
             self.serial = None
             self.log.error("serial port failed")
         except Exception as e:
             return None
 
-    def init_address(self):
+    def init_address(self, addr=0x00):
         """
         Init device address. With a single Multiplus on the bus the Address is 0x00
 
         011.883 TX: 04 FF 41 01 00 BB          A| 01 00          Device address: action=1 device=0
         011.925 RX: 04 FF 41 01 00 BB          A| 01 00          Device address: action=1 device=0
 
+        :param addr: device address, following requests (RAM vars, setpoint) are sent to this device
         :return: True/False
         """
         if self.serial is None:
             self.open_port()  # open port
 
-        addr = 0x00  # for addr in range(0, 3):
         try:
             self.send_frame('A', [0x01, addr])
             rx = self.receive_frame(b'\x04\xFF\x41')
-            if rx[4] == addr:  # check if correct answer and address
-                self.log.info("init_address {} successful".format(addr))
-                return True
-            else:
-                raise Exception("init_address failed")
+            return self.parse_init_address(rx, addr)
         except IOError:
             self.serial = None
             self.log.error("serial port failed")
         except Exception as e:
-            self.log.error("get_version: {}".format(e))
+            self.log.error("init_address {}: {}".format(addr, e))
         return False
 
     def get_led(self):
@@ -111,12 +267,7 @@ class VEBus:
         try:
             self.send_frame('L', [])
             rx = self.receive_frame(b'\x08\xFF\x4C', timeout=0.5)
-            led_light, led_blink = struct.unpack("<BB", rx[3:5])  # high=blink   low = light
-
-            led_info = self.make_led_names(led_light | led_blink)
-
-            self.log.info("led_light=0x{:02X} led_blink=0x{:02X}".format(led_light, led_blink))
-            return {'led_light': led_light, 'led_blink': led_blink, 'led_info': led_info}
+            return self.parse_led(rx)
         except IOError:
             self.serial = None
             self.log.error("serial port failed")
@@ -142,28 +293,19 @@ class VEBus:
                   : 03 FF 46 01 B7                                      F | 01             Info Request=1 AC L1 info
         009.374 RX: 0F 20 01 01 01 09 08 EC 5A 5F FF EC 5A 08 00 C3 08  !!! AC !!! {'bf_factor': 1, 'inverter_factor': 1, 'state': 'StateCharge', 'phase_info': 8, 'mains_voltage': 23276, 'mains_current': 65375, 'inverter_voltage': 23276, 'inverter_current': 8, 'mains_period': 195}
 
+        With more than one phase all phases are requested with one write.
+
         return: Dictionary or None
         """
         if self.serial is None:
             self.open_port()  # open port
 
         try:
+            if len(self.phases) > 1:
+                return self.parse_ac_phases(self.transact([('F', [phase], b'\x0F\x20') for phase in self.phases]))
             self.send_frame('F', [0x01])
             rx = self.receive_frame(b'\x0F\x20')
-            bf_factor, inv_factor, device_state_id, phase_info, mains_u, mains_i, inv_u, inv_i, mains_period = struct.unpack(
-                "<BBxBBhhhhB", rx[2:16])
-
-            device_state_name = {0: 'down', 1: 'startup', 2: 'off', 3: 'slave', 4: 'invert_full', 5: 'invert_half',
-                                 6: 'invert_aes', 7: 'power_assist', 8: 'bypass', 9: 'charge'}[device_state_id]
-
-            r = {'device_state_id': device_state_id,
-                 'device_state_name': device_state_name,
-                 'mains_u': round(mains_u / 100, 2),
-                 'mains_i': round(mains_i / 100, 2),
-                 'inv_u': round(inv_u / 100, 2),
-                 'inv_i': round(inv_i / 100, 2)}
-            self.log.info(r)
-            return r
+            return self.parse_ac_info(rx)
         except IOError:
             self.serial = None
             self.log.error("serial port failed")
@@ -188,8 +330,7 @@ class VEBus:
             self.open_port()  # open port
 
         try:
-            ids = [15, 16, 4, 5, 13]  # up to 6x
-            self.send_frame('F', [0x06] + ids)
+            self.send_frame('F', [0x06] + self.snapshot_ids)
         except IOError:
             self.serial = None
             self.log.error("serial port failed")
@@ -218,18 +359,8 @@ class VEBus:
 
         try:
             self.send_frame('X', [0x38])
-            frame = self.receive_frame(b'\x0D\xFF\x58')
-            if frame[3] != 0x99:
-                raise Exception('invalid response')
-            inv_p, out_p, bat_u, bat_i, soc = struct.unpack("<hhhhh", frame[4:4 + 5 * 2])
-            r = {'inv_p': -inv_p,
-                 'out_p': out_p,
-                 'bat_u': round(bat_u / 100, 2),
-                 'bat_i': round(bat_i / 10, 1),
-                 'bat_p': round(bat_u / 100 * bat_i / 10),
-                 'soc': round(soc / 2, 1)}
-            self.log.info("read_snapshot: {}".format(r))
-            return r
+            frame = self.receive_frame(self.snapshot_head(self.snapshot_ids))
+            return self.parse_snapshot(frame)
         except IOError:
             self.serial = None
             self.log.error("serial port failed")
@@ -253,14 +384,9 @@ class VEBus:
             self.open_port()  # open port
 
         try:
-            data = struct.pack("<BBBh", 0x37, 0x00, self.ess_setpoint_ram_id, -power)  # cmd, flags, id, power
-            self.send_frame('X', data)
+            self.send_frame('X', self.make_set_power(power))
             rx = self.receive_frame([b'\x05\xFF\x58', b'\x03\xFF\x58'])  # two different answers are possible
-            if rx[3] == 0x87:
-                self.log.info("set_ess_power to {}W done".format(power))
-                return True
-            else:
-                raise Exception("invalid response")
+            return self.parse_set_power(rx, power)
         except IOError:
             self.serial = None
             self.log.error("serial port failed")
@@ -292,17 +418,11 @@ class VEBus:
         ramid = 128
         for n in range(8):
             try:
-                data = struct.pack("<BH", 0x30, ramid)  # read ram id
-                self.send_frame('X', data)
+                self.send_frame('X', struct.pack("<BH", 0x30, ramid))  # read ram id
                 rx = self.receive_frame(b'\x07\xFF\x58')
-                ram = rx[4] + rx[5] * 256  # value at ramid
-                self.log.debug("scan_ess_assistant ramid={} value=0x{:04X}".format(ramid, ram))
-                if ram & 0xFFF0 == 0x0050:  # ESS Assistant
-                    self.log.info("found ess assistant at ramid={}".format(ramid))
-                    self.ess_setpoint_ram_id = ramid + 1
+                found, ramid = self.parse_scan_ess_assistant(rx, ramid)
+                if found:
                     return True
-                else:
-                    ramid += 1 + ram & 0x000F  # skip other
             except IOError:
                 self.serial = None
                 self.log.error("serial port failed")
@@ -313,14 +433,423 @@ class VEBus:
         self.log.error("ess assistant not found")
         return False
 
+    def verify_ess_assistant(self, ramid):
+        """
+        Check a known setpoint RAM id (e.g. from a previous scan) with one read of the assistant header at ramid-1
+
+        :param ramid: ESS setpoint RAM id
+        :return: True/False
+        """
+        if self.serial is None:
+            self.open_port()  # open port
+
+        try:
+            self.send_frame('X', struct.pack("<BH", 0x30, ramid - 1))  # read ram id
+            rx = self.receive_frame(b'\x07\xFF\x58')
+            found, _ = self.parse_scan_ess_assistant(rx, ramid - 1)
+            return found
+        except IOError:
+            self.serial = None
+            self.log.error("serial port failed")
+        except Exception as e:
+            self.log.error("verify_ess_assistant ramid={} error={}".format(ramid, e))
+        return False
+
+    # ====== RAM variables ======
+
+    SNAPSHOT_IDS = [15, 16, 4, 5, 13]  # default RAM ids of the snapshot, up to 6x, see send_snapshot_request()
+    SNAPSHOT_MAX = 6
+
+    # name in the result of read_ram_vars(), other ids: 'ram_<id>'
+    RAM_VARS = {0: 'mains_u_rms', 1: 'mains_i_rms', 2: 'inv_u_rms', 3: 'inv_i_rms', 4: 'bat_u', 5: 'bat_i',
+                6: 'bat_u_rms', 7: 'inv_period', 8: 'mains_period', 9: 'ac_load_i', 10: 'virtual_switch',
+                11: 'ignore_ac_input', 12: 'relay_state', 13: 'soc', 14: 'inv_p_14', 15: 'inv_p', 16: 'out_p'}
+    RAM_VAR_SIGN = {15: -1}  # 15 Inverter Power (filtered) falsches Vorzeichen, +: charge AC>DC -: feed DC>AC
+    # (scale, offset, signed, digits) used until the RAM var info is received
+    RAM_VAR_DEFAULT = {4: (0.01, 0, True, 2), 5: (0.1, 0, True, 1), 13: (0.5, 0, True, 1),
+                       14: (1, 0, True, 0), 15: (1, 0, True, 0), 16: (1, 0, True, 0)}
+
+    def set_snapshot_ids(self, ids):
+        """
+        :param ids: RAM ids read with every update (up to 6)
+        """
+        if not 0 < len(ids) <= self.SNAPSHOT_MAX:
+            raise ValueError("1..{} RAM ids per snapshot, got {}".format(self.SNAPSHOT_MAX, len(ids)))
+        self.snapshot_ids = list(ids)
+
+    def get_ram_var_info(self, ramid):
+        """
+        Read scale and offset of a RAM variable, the result is cached
+
+        TX: 05 FF 58 36 04 00 6A          X| 36 04 00        0x36/CommandGetRAMVarInfo ram_id=4
+        RX: 07 FF 58 8E 9C 7F 00 00 59    X| 8E 9C 7F 00 00  0x8E/RamVarInfo scale=0x7F9C (1/100) offset=0
+
+        :param ramid: RAM id
+        :return: (scale, offset, signed, digits) or None
+        """
+        key = (self.address, self.mk2_version, ramid)
+        if key in self.ram_var_info:
+            return self.ram_var_info[key]
+
+        if self.serial is None:
+            self.open_port()  # open port
+
+        try:
+            self.send_frame('X', struct.pack("<BH", 0x36, ramid))
+            rx = self.receive_frame(b'\x07\xFF\x58\x8E')
+            return self.parse_ram_var_info(rx, ramid)
+        except IOError:
+            self.serial = None
+            self.log.error("serial port failed")
+        except Exception as e:
+            self.log.error("get_ram_var_info: ramid={} error={}".format(ramid, e))
+            return None
+
+    def load_ram_var_info(self, ids):
+        """
+        Read the missing RAM var info (once after connect)
+
+        :return: True if the info of all ids is known
+        """
+        return all([self.get_ram_var_info(ramid) is not None for ramid in ids])
+
+    def read_ram_vars(self, ids, pause=0.05):
+        """
+        Read up to 6 RAM variables with one snapshot
+
+        :param ids: RAM ids
+        :param pause: time for the snapshot between trigger and read in seconds
+        :return: dictionary {name: value} (names see RAM_VARS) or None
+        """
+        if not 0 < len(ids) <= self.SNAPSHOT_MAX:
+            raise ValueError("1..{} RAM ids per snapshot, got {}".format(self.SNAPSHOT_MAX, len(ids)))
+        self.load_ram_var_info(ids)
+
+        if self.serial is None:
+            self.open_port()  # open port
+
+        try:
+            self.send_frame('F', [0x06] + list(ids))  # no response
+            time.sleep(pause)
+            self.send_frame('X', [0x38])
+            frame = self.receive_frame(self.snapshot_head(ids))
+            return self.parse_ram_vars(frame, ids)
+        except IOError:
+            self.serial = None
+            self.log.error("serial port failed")
+        except Exception as e:
+            self.log.error("read_ram_vars: ids={} error={}".format(ids, e))
+            return None
+
+    def snapshot_head(self, ids):
+        """
+        :return: start of the snapshot response for the ids
+        """
+        return bytes((3 + 2 * len(ids), 0xFF, 0x58, 0x99))
+
+    # ====== Pipelined transactions ======
+
+    def batch_ac_info(self):
+        """
+        :return: batch for transact(), list of (cmd, data, head of the response or None)
+        """
+        return [('F', [0x06] + self.snapshot_ids, None)] + \
+               [('F', [phase], b'\x0F\x20') for phase in self.phases]  # trigger snapshot (no response), AC info L1..
+
+    def batch_set_power(self, setpoints):
+        """
+        :param setpoints: list of (address, ram id, power)
+        :return: batch for transact(), the device at the actual address is written last and stays selected
+        """
+        setpoints = sorted(setpoints, key=lambda s: s[0] == self.address)  # actual address last
+        batch = []
+        for addr, ramid, power in setpoints:
+            batch.append(('A', [0x01, addr], b'\x04\xFF\x41'))
+            batch.append(('X', self.make_set_power(power, ramid), [b'\x05\xFF\x58', b'\x03\xFF\x58']))
+        if setpoints[-1][0] != self.address:
+            batch.append(('A', [0x01, self.address], b'\x04\xFF\x41'))  # select the actual address again
+        return batch
+
+    def parse_set_power_multi(self, batch, rx):
+        """
+        :return: True if all devices confirmed address and setpoint
+        """
+        if len(rx) != len(batch):
+            self.log.error("set_power_multi: {} responses for {} requests".format(len(rx), len(batch)))
+            return False
+        for (cmd, data, head), frame in zip(batch, rx):
+            if head is None:
+                continue  # no response expected
+            if frame is None:
+                self.log.error("set_power_multi: no response for {} {}".format(cmd, self.format_hex(data)))
+                return False
+            if cmd == 'A':
+                self.parse_init_address(frame, data[1])
+            else:
+                self.parse_set_power(frame, -struct.unpack("<h", data[3:5])[0])
+        return True
+
+    def set_power_multi(self, setpoints):
+        """
+        Set the ESS power of several devices with one write
+
+        :param setpoints: list of (address, ram id, power)
+        :return: True/False
+        """
+        if self.serial is None:
+            self.open_port()  # open port
+
+        try:
+            batch = self.batch_set_power(setpoints)
+            return self.parse_set_power_multi(batch, self.transact(batch, 0.5 + 0.06 * len(batch)))
+        except IOError:
+            self.serial = None
+            self.log.error("serial port failed")
+        except Exception as e:
+            self.log.error("set_power_multi: setpoints={} error={}".format(setpoints, e))
+            return False
+
+    def batch_snapshot_led(self):
+        return [('X', [0x38], self.snapshot_head(self.snapshot_ids)),  # read snapshot
+                ('L', [], b'\x08\xFF\x4C')]  # LED status
+
+    def transact(self, batch, timeout=0.5):
+        """
+        Send several requests with one write, the responses are assigned by their start (length, marker, command)
+
+        :param batch: list of (cmd, data, head), head None for a request without response
+        :param timeout: timeout for all responses
+        :return: list with a response frame per request (None without response)
+        """
+        tx, responses, pending = self.make_batch(batch)
+        self.log.debug("TX: batch={}".format(self.format_hex(tx)))
+        self.write(tx, len(batch))
+        tout = time.perf_counter() + timeout
+        while not self.assign_frames(pending, responses):
+            if time.perf_counter() >= tout:
+                raise Exception("batch timeout, missing {}".format([batch[i][0] for i in pending]))
+            self.read_port()
+        return responses
+
+    def make_batch(self, batch):
+        """
+        :return: (frames to send, list for the responses, pending responses {index: head})
+        """
+        tx = b''.join(self.build_frame(cmd, data) for cmd, data, head in batch)
+        pending = {i: tuple(head) if isinstance(head, (list, tuple)) else head
+                   for i, (cmd, data, head) in enumerate(batch) if head is not None}
+        return tx, [None] * len(batch), pending
+
+    def assign_frames(self, pending, responses):
+        """
+        Assign the parsed frames to the pending requests, other frames are dropped
+
+        :return: True if all responses are received
+        """
+        while pending:
+            frame = self.next_frame()
+            if frame is None:
+                return False
+            for i, head in pending.items():
+                if frame.startswith(head):
+                    self.log.debug("RX: frame={}".format(self.format_hex(frame)))
+                    responses[i] = frame
+                    del pending[i]
+                    break
+            else:
+                self.on_unsolicited(frame)
+        return True
+
+    def get_ac_info_batch(self):
+        """
+        Trigger snapshot and get AC info with one write (like Venus OS)
+
+        :return: Dictionary or None
+        """
+        if self.serial is None:
+            self.open_port()  # open port
+
+        try:
+            rx = self.transact(self.batch_ac_info())
+            return self.parse_ac_phases(rx[1:])
+        except IOError:
+            self.serial = None
+            self.log.error("serial port failed")
+        except Exception as e:
+            self.log.error("get_ac_info_batch: {}".format(e))
+            return None
+
+    def read_snapshot_led(self):
+        """
+        Read snapshot and LED status with one write
+
+        :return: (snapshot dictionary, led dictionary) or (None, None)
+        """
+        if self.serial is None:
+            self.open_port()  # open port
+
+        try:
+            rx = self.transact(self.batch_snapshot_led())
+            return self.parse_snapshot(rx[0]), self.parse_led(rx[1])
+        except IOError:
+            self.serial = None
+            self.log.error("serial port failed")
+        except Exception as e:
+            self.log.error("read_snapshot_led: {}".format(e))
+        return None, None
+
+    # ====== Parser, shared with the asyncio driver (aio.py) ======
+
+    def parse_version(self, frame):
+        cmd, mk2_version = struct.unpack("<BI", frame[2:7])
+        self.log.info("mk2_version={}".format(mk2_version))
+        self.mk2_version = mk2_version
+        return mk2_version
+
+    def parse_init_address(self, frame, addr):
+        if frame[4] == addr:  # check if correct answer and address
+            self.log.info("init_address {} successful".format(addr))
+            self.address = addr
+            return True
+        else:
+            raise Exception("init_address failed")
+
+    def parse_led(self, frame):
+        led_light, led_blink = struct.unpack("<BB", frame[3:5])  # high=blink   low = light
+        self.log.info("led_light=0x{:02X} led_blink=0x{:02X}".format(led_light, led_blink))
+        return self.make_led_status(led_light, led_blink)
+
+    def make_led_status(self, led_light, led_blink):
+        return {'led_light': led_light, 'led_blink': led_blink, 'led_info': self.make_led_names(led_light | led_blink)}
+
+    def parse_ac_info(self, frame):
+        bf_factor, inv_factor, device_state_id, phase_info, mains_u, mains_i, inv_u, inv_i, mains_period = struct.unpack(
+            "<BBxBBhhhhB", frame[2:16])
+
+        device_state_name = {0: 'down', 1: 'startup', 2: 'off', 3: 'slave', 4: 'invert_full', 5: 'invert_half',
+                             6: 'invert_aes', 7: 'power_assist', 8: 'bypass', 9: 'charge'}[device_state_id]
+
+        r = {'device_state_id': device_state_id,
+             'device_state_name': device_state_name,
+             'mains_u': round(mains_u / 100, 2),
+             'mains_i': round(mains_i / 100, 2),
+             'inv_u': round(inv_u / 100, 2),
+             'inv_i': round(inv_i / 100, 2)}
+        self.log.info(r)
+        return r
+
+    PHASE_INFO = {0x05: 4, 0x06: 3, 0x07: 2, 0x08: 1, 0x09: 1, 0x0A: 1, 0x0B: 1}  # phase_info: phase
+
+    def parse_ac_phases(self, frames):
+        """
+        :param frames: AC info frames in the order of self.phases
+        :return: dictionary of the first phase, with more phases a list 'phases'
+        """
+        r = self.parse_ac_info(frames[0])
+        if len(frames) > 1:
+            r['phases'] = []
+            for phase, frame in zip(self.phases, frames):
+                p = self.parse_ac_info(frame)
+                r['phases'].append({'phase': self.PHASE_INFO.get(frame[6], phase),
+                                    'mains_u': p['mains_u'],
+                                    'mains_i': p['mains_i'],
+                                    'inv_u': p['inv_u'],
+                                    'inv_i': p['inv_i'],
+                                    'inv_p': round(p['inv_u'] * p['inv_i'])})
+        return r
+
+    def parse_snapshot(self, frame):
+        r = self.parse_ram_vars(frame, self.snapshot_ids)
+        if 'bat_u' in r and 'bat_i' in r:
+            r['bat_p'] = round(r['bat_u'] * r['bat_i'])
+        self.log.info("read_snapshot: {}".format(r))
+        return r
+
+    def parse_ram_vars(self, frame, ids):
+        """
+        :param frame: snapshot response
+        :param ids: RAM ids of the snapshot request
+        :return: dictionary {name: value}
+        """
+        if frame[3] != 0x99 or len(frame) < 5 + 2 * len(ids):
+            raise Exception('invalid response')
+        r = {}
+        for n, ramid in enumerate(ids):
+            scale, offset, signed, digits = self.ram_var_info.get((self.address, self.mk2_version, ramid)) or \
+                                            self.RAM_VAR_DEFAULT.get(ramid, (1, 0, True, 0))
+            raw = frame[4 + 2 * n] | frame[5 + 2 * n] << 8
+            if signed and raw & 0x8000:
+                raw -= 0x10000
+            value = scale * (raw + offset) * self.RAM_VAR_SIGN.get(ramid, 1)
+            r[self.RAM_VARS.get(ramid, 'ram_{}'.format(ramid))] = round(value, digits) if digits else round(value)
+        return r
+
+    def parse_ram_var_info(self, frame, ramid):
+        """
+        Decode and cache the RAM var info
+
+        :return: (scale, offset, signed, digits)
+        """
+        if frame[3] != 0x8E:
+            raise Exception('invalid response')
+        scale, offset = struct.unpack("<hh", frame[4:8])
+        signed = scale < 0
+        scale = abs(scale)
+        if scale >= 0x4000:
+            scale = 1 / (0x8000 - scale)
+        elif scale == 0:
+            scale = 1
+        digits = max(0, math.ceil(-math.log10(scale) - 1e-9))
+        info = (scale, offset, signed, digits)
+        self.ram_var_info[(self.address, self.mk2_version, ramid)] = info
+        self.log.info("ram_var_info ramid={} scale={:g} offset={} signed={}".format(ramid, scale, offset, signed))
+        return info
+
+    def make_set_power(self, power, ramid=None):
+        ramid = ramid if ramid else self.ess_setpoint_ram_id
+        return struct.pack("<BBBh", 0x37, 0x00, ramid, -power)  # cmd, flags, id, power
+
+    def parse_set_power(self, frame, power):
+        if frame[3] == 0x87:
+            self.log.info("set_ess_power to {}W done".format(power))
+            return True
+        else:
+            raise Exception("invalid response")
+
+    def parse_scan_ess_assistant(self, frame, ramid):
+        """
+        :return: (found, next ramid to scan)
+        """
+        ram = frame[4] + frame[5] * 256  # value at ramid
+        self.log.debug("scan_ess_assistant ramid={} value=0x{:04X}".format(ramid, ram))
+        if ram & 0xFFF0 == 0x0050:  # ESS Assistant
+            self.log.info("found ess assistant at ramid={}".format(ramid))
+            self.ess_setpoint_ram_id = ramid + 1
+            return True, ramid
+        else:
+            return False, ramid + (1 + ram & 0x000F)  # skip other
+
+    # ====== Frame handling ======
+
     def format_hex(self, data):
         return " ".join(["{:02X}".format(b) for b in data])
 
     def send_frame(self, cmd, data):
         frame = self.build_frame(cmd, data)
         self.log.debug("TX: cmd={} frame={}".format(cmd, self.format_hex(frame)))
-        self.serial.reset_input_buffer()  # test ob es was hilft ?
-        self.serial.write(frame)
+        self.write(frame)
+
+    def write(self, data, frames=1):
+        self.serial.write(data)
+        self.link.add_tx(len(data), frames)
+
+    def read_port(self):
+        """
+        Read the received bytes into the parser, blocks until data or port timeout
+        """
+        data = self.serial.read(self.serial.in_waiting or 1)
+        self.link.add_rx(len(data))
+        self.parser.feed(data)
 
     def build_frame(self, cmd, data):
         """
@@ -344,40 +873,108 @@ class VEBus:
 
     def receive_frame(self, head, timeout=0.5):
         """
-        Receive frame
+        Receive frame. Valid frames with an other start (e.g. late answer of a previous request) are skipped.
 
-        :param head: search pattern (frame start)
+        :param head: search pattern (frame start) or list of search pattern
         :param timeout:
         :return: frame bytes
         """
-        # self.serial.reset_input_buffer()
-        rx = bytes()
         tout = time.perf_counter() + timeout
-        while time.perf_counter() < tout:
-            rx += self.serial.read(500)
-            time.sleep(0.010)
-            if isinstance(head, (list, tuple)):
-                for h in head:
-                    p = rx.find(h)
-                    if p >= 0:
-                        break
-            else:
-                p = rx.find(head)
+        while True:
+            frame = self.match_frame(head)
+            if frame is not None:
+                return frame
+            if time.perf_counter() >= tout:
+                break
+            self.read_port()
+
+        if self.parser.buffer:
+            raise Exception("invalid rx frame {}".format(self.format_hex(self.parser.buffer)))
+        else:
+            raise Exception("receive timeout, no data")
+
+    def match_frame(self, head):
+        """
+        Get the next parsed frame starting with head, other frames are dropped
+
+        :param head: search pattern (frame start) or list of search pattern
+        :return: frame bytes or None
+        """
+        heads = tuple(head) if isinstance(head, (list, tuple)) else head
+        frame = self.next_frame()
+        while frame is not None:
+            if frame.startswith(heads):
+                self.log.debug("RX: frame={}".format(self.format_hex(frame)))
+                return frame
+            self.on_unsolicited(frame)
+            frame = self.next_frame()
+        return None
+
+    # ====== Dispatcher ======
+
+    def next_frame(self):
+        """
+        :return: next parsed frame after dispatch() or None
+        """
+        frame = self.parser.next_frame()
+        if frame is None:
+            return None
+        self.link.add_rx_frame()
+        return self.dispatch(frame)
+
+    def dispatch(self, frame):
+        """
+        Remove and store an appended LED status
 
-            if (p >= 0):
-                flen = rx[p] + 2  # expected full package length
-                if (len(rx) - p) >= flen:  # rx matches expected full package length
-                    self.log.debug("RX: frame={}".format(self.format_hex(rx[p:p + flen])))
-                    return rx[p:p + flen]
+        :param frame: valid frame
+        :return: frame without LED status
+        """
+        if not frame[0] & 0x80:
+            return frame
+        self.led_status = self.make_led_status(frame[-3], frame[-2])
+        self.led_time = time.perf_counter()
+        head = bytes(((frame[0] & 0x7F) - 2,)) + frame[1:-3]
+        return head + bytes(((256 - sum(head)) & 0xFF,))
+
+    def add_handler(self, cmd, func):
+        """
+        :param cmd: command (character or byte value)
+        :param func: function(frame) called for unsolicited frames with this command
+        """
+        self.handlers[ord(cmd) if isinstance(cmd, str) else cmd] = func
 
-        if rx:
-            raise Exception("invalid rx frame {}".format(self.format_hex(rx)))
+    def on_unsolicited(self, frame):
+        """
+        Frame without waiting request (broadcast or late response)
+        """
+        cmd = frame[2]
+        self.parser.unexpected += 1
+        self.unsolicited[cmd] = self.unsolicited.get(cmd, 0) + 1
+        handler = self.handlers.get(cmd)
+        if handler:
+            handler(frame)
         else:
-            raise Exception("receive timeout, no data")
+            self.log.debug("RX: unsolicited frame={}".format(self.format_hex(frame)))
+
+    def on_version(self, frame):
+        if frame[1] == 0xFF and len(frame) >= 8:
+            self.broadcast_version = struct.unpack("<I", frame[3:7])[0]
+
+    def get_led_status(self, max_age):
+        """
+        :param max_age: maximum age in seconds
+        :return: LED status appended to a received frame or None if older than max_age
+        """
+        if self.led_time is not None and time.perf_counter() - self.led_time <= max_age:
+            return self.led_status
+        return None
+
+    WAKEUP_FRAME = bytes([0x05, 0x3F, 0x07, 0x00, 0x00, 0x00, 0xC2])
+    SLEEP_FRAME = bytes([0x05, 0x3F, 0x04, 0x00, 0x00, 0x00, 0xC5])
 
     def wakeup(self):
         try:
-            self.serial.write(bytes([0x05, 0x3F, 0x07, 0x00, 0x00, 0x00, 0xC2]))
+            self.write(self.WAKEUP_FRAME)
             self.log.info("WAKEUP !!!")
         except IOError:
             self.serial = None
@@ -392,7 +989,7 @@ class VEBus:
         Standby consumption: ~1,3 Watt     DC: 27mA AC: 0.0 Watt
         """
         try:
-            self.serial.write(bytes([0x05, 0x3F, 0x04, 0x00, 0x00, 0x00, 0xC5]))
+            self.write(self.SLEEP_FRAME)
             self.log.info("SLEEP !!!")
         except IOError:
             self.serial = None
@@ -8,6 +8,7 @@ from bottle import Bottle, request, response, static_file, redirect, template
 
 from config import config
 from session import Session
+from timing import timing
 from utils import dictget
 from version import __version__
 
@@ -19,7 +20,12 @@ class AppWeb:
     Webserverintegration for application
     """
 
-    def __init__(self, app, log='web'):
+    def __init__(self, app, log='web', server=True):
+        """
+        :param app: application
+        :param log: name for logger
+        :param server: start the waitress webserver thread, False if served by the asyncio runtime (aio.py)
+        """
         self.app = app  # reference to application
         self.log = logging.getLogger(log)
         self.web = Bottle()  # webserver
@@ -35,16 +41,21 @@ class AppWeb:
         self.web.route('/api/state/<state>', callback=self.web_api_state)
         self.web.route('/api/set', callback=self.web_api_set, method=('GET', 'POST'))
         self.web.route('/api/bms', callback=self.web_api_bms)  # full bms data in json format
+        self.web.route('/api/cells', callback=self.web_api_cells)  # cell history statistics in json format
+        self.web.route('/api/cells/<pack:int>', callback=self.web_api_cells)  # cell history of a pack
+        self.web.route('/api/cycle', callback=self.web_api_cycle)  # control cycle statistics in json format
+        self.web.route('/api/timing', callback=self.web_api_timing)  # latency per stage in json format
         self.web.route('/debug/<cmd>', callback=self.web_debug_cmd)  # debug commands
         self.web.route('/log', callback=self.web_log)  # access to logfile
         self.web.route('/chart', callback=self.web_chart)  #
         self.web.route('/blackbox', callback=lambda : "\n".join(self.app.blackbox.record_lines))  #
         self.web.route('/<filepath:path>', callback=self.web_static)  # hosting static files
 
-        logging.getLogger('waitress.queue').setLevel(logging.ERROR)  # hide waitress info log
-        # start webserver thread
-        threading.Thread(target=self.web.run, daemon=True,
-                         kwargs=dict(host='0.0.0.0', port=config['http_port'], server='waitress')).start()
+        if server:
+            logging.getLogger('waitress.queue').setLevel(logging.ERROR)  # hide waitress info log
+            # start webserver thread
+            threading.Thread(target=self.web.run, daemon=True,
+                             kwargs=dict(host='0.0.0.0', port=config['http_port'], server='waitress')).start()
 
     def web_login(self):
         """
@@ -133,7 +144,7 @@ class AppWeb:
 
         session_id = request.get_cookie('session')
 
-        state = self.app.get_state()
+        state = dict(self.app.snapshot.state)  # shallow copy of the published snapshot for the extra keys
 
         # manual auth
         if self.app.mode == 'manual' and self.manual_session and session_id == self.manual_session:
@@ -178,7 +189,10 @@ class AppWeb:
                 self.log.error('/api/set exception: {}'.format(e))
         else:
             self.log.error('/api/set without valid session')
-        return self.app.get_state()
+
+        state = dict(self.app.snapshot.state)
+        state['ess'] = dict(state['ess'], mode=self.app.mode, setting=self.app.setting)  # show changes instantly
+        return state
 
     def web_api_bms(self):
         """
@@ -187,6 +201,51 @@ class AppWeb:
         response.content_type = 'application/json'
         return json.dumps(self.app.bms.get_detail())
 
+    def web_api_cells(self, pack=None):
+        """
+        /api/cells?window=3600                  cell spread, lowest/highest cell and temperature trend per pack
+        /api/cells/<pack>?window=3600&points=300    time series of a pack for a chart
+        """
+        response.content_type = 'application/json'
+        history = getattr(self.app.bms, 'history', None)
+        if history is None:
+            return json.dumps({'error': 'no cell history'})
+        try:
+            window = float(request.query.get('window', 3600)) or None  # 0: all
+            if pack is None:
+                return json.dumps(history.get_summary(window))
+            if not 0 <= pack < history.pack_number:
+                raise ValueError("pack {} not available".format(pack))
+            return json.dumps(history.get_series(pack, window, int(request.query.get('points', 300))))
+        except ValueError as e:
+            return json.dumps({'error': str(e)})
+
+    def web_api_cycle(self):
+        """
+        /api/cycle      Webserver interface to get control cycle and acquisition statistics as json
+        """
+        response.content_type = 'application/json'
+        d = self.app.scheduler.get_state()
+        if self.app.fast_scheduler:
+            d['fast'] = self.app.fast_scheduler.get_state()
+        d['acquisition'] = self.app.acquisition.get_state()
+        if hasattr(self.app.multiplus, 'get_state'):
+            d['multiplus'] = self.app.multiplus.get_state()
+        vebus = getattr(self.app.multiplus, 'vebus', None)
+        if vebus is not None:
+            d['vebus'] = vebus.parser.get_state()
+            d['vebus_link'] = vebus.link.get_state()
+        if hasattr(self.app.meterhub, 'get_state'):
+            d['meter_stream'] = self.app.meterhub.get_state()
+        return json.dumps(d)
+
+    def web_api_timing(self):
+        """
+        /api/timing     Webserver interface to get the latency statistics (p50/p95/p99/max in ms) per stage as json
+        """
+        response.content_type = 'application/json'
+        return json.dumps(timing.get_state())
+
     def web_debug_cmd(self, cmd):
         """
 